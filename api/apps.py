@@ -4,3 +4,31 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from .counters import UnreadCounter
+        from .delivery import DeliveryScheduler
+        from .profiles import ProfileCache
+        from .realtime import PushHub
+        from .search import LetterSearch
+        from .sharding import Shards
+        from django.db.models import signals
+
+        # 调度器只在wsgi/asgi中启动 这里只注册listener
+        DeliveryScheduler.getInstance().addListener(PushHub.getInstance().onDeliver)
+        DeliveryScheduler.getInstance().addReloadListener(UnreadCounter.invalidateAll)
+
+        UnreadCounter.checkBackend()
+        ProfileCache.checkBackend()
+
+        # 全文索引随信件的保存/删除同步
+        signals.pre_save.connect(LetterSearch.onPreSave, sender='api.Letter')
+        signals.post_save.connect(LetterSearch.onPostSave, sender='api.Letter')
+        signals.pre_delete.connect(LetterSearch.onPreDelete, sender='api.Letter')
+
+        # 用户资料缓存随昵称、经验值等的修改失效
+        signals.post_save.connect(ProfileCache.onUserSaved, sender='api.User')
+
+        # 分片建表后设置各表的主键起点 有信件表的数据库同时建立全文索引表
+        signals.post_migrate.connect(Shards.onPostMigrate, sender=self)
+        signals.post_migrate.connect(LetterSearch.onPostMigrate, sender=self)
@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import *
+
+import bisect
+import functools
+import json
+import os
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+
+from .sharding import Shards
+
+
+# 默认配置 可在settings.LETTER_ARCHIVE中覆盖
+DEFAULT_ARCHIVE_CONFIG:Dict[str,Any] = {
+    'DIR': Path(settings.BASE_DIR) / 'archive',
+    'AGE_DAYS': 180,            # 到达超过此天数且已读的信件归档
+    'SEGMENT_LETTERS': 500,     # 每个段文件最多包含的信件数
+}
+
+ARCHIVE_BOXES = ('inbox', 'outbox')
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' # 定长 字符串顺序即时间顺序
+
+# 段文件中每封信的字段
+RECORD_FIELDS = ('id', 'sender_id', 'receiver_id', 'receiver_alias', 'has_read', 'send_time', 'recv_time', 'content')
+RECORD_ID, RECORD_SEND_TIME, RECORD_RECV_TIME = 0, 5, 6
+
+
+def archiveConfig() -> Dict[str,Any]:
+    config = dict(DEFAULT_ARCHIVE_CONFIG)
+    config.update(getattr(settings, 'LETTER_ARCHIVE', {}))
+    return config
+
+
+def formatTime(time:datetime) -> str:
+    return time.strftime(TIME_FORMAT)
+
+
+def parseTime(timestr:str) -> datetime:
+    return datetime.strptime(timestr, TIME_FORMAT)
+
+
+@functools.lru_cache(maxsize=64)
+def loadSegment(path:str) -> List[List]:
+    '''段文件写入后不再修改 可以按路径缓存'''
+    with open(path, 'rb') as f:
+        return json.loads(zlib.decompress(f.read()))
+
+
+class LetterArchive:
+    '''
+    一个用户的收件箱或发件箱的冷数据
+
+    目录为 <DIR>/<user_id末两位十六进制>/<user_id>/<box>/ 包含:
+      seg-<序号>.z   zlib压缩的JSON 信件记录按(时间, id)倒序 收件箱按到达时间 发件箱按发出时间
+      index.json     各段的信件数、键范围和id列表
+    段文件只追加不修改 index.json写临时文件后原子替换 因此读取方不需要加锁
+    append不做fsync 调用方在删除数据库中的行之前应统一落盘（os.sync）
+    同一封信在寄信人的outbox和收信人的inbox中各存一份
+    '''
+    def __init__(self, userId:int, box:str):
+        assert box in ARCHIVE_BOXES
+        self.userId = userId
+        self.box = box
+        self.timeIndex = RECORD_RECV_TIME if box == 'inbox' else RECORD_SEND_TIME
+        self.dir = Path(archiveConfig()['DIR']) / ('%02x' % (userId % 256)) / str(userId) / box
+        self._index:Optional[Dict] = None
+
+    @property
+    def index(self) -> Dict:
+        if self._index is None:
+            try:
+                with open(self.dir / 'index.json', 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {'next': 1, 'segments': []}
+        return self._index
+
+    def key(self, record:List) -> Tuple[str,int]:
+        return record[self.timeIndex], record[RECORD_ID]
+
+    def maxKey(self) -> Optional[Tuple[str,int]]:
+        '''归档中最新的(时间, id) 没有归档时为None'''
+        segments = self.index['segments']
+        if not segments:
+            return None
+        return max(tuple(seg['max']) for seg in segments)
+
+    def letterIds(self) -> Set[int]:
+        return set(letterId for seg in self.index['segments'] for letterId in seg['ids'])
+
+    ##############################################
+
+    def append(self, records:List[List]) -> None:
+        '''追加一批记录 已归档过的id会被跳过'''
+        existing = self.letterIds()
+        records = sorted((r for r in records if r[RECORD_ID] not in existing), key=self.key, reverse=True)
+        if not records:
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        index = self.index
+        size = archiveConfig()['SEGMENT_LETTERS']
+        for start in range(0, len(records), size):
+            chunk = records[start:start+size]
+            name = 'seg-%06d.z' % index['next']
+            with open(self.dir / name, 'wb') as f:
+                f.write(zlib.compress(json.dumps(chunk, ensure_ascii=False).encode('utf-8')))
+            index['segments'].append({'file': name, 'count': len(chunk), 'max': list(self.key(chunk[0])),
+                                      'min': list(self.key(chunk[-1])), 'ids': [r[RECORD_ID] for r in chunk]})
+            index['next'] += 1
+        tmp = self.dir / 'index.json.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.dir / 'index.json')
+
+    def page(self, cursor:Optional[Tuple[datetime,int]], limit:int) -> List[List]:
+        '''(时间, id)严格小于cursor的前limit条记录 按倒序'''
+        bound = (formatTime(cursor[0]), cursor[1]) if cursor is not None else None
+        candidates = []
+        for seg in self.index['segments']:
+            if bound is not None and tuple(seg['min']) >= bound:
+                continue
+            records = loadSegment(str(self.dir / seg['file']))
+            start = 0
+            if bound is not None:
+                # 记录倒序 找到第一个小于bound的位置
+                keys = [self.key(r) for r in records]
+                start = len(keys) - bisect.bisect_left(keys[::-1], bound)
+            candidates.extend(records[start:start+limit])
+        candidates.sort(key=self.key, reverse=True)
+        return candidates[:limit]
+
+    def iterRecords(self) -> Iterator[List]:
+        '''按倒序遍历全部记录 每次只加载一个段'''
+        for seg in sorted(self.index['segments'], key=lambda seg: tuple(seg['max']), reverse=True):
+            yield from loadSegment(str(self.dir / seg['file']))
+
+    def get(self, letterId:int) -> Optional[List]:
+        for seg in self.index['segments']:
+            if letterId in seg['ids']:
+                for record in loadSegment(str(self.dir / seg['file'])):
+                    if record[RECORD_ID] == letterId:
+                        return record
+        return None
+
+    def getMany(self, letterIds:Iterable[int]) -> Dict[int,List]:
+        '''{id: 记录} 只加载包含这些id的段 不在归档中的id不出现在结果中'''
+        wanted = set(letterIds)
+        found = {}
+        for seg in self.index['segments']:
+            if wanted.isdisjoint(seg['ids']):
+                continue
+            for record in loadSegment(str(self.dir / seg['file'])):
+                if record[RECORD_ID] in wanted:
+                    found[record[RECORD_ID]] = record
+            wanted.difference_update(found)
+            if not wanted:
+                break
+        return found
+
+    ##############################################
+
+    @staticmethod
+    def toRecord(letter) -> List:
+        return [letter.id, letter.sender_id, letter.receiver_id, letter.receiver_alias, letter.has_read,
+                formatTime(letter.send_time), formatTime(letter.recv_time), letter.content]
+
+    @staticmethod
+    def toLetters(records:List[List]) -> List:
+        '''把记录还原为（未保存的）Letter对象 寄信人/收信人每个分片一次查询取出'''
+        from .models import Letter
+        userIds = set(r[1] for r in records if r[1] is not None) | set(r[2] for r in records if r[2] is not None)
+        users = Shards.usersByIds(userIds, 'id', 'username', 'nickname') if userIds else {}
+        letters = []
+        for r in records:
+            letter = Letter(id=r[0], receiver_alias=r[3], has_read=r[4],
+                            send_time=parseTime(r[5]), recv_time=parseTime(r[6]), content=r[7])
+            letter.sender = users.get(r[1])
+            letter.receiver = users.get(r[2])
+            letter.sender_id, letter.receiver_id = r[1], r[2]
+            letters.append(letter)
+        return letters
@@ -0,0 +1,521 @@
+from __future__ import annotations
+from typing import *
+
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import django
+from django.db import connection
+from django.http import QueryDict
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+# 判定为性能退化的默认阈值 median比基线慢20%以上
+REGRESSION_THRESHOLD = 0.2
+
+
+class Benchmark:
+    '''
+    一个benchmark项
+
+    factory(ctx)在每轮计时前调用 做不计时的准备工作 返回被计时的op(i)
+    每轮调用op(i) number次 共repeat轮 以每轮的单次耗时做统计
+    '''
+    REGISTRY:Dict[str,Benchmark] = {}
+
+    def __init__(self, name:str, factory:Callable, group:str, number:int, repeat:int):
+        self.name = name
+        self.factory = factory
+        self.group = group
+        self.number = number
+        self.repeat = repeat
+
+    def run(self, ctx:BenchContext, scale:float=1.0) -> Dict:
+        number = max(1, int(self.number * scale))
+        timings = []
+        for _ in range(self.repeat):
+            op = self.factory(ctx)
+            start = time.perf_counter()
+            for i in range(number):
+                op(i)
+            timings.append((time.perf_counter() - start) / number)
+        median = statistics.median(timings)
+        return {
+            'group': self.group,
+            'number': number,
+            'repeat': self.repeat,
+            'min': min(timings),
+            'median': median,
+            'mean': statistics.mean(timings),
+            'ops': 1 / median if median > 0 else None,
+        }
+
+
+def benchmark(name:str, group:str='micro', number:int=1000, repeat:int=5) -> Callable:
+    '''注册benchmark的装饰器'''
+    def decorator(factory:Callable) -> Callable:
+        Benchmark.REGISTRY[name] = Benchmark(name, factory, group, number, repeat)
+        return factory
+    return decorator
+
+
+class BenchContext:
+    '''
+    benchmark运行环境
+
+    在临时SQLite文件上建立测试库 写入固定seed的用户和信件 全部benchmark共享
+    '''
+    PASSWORD = 'bench-password'
+
+    def __init__(self, users:int=20, letters:int=200, seed:int=0):
+        self.userCount = users
+        self.letterCount = letters
+        self.seed = seed
+        self.usernames:List[str] = []
+        self.counter = 0
+        self.oldDbName = None
+        self.tmpdir = None
+
+    def nextId(self) -> int:
+        '''全局递增序号 用于生成不重复的用户名等'''
+        self.counter += 1
+        return self.counter
+
+    def setup(self) -> None:
+        setup_test_environment()
+        self.tmpdir = tempfile.mkdtemp(prefix='myletter-bench-')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(self.tmpdir, 'bench.sqlite3')
+        self.oldDbName = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        self.seedData()
+
+    def teardown(self) -> None:
+        from .experience import ExpLedger
+        from .stats import RegionStats
+
+        # 缓冲的经验值、地区统计在测试库销毁前写入 之后进程退出时没有要写的
+        for ledger in (ExpLedger.INSTANCE, RegionStats.INSTANCE):
+            if ledger is not None:
+                ledger.stop()
+        connection.creation.destroy_test_db(self.oldDbName, verbosity=0)
+        teardown_test_environment()
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def seedData(self) -> None:
+        from .models import Letter, User, VirtualLocation
+        from .passwords import PasswordService
+
+        rng = random.Random(self.seed)
+        passwordHash = PasswordService.computeHash(self.PASSWORD)
+        users = []
+        for i, pos in enumerate(rng.sample(range(1920*1920), self.userCount)):
+            vlocation = VirtualLocation.createLocationByPos(divmod(pos, 1920))
+            vlocation.save()
+            user = User(username='bench%05d' % i, password_hash=passwordHash,
+                        nickname='bench user %d' % i, vlocation=vlocation)
+            user.save()
+            users.append(user)
+        self.usernames = [user.username for user in users]
+
+        now = datetime.now()
+        Letter.objects.bulk_create([
+            Letter(sender=rng.choice(users), receiver=rng.choice(users), receiver_alias='friend',
+                   recv_time=now + timedelta(seconds=rng.randint(-86400*30, 86400)),
+                   content='bench letter %d ' % i * 20)
+            for i in range(self.letterCount)
+        ])
+
+
+class BenchRunner:
+    def __init__(self, names:Optional[List[str]]=None, scale:float=1.0, **contextArgs):
+        self.names = names
+        self.scale = scale
+        self.contextArgs = contextArgs
+
+    def selected(self) -> List[Benchmark]:
+        benches = Benchmark.REGISTRY.values()
+        if self.names:
+            benches = [b for b in benches if any(n in b.name for n in self.names)]
+        return list(benches)
+
+    def run(self, log:Callable[[str],Any]=print) -> Dict:
+        ctx = BenchContext(**self.contextArgs)
+        ctx.setup()
+        results:Dict[str,Dict] = {}
+        try:
+            for bench in self.selected():
+                try:
+                    results[bench.name] = bench.run(ctx, self.scale)
+                except Exception as e:
+                    # 缺少字体文件等环境问题 只记录不中断
+                    results[bench.name] = {'group': bench.group, 'error': '%s: %s' % (type(e).__name__, e)}
+                log(BenchRunner.formatLine(bench.name, results[bench.name]))
+        finally:
+            ctx.teardown()
+        return {
+            'meta': {
+                'time': datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'machine': platform.machine(),
+                'node': platform.node(),
+                'scale': self.scale,
+            },
+            'results': results,
+        }
+
+    @staticmethod
+    def formatLine(name:str, result:Dict) -> str:
+        if 'error' in result:
+            return '%-40s ERROR %s' % (name, result['error'])
+        return '%-40s median %10.2fus  min %10.2fus  %12.1f ops/s' % (
+            name, result['median']*1e6, result['min']*1e6, result['ops'] or 0)
+
+    @staticmethod
+    def compare(current:Dict, baseline:Dict, threshold:float=REGRESSION_THRESHOLD) -> List[Dict]:
+        '''与基线比较 返回median退化超过阈值的项'''
+        regressions = []
+        for name, result in current['results'].items():
+            base = baseline['results'].get(name)
+            if base is None or 'error' in result or 'error' in base:
+                continue
+            ratio = result['median'] / base['median']
+            if ratio > 1 + threshold:
+                regressions.append({'name': name, 'baseline': base['median'],
+                                    'current': result['median'], 'ratio': ratio})
+        return regressions
+
+    @staticmethod
+    def load(path:str) -> Dict:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def save(result:Dict, path:str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+##############################################
+# micro benchmarks
+
+@benchmark('token.hmac')
+def benchHMAC(ctx:BenchContext):
+    from . import secret_infos
+    from .logic import Tools
+    data = 'MSxTSEEyNTYsdG9wLm1veWluZ21vZS5teWxldHRlci5hY2Nlc3M=:' + 'A'*120
+    return lambda i: Tools.HMAC(data, secret_infos.TOKEN_HMAC_SALT, Tools.getSHA256, 512)
+
+@benchmark('token.mint')
+def benchTokenMint(ctx:BenchContext):
+    from .models import User
+    return lambda i: User.createToken('bench00000', 1600000000, 300, 'top.moyingmoe.myletter.access')
+
+@benchmark('token.verify')
+def benchTokenVerify(ctx:BenchContext):
+    from .logic import Tools
+    from .models import User
+    token = User.createToken('bench00000', int(Tools.getNow()), 3600, 'top.moyingmoe.myletter.access')
+    return lambda i: User.analyzeToken(token, 'top.moyingmoe.myletter.access')
+
+@benchmark('password.hash', number=20, repeat=3)
+def benchPasswordHash(ctx:BenchContext):
+    from .passwords import PasswordService
+    return lambda i: PasswordService.computeHash('password%d' % i)
+
+@benchmark('password.legacy')
+def benchPasswordLegacy(ctx:BenchContext):
+    from .logic import Tools
+    return lambda i: Tools.getPasswordHash('password%d' % i)
+
+@benchmark('captcha.code')
+def benchCaptchaCode(ctx:BenchContext):
+    from .logic import VerifyCode
+    return lambda i: VerifyCode('%032x:1600000000.0' % i).getCode()
+
+@benchmark('captcha.render', number=20, repeat=3)
+def benchCaptchaRender(ctx:BenchContext):
+    from .logic import VerifyCode
+    return lambda i: VerifyCode('%032x:1600000000.0' % i, 3, 7, 0.04).drawImage()
+
+@benchmark('captcha.encode', number=20, repeat=3)
+def benchCaptchaEncode(ctx:BenchContext):
+    from .logic import VerifyCode
+    vc = VerifyCode('0:1600000000.0', 3, 7, 0.04)
+    vc.drawImage()
+    return lambda i: vc.getBase64()
+
+@benchmark('args.verify')
+def benchArgsVerify(ctx:BenchContext):
+    from .logic import RequestArgsVerify
+    from .views import RegisterInterface
+    query = QueryDict('username=bench_user&password=secret123&nickname=nick&randomkey=k&verifycode=c')
+    return lambda i: RequestArgsVerify(query, RegisterInterface.args).verify()
+
+@benchmark('address.encode')
+def benchAddressEncode(ctx:BenchContext):
+    from .models import VirtualLocation
+    return lambda i: VirtualLocation.createLocationByPos((i % 1920, (i*7) % 1920))
+
+@benchmark('address.decode')
+def benchAddressDecode(ctx:BenchContext):
+    from .models import VirtualLocation
+    vlocs = [VirtualLocation.createLocationByPos((i % 1920, (i*7) % 1920)) for i in range(100)]
+    return lambda i: (vlocs[i % 100].getAddressInfo(), vlocs[i % 100].getPostCode(), vlocs[i % 100].getFullAddress())
+
+@benchmark('content.encode')
+def benchContentEncode(ctx:BenchContext):
+    from .compression import ContentCompressor
+    text = '今天天气很好，我们一起去散步吧。' * 40
+    return lambda i: ContentCompressor.getInstance().encode(text)
+
+@benchmark('content.decode')
+def benchContentDecode(ctx:BenchContext):
+    from .compression import ContentCompressor
+    data = ContentCompressor.getInstance().encode('今天天气很好，我们一起去散步吧。' * 40)
+    return lambda i: ContentCompressor.getInstance().decode(data)
+
+@benchmark('spatial.knn_1m', number=2000)
+def benchSpatialKnn(ctx:BenchContext):
+    from .spatial import NearbyIndex
+    index = NearbyIndex()
+    rng = random.Random(ctx.seed)
+    # 百万个不重复的随机坐标
+    index.build((i, p // 1920, p % 1920) for i, p in enumerate(rng.sample(range(1920*1920), 1000000)))
+    queries = [(rng.randrange(1920), rng.randrange(1920)) for _ in range(1024)]
+    return lambda i: index.nearest(queries[i % 1024][0], queries[i % 1024][1], 10)
+
+@benchmark('spatial.radius_1m', number=2000)
+def benchSpatialRadius(ctx:BenchContext):
+    from .spatial import NearbyIndex
+    index = NearbyIndex()
+    rng = random.Random(ctx.seed)
+    index.build((i, p // 1920, p % 1920) for i, p in enumerate(rng.sample(range(1920*1920), 1000000)))
+    queries = [(rng.randrange(1920), rng.randrange(1920)) for _ in range(1024)]
+    return lambda i: index.nearest(queries[i % 1024][0], queries[i % 1024][1], 50, 8)
+
+@benchmark('matching.sample_1m', number=20000)
+def benchMatchingSample(ctx:BenchContext):
+    from array import array
+    from .matching import MatchPool
+    pool = MatchPool()
+    rng = random.Random(ctx.seed)
+    for i, p in enumerate(rng.sample(range(1920*1920), 1000000)):
+        pool.add(i, p // 1920, p % 1920)
+    # 已匹配过200人的用户 在其小区中抽样
+    excluded = array('q', sorted(rng.sample(range(1000000), 200)))
+    return lambda i: pool.sample('3-4-5', -1, excluded)
+
+@benchmark('tiles.render', number=50)
+def benchTileRender(ctx:BenchContext):
+    from .tiles import WorldMap, np
+    worldMap = WorldMap()
+    rng = np.random.default_rng(ctx.seed)
+    # 约四分之一的地址已入住
+    worldMap.occupancy[:] = rng.random(worldMap.occupancy.shape) < 0.25
+    worldMap.heat[:] = rng.integers(0, 1000, worldMap.heat.shape)
+    return lambda i: worldMap.render('heat', 3, i % 8, i // 8 % 8)
+
+@benchmark('allocator.pop', number=200)
+def benchAllocatorPop(ctx:BenchContext):
+    from .logic import GlobalVars
+    from .models import VirtualLocation
+    GlobalVars.getInstance()
+    return lambda i: VirtualLocation.getRandomPosition()
+
+@benchmark('routing.delivery')
+def benchRoutingDelivery(ctx:BenchContext):
+    from .routing import PostalRouter
+    router = PostalRouter.getInstance()
+    return lambda i: router.deliverySeconds((i % 1920, (i*7) % 1920), ((i*13) % 1920, (i*31) % 1920))
+
+@benchmark('routing.batch_1000', number=20)
+def benchRoutingBatch(ctx:BenchContext):
+    from .routing import PostalRouter
+    router = PostalRouter.getInstance()
+    senders = [(i % 1920, (i*7) % 1920) for i in range(1000)]
+    receivers = [((i*13) % 1920, (i*31) % 1920) for i in range(1000)]
+    return lambda i: router.batchDeliverySeconds(senders, receivers)
+
+
+##############################################
+# SQLite连接配置对比 模拟并发登录（写session）与读请求
+# 每次op是一轮完整的并发读写 比较默认配置与settings中的生产配置
+
+def sqliteConcurrentRound(path:str, pragmas:Dict, mode:str, persistent:bool,
+                          readers:int=6, writers:int=2, ops:int=200) -> None:
+    '''readers个线程按用户名查询 writers个线程在事务中读后写session 全部完成后返回'''
+    from myletter.backends.sqlite3.base import applyPragmas
+
+    def connect():
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        applyPragmas(conn, pragmas)
+        return conn
+
+    def reader(seed):
+        rng = random.Random(seed)
+        conn = connect() if persistent else None
+        for _ in range(ops):
+            c = conn or connect()
+            c.execute('SELECT * FROM user WHERE username = ?', ('u%d' % rng.randrange(2000),)).fetchone()
+            if conn is None:
+                c.close()
+
+    def writer(seed):
+        rng = random.Random(seed)
+        conn = connect() if persistent else None
+        for i in range(ops):
+            c = conn or connect()
+            name = 'u%d' % rng.randrange(2000)
+            while True:
+                try:
+                    c.execute('BEGIN %s' % mode)
+                    c.execute('SELECT session FROM user WHERE username = ?', (name,)).fetchone()
+                    c.execute('UPDATE user SET session = ? WHERE username = ?', ('%d:%d' % (seed, i), name))
+                    c.execute('COMMIT')
+                    break
+                except sqlite3.OperationalError:
+                    # DEFERRED事务读锁升级写锁失败时会立刻报database is locked 只能回滚重试
+                    if c.in_transaction:
+                        c.execute('ROLLBACK')
+            if conn is None:
+                c.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(1000+i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def sqliteRoundFactory(pragmas:Dict, mode:str, persistent:bool) -> Callable:
+    def factory(ctx:BenchContext):
+        path = os.path.join(ctx.tmpdir, 'concurrent-%d.sqlite3' % ctx.nextId())
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, username TEXT UNIQUE, session TEXT)')
+        conn.executemany('INSERT INTO user (username, session) VALUES (?, NULL)', (('u%d' % i,) for i in range(2000)))
+        conn.commit()
+        conn.close()
+        return lambda i: sqliteConcurrentRound(path, pragmas, mode, persistent)
+    return factory
+
+benchmark('sqlite.concurrent_round.default', group='sqlite', number=1, repeat=3)(
+    sqliteRoundFactory({}, 'DEFERRED', persistent=False))
+
+def benchSqliteProduction(ctx:BenchContext):
+    from django.conf import settings
+    options = settings.DATABASES['default'].get('OPTIONS', {})
+    return sqliteRoundFactory(options.get('pragmas', {}), options.get('transaction_mode', 'DEFERRED'),
+                              persistent=True)(ctx)
+benchmark('sqlite.concurrent_round.production', group='sqlite', number=1, repeat=3)(benchSqliteProduction)
+
+
+##############################################
+# end-to-end benchmarks 通过Django测试客户端在进程内调用各接口
+
+def captchaPairs(n:int) -> List[Tuple[str,str]]:
+    '''生成n组(randomkey, verifycode) 供需要验证码的接口使用'''
+    from .logic import Tools, VerifyCode
+    pairs = []
+    for _ in range(n):
+        key = Tools.getRandom16bit(32) + ':' + str(Tools.getNow('timestamp'))
+        pairs.append((key, VerifyCode(key).getCode()))
+    return pairs
+
+@benchmark('e2e.verify_code', group='e2e', number=10, repeat=3)
+def benchE2EVerifyCode(ctx:BenchContext):
+    client = Client()
+    return lambda i: client.get('/myletter/api/user/verify_code/')
+
+@benchmark('e2e.verify_code_test', group='e2e', number=100)
+def benchE2EVerifyCodeTest(ctx:BenchContext):
+    client = Client()
+    pairs = captchaPairs(100)
+    return lambda i: client.post('/myletter/api/test/verify_code/',
+                                 {'randomkey': pairs[i][0], 'verifycode': pairs[i][1]})
+
+@benchmark('e2e.login', group='e2e', number=50)
+def benchE2ELogin(ctx:BenchContext):
+    client = Client()
+    pairs = captchaPairs(50)
+    return lambda i: client.post('/myletter/api/user/login/', {
+        'username': ctx.usernames[i % len(ctx.usernames)], 'password': ctx.PASSWORD,
+        'randomkey': pairs[i][0], 'verifycode': pairs[i][1]})
+
+@benchmark('e2e.register', group='e2e', number=50)
+def benchE2ERegister(ctx:BenchContext):
+    from .logic import GlobalVars
+    GlobalVars.getInstance()
+    client = Client()
+    pairs = captchaPairs(50)
+    names = ['reg%08d' % ctx.nextId() for _ in range(50)]
+    return lambda i: client.post('/myletter/api/user/register/', {
+        'username': names[i], 'password': ctx.PASSWORD, 'nickname': 'nick',
+        'randomkey': pairs[i][0], 'verifycode': pairs[i][1]})
+
+@benchmark('e2e.username_available', group='e2e', number=200)
+def benchE2EUsernameAvailable(ctx:BenchContext):
+    client = Client()
+    return lambda i: client.post('/myletter/api/user/username_available/',
+                                 {'username': ctx.usernames[i % len(ctx.usernames)]})
+
+@benchmark('e2e.refresh_token', group='e2e', number=200)
+def benchE2ERefreshToken(ctx:BenchContext):
+    from .logic import Tools
+    from .models import User
+    client = Client()
+    user = User.objects.get(username=ctx.usernames[0])
+    session = user.createSession(int(Tools.getNow()))
+    return lambda i: client.post('/myletter/api/user/refresh_token/',
+                                 {'username': user.username, 'session': session})
+
+@benchmark('e2e.token_test', group='e2e', number=200)
+def benchE2ETokenTest(ctx:BenchContext):
+    from .logic import Tools
+    from .models import User
+    client = Client()
+    token = User.createToken(ctx.usernames[0], int(Tools.getNow()), 3600, 'top.moyingmoe.myletter.access')
+    return lambda i: client.get('/myletter/api/test/token/', {'token': token})
+
+@benchmark('e2e.inbox', group='e2e', number=200)
+def benchE2EInbox(ctx:BenchContext):
+    from .logic import Tools
+    from .models import User
+    client = Client()
+    token = User.createToken(ctx.usernames[0], int(Tools.getNow()), 3600, 'top.moyingmoe.myletter.access')
+    return lambda i: client.get('/myletter/api/letter/inbox/', {'token': token})
+
+@benchmark('e2e.profiles', group='e2e', number=200)
+def benchE2EProfiles(ctx:BenchContext):
+    from .logic import Tools
+    from .models import User
+    client = Client()
+    token = User.createToken(ctx.usernames[0], int(Tools.getNow()), 3600, 'top.moyingmoe.myletter.access')
+    usernames = ','.join(ctx.usernames[:20])
+    return lambda i: client.get('/myletter/api/user/profile/', {'token': token, 'usernames': usernames})
+
+@benchmark('profiles.miss_20', group='e2e', number=200)
+def benchProfilesMiss(ctx:BenchContext):
+    from .profiles import ProfileCache
+    usernames = ctx.usernames[:20]
+    def op(i):
+        ProfileCache.getCache().clear()
+        return ProfileCache.getProfiles(usernames)
+    return op
+
+@benchmark('profiles.hit_20', group='e2e', number=2000)
+def benchProfilesHit(ctx:BenchContext):
+    from .profiles import ProfileCache
+    usernames = ctx.usernames[:20]
+    ProfileCache.getProfiles(usernames)
+    return lambda i: ProfileCache.getProfiles(usernames)
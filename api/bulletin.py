@@ -0,0 +1,90 @@
+from __future__ import annotations
+from typing import *
+
+from datetime import datetime
+
+from django.db.models import Q
+
+from .logic import Tools
+from .models import REGION_LEVELS, Bulletin, BulletinRead, User
+from .routing import BLOCK_SIZE, CITY_SIZE, PostalRouter
+from .sharding import Shards
+
+
+class BulletinBoard:
+    '''
+    地区公告
+
+    一条公告只写一行Bulletin 目标地区为发布人所在的城市、市区或小区之一
+    居民读收件箱时 按自己所在的三个地区键各做一次索引范围扫描 与私人信件按到达时间合并（见Mailbox.inboxPage）
+    已读标记只在居民读公告时写入BulletinRead 发布的写入量与地区人数无关
+
+    收件箱中公告排在同一到达时间的信件之后 同一时间的公告按id升序
+    游标中的公告以负id表示 因此信件和归档的keyset条件不需要区分公告
+    分片时公告、已读标记与发布人和地区内的居民在同一个分片（目标地区所在城市的分片）
+    '''
+    @staticmethod
+    def regionCenter(level:str, x:int, y:int) -> Tuple[int,int]:
+        router = PostalRouter.getInstance()
+        community = PostalRouter.communityIndex(x, y)
+        if level == 'community':
+            center = router.communityCenters[community]
+        else:
+            center = PostalRouter.regionCenter(community, CITY_SIZE if level == 'city' else BLOCK_SIZE)
+        return int(center[0]), int(center[1])
+
+    @staticmethod
+    def post(sender:User, level:str, content:str) -> Bulletin:
+        '''发布到sender所在的level级地区 到达时间为寄到地区中心的时间'''
+        vloc = sender.vlocation
+        region = vloc.getRegionKeys()[REGION_LEVELS.index(level)]
+        sendTime = Tools.getNow('datetime')
+        recvTime = PostalRouter.getInstance().deliveryTime(
+            (vloc.position_x, vloc.position_y),
+            BulletinBoard.regionCenter(level, vloc.position_x, vloc.position_y), sendTime)
+        return Bulletin.objects.using(Shards.forRegion(region)).create(sender=sender, region=region, recv_time=recvTime, content=content)
+
+    @staticmethod
+    def regionLevel(region:str) -> str:
+        return REGION_LEVELS[region.count('-')]
+
+    @staticmethod
+    def page(user:User, cursor:Optional[Tuple[datetime,int]], limit:int) -> List[Bulletin]:
+        '''user所在地区已到达的公告中 排在cursor之后的前limit条 附带has_read'''
+        if user.vlocation_id is None:
+            return []
+        now = Tools.getNow('datetime')
+        bulletins = []
+        for region in user.vlocation.getRegionKeys():
+            queryset = Bulletin.objects.using(Shards.forRegion(region)).filter(region=region, recv_time__lte=now) \
+                                       .select_related('sender').only('id', 'region', 'send_time', 'recv_time',
+                                                                      'sender__username', 'sender__nickname')
+            if cursor is not None:
+                ctime, cid = cursor
+                queryset = queryset.filter(recv_time__lte=ctime)
+                if cid < 0:
+                    queryset = queryset.filter(Q(recv_time__lt=ctime) | Q(id__gt=-cid))
+            bulletins.extend(queryset.order_by('-recv_time', 'id')[:limit])
+        bulletins.sort(key=lambda bulletin: (bulletin.recv_time, -bulletin.id), reverse=True)
+        bulletins = bulletins[:limit]
+
+        read = set(BulletinRead.objects.using(Shards.forId(user.id)).filter(user=user, bulletin_id__in=[b.id for b in bulletins])
+                                       .values_list('bulletin_id', flat=True))
+        for bulletin in bulletins:
+            bulletin.has_read = bulletin.id in read
+        return bulletins
+
+    @staticmethod
+    def read(user:User, bulletinId:int) -> Optional[Bulletin]:
+        '''读取user所在地区已到达的公告 并记为已读'''
+        if user.vlocation_id is None:
+            return None
+        try:
+            bulletin = Bulletin.objects.using(Shards.forId(user.id)).select_related('sender').get(
+                id=bulletinId, region__in=user.vlocation.getRegionKeys(), recv_time__lte=Tools.getNow('datetime'))
+        except Bulletin.DoesNotExist:
+            return None
+        # 已经读过时忽略
+        BulletinRead.objects.using(bulletin._state.db).bulk_create([BulletinRead(user=user, bulletin=bulletin)], ignore_conflicts=True)
+        bulletin.has_read = True
+        return bulletin
@@ -0,0 +1,243 @@
+from __future__ import annotations
+from typing import *
+
+import lzma
+import struct
+import threading
+import zlib
+from collections import Counter
+
+from django.conf import settings
+from django.db import models
+
+
+# 默认配置 可在settings.LETTER_COMPRESSION中覆盖
+DEFAULT_COMPRESSION_CONFIG:Dict[str,Any] = {
+    'CODEC': 'zlib',        # 新写入内容使用的编码 见ContentCompressor.CODECS
+    'LEVEL': 6,
+    'THRESHOLD': 128,       # 字节 短于此长度的内容不压缩
+    'DICTIONARY': True,     # codec为zlib且已训练过共享字典时 使用最新的字典
+}
+
+DICTIONARY_SIZE = 32 * 1024 # zlib的窗口大小 更长的字典没有意义
+
+
+class ContentCodec:
+    '''
+    正文编码 存储格式为 1字节codec id + codec自己的payload
+    id一经使用不能再改 否则已存储的内容无法解码
+    '''
+    codecId:int = -1
+    name:str = ''
+
+    def encode(self, data:bytes, level:int) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, payload:bytes) -> bytes:
+        raise NotImplementedError
+
+
+class RawCodec(ContentCodec):
+    codecId = 0
+    name = 'raw'
+
+    def encode(self, data, level):
+        return data
+
+    def decode(self, payload):
+        return payload
+
+
+class ZlibCodec(ContentCodec):
+    codecId = 1
+    name = 'zlib'
+
+    def encode(self, data, level):
+        return zlib.compress(data, level)
+
+    def decode(self, payload):
+        return zlib.decompress(payload)
+
+
+class ZlibDictCodec(ContentCodec):
+    '''带共享字典的zlib payload为 4字节字典id + 压缩数据'''
+    codecId = 2
+    name = 'zlib-dict'
+
+    def encode(self, data, level):
+        dictId, zdict = ContentCompressor.getInstance().activeDictionary()
+        compressor = zlib.compressobj(level, zdict=zdict)
+        return struct.pack('>I', dictId) + compressor.compress(data) + compressor.flush()
+
+    def decode(self, payload):
+        dictId, = struct.unpack_from('>I', payload)
+        decompressor = zlib.decompressobj(zdict=ContentCompressor.getInstance().dictionary(dictId))
+        return decompressor.decompress(payload[4:]) + decompressor.flush()
+
+
+class LzmaCodec(ContentCodec):
+    codecId = 3
+    name = 'lzma'
+
+    def encode(self, data, level):
+        return lzma.compress(data, lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2, 'preset': min(level, 9)}])
+
+    def decode(self, payload):
+        return lzma.decompress(payload, lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2}])
+
+
+class ContentCompressor:
+    '''
+    信件正文的压缩/解压
+
+    写入时按配置的codec压缩 短内容或压缩后反而更长的内容以raw存储
+    读取时按首字节选择codec 与当前配置无关 因此修改配置或训练新字典后旧数据仍可读
+    共享字典保存在CompressionDictionary表中 永不删除 编码时使用id最大的一个
+    其他进程在重启或调用reloadDictionary之后才会使用新字典
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> ContentCompressor:
+        if ContentCompressor.INSTANCE is None:
+            with ContentCompressor.LOCK:
+                if ContentCompressor.INSTANCE is None:
+                    ContentCompressor.INSTANCE = ContentCompressor()
+        return ContentCompressor.INSTANCE
+
+    CODECS:Dict[int,ContentCodec] = {}
+
+    @staticmethod
+    def registerCodec(codec:ContentCodec) -> None:
+        ContentCompressor.CODECS[codec.codecId] = codec
+
+    ##############################################
+
+    def __init__(self):
+        self.config = dict(DEFAULT_COMPRESSION_CONFIG)
+        self.config.update(getattr(settings, 'LETTER_COMPRESSION', {}))
+        self.dictionaries:Dict[int,bytes] = {}
+        self.active:Optional[Tuple[int,bytes]] = None
+        self.activeLoaded = False
+
+    def codecByName(self, name:str) -> ContentCodec:
+        for codec in ContentCompressor.CODECS.values():
+            if codec.name == name:
+                return codec
+        raise ValueError('unknown letter codec: %s' % name)
+
+    def dictionary(self, dictId:int) -> bytes:
+        zdict = self.dictionaries.get(dictId)
+        if zdict is None:
+            from .models import CompressionDictionary
+            zdict = bytes(CompressionDictionary.objects.get(id=dictId).data)
+            self.dictionaries[dictId] = zdict
+        return zdict
+
+    def activeDictionary(self) -> Optional[Tuple[int,bytes]]:
+        '''最新的共享字典 (id, 内容) 未训练过时为None'''
+        if not self.activeLoaded:
+            from .models import CompressionDictionary
+            latest = CompressionDictionary.objects.order_by('-id').only('id').first()
+            self.active = (latest.id, self.dictionary(latest.id)) if latest is not None else None
+            self.activeLoaded = True
+        return self.active
+
+    def reloadDictionary(self) -> None:
+        self.activeLoaded = False
+
+    def writeCodec(self) -> ContentCodec:
+        codec = self.codecByName(self.config['CODEC'])
+        if codec.codecId in (ZlibCodec.codecId, ZlibDictCodec.codecId):
+            # 没有训练过字典时zlib-dict退化为zlib
+            useDict = self.config['DICTIONARY'] or codec.codecId == ZlibDictCodec.codecId
+            hasDict = useDict and self.activeDictionary() is not None
+            codec = ContentCompressor.CODECS[ZlibDictCodec.codecId if hasDict else ZlibCodec.codecId]
+        return codec
+
+    def encode(self, text:str) -> bytes:
+        data = text.encode('utf-8')
+        if len(data) >= self.config['THRESHOLD']:
+            codec = self.writeCodec()
+            payload = codec.encode(data, self.config['LEVEL'])
+            if len(payload) < len(data):
+                return bytes((codec.codecId,)) + payload
+        return b'\x00' + data
+
+    def decode(self, value:Union[str,bytes,memoryview]) -> str:
+        '''兼容压缩之前以TEXT存储的内容'''
+        if isinstance(value, str):
+            return value
+        value = bytes(value)
+        return ContentCompressor.CODECS[value[0]].decode(value[1:]).decode('utf-8')
+
+
+for _codec in (RawCodec(), ZlibCodec(), ZlibDictCodec(), LzmaCodec()):
+    ContentCompressor.registerCodec(_codec)
+
+
+def trainDictionary(samples:Iterable[str], size:int=DICTIONARY_SIZE, gram:int=4) -> bytes:
+    '''
+    从样本中训练zlib共享字典
+    统计在多个样本中重复出现的定长片段 按 出现次数*字节长度 取最常见的片段拼接
+    zlib对距离近的匹配编码更短 所以最常见的片段放在字典末尾
+    '''
+    counts = Counter()
+    for text in samples:
+        counts.update(set(text[i:i+gram] for i in range(0, max(1, len(text) - gram + 1))))
+
+    chosen = []
+    total = 0
+    for piece, count in sorted(counts.items(), key=lambda item: item[1]*len(item[0].encode('utf-8')), reverse=True):
+        if count < 2:
+            break
+        data = piece.encode('utf-8')
+        if total + len(data) > size:
+            break
+        chosen.append(data)
+        total += len(data)
+    return b''.join(reversed(chosen))
+
+
+class CompressedTextField(models.Field):
+    '''
+    以压缩的二进制形式存储的文本字段 读写时透明地压缩/解压
+    查询条件的值同样会被压缩 icontains、startswith等按子串比较的lookup在压缩后的字节上没有意义 直接报FieldError
+    只支持exact和isnull exact比较的是按当前配置编码的结果 用其他编码写入的旧值匹配不到
+    '''
+    description = '压缩存储的文本'
+    SUPPORTED_LOOKUPS = frozenset(('exact', 'isnull'))
+
+    def get_lookup(self, lookup_name):
+        if lookup_name not in CompressedTextField.SUPPORTED_LOOKUPS:
+            return None
+        return super().get_lookup(lookup_name)
+
+    def get_transform(self, lookup_name):
+        return None
+
+    def get_internal_type(self):
+        return 'BinaryField'
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        return ContentCompressor.getInstance().encode(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        if value is None:
+            return None
+        return connection.Database.Binary(value)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        return ContentCompressor.getInstance().decode(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return ContentCompressor.getInstance().decode(value)
@@ -0,0 +1,140 @@
+from __future__ import annotations
+from typing import *
+
+import bisect
+import logging
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core import cache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .logic import Tools
+from .models import Letter
+from .sharding import Shards
+
+
+UNREAD_COUNTER_EXP = 3600 # 未读计数缓存的有效期 过期后从数据库重新统计
+PENDING_LOCK_TIMEOUT = 5 # 秒 修改pending时持有的锁的最长时间（持有的进程中途退出时）
+PENDING_LOCK_RETRIES = 50 # 取锁的重试次数 每次等待PENDING_LOCK_WAIT秒 仍取不到时放弃缓存项 下次读取时重新统计
+PENDING_LOCK_WAIT = 0.002
+
+
+logger = logging.getLogger(__name__)
+
+
+class UnreadCounter:
+    '''
+    按用户名维护的未读信件计数 缓存在CACHES['counter']中 所有进程必须共享同一个缓存（见settings）
+
+    每个用户两个缓存项:
+        unread:<用户名>           所有未读信件数（包括尚未到达的） 寄信时incr 已读时decr 都是原子操作
+        unread_pending:<用户名>   尚未到达的信件的到达时间戳（升序）
+    未读数 = 所有未读信件数 - pending中仍未到达的数 读取时计算 因此信件到达时不需要修改缓存
+    pending只在寄出延迟到达的信件时修改 用cache.add实现的锁保证不丢失修改
+
+    缓存缺失时查数据库重新统计（reconcile） 重新统计与寄信同时发生时可能少计 缓存过期（UNREAD_COUNTER_EXP）后自然纠正
+    '''
+    @staticmethod
+    def getCache():
+        return cache.caches['counter']
+
+    @staticmethod
+    def isProcessLocal() -> bool:
+        '''计数缓存是否只在本进程内 多进程部署时各进程的计数互不相同'''
+        return isinstance(UnreadCounter.getCache(), LocMemCache)
+
+    @staticmethod
+    def checkBackend() -> None:
+        '''启动时调用 非DEBUG下计数缓存只在进程内时警告'''
+        if not settings.DEBUG and UnreadCounter.isProcessLocal():
+            logger.warning("CACHES['counter'] is a per-process LocMemCache, unread counts will differ between "
+                           "worker processes; set MYLETTER_MEMCACHED to share them")
+
+    @staticmethod
+    def cacheKey(username:str) -> str:
+        return 'unread:' + username
+
+    @staticmethod
+    def pendingKey(username:str) -> str:
+        return 'unread_pending:' + username
+
+    @staticmethod
+    def reconcile(username:str) -> Tuple[int, List[float]]:
+        '''从数据库重新统计并写入缓存 返回(所有未读信件数, pending)'''
+        now = Tools.getNow('datetime')
+        db = Shards.forUsername(username)
+        if db is None:
+            return 0, []
+        unread = Letter.objects.using(db).filter(receiver__username=username, has_read=False)
+        total = unread.count()
+        pending = sorted(t.timestamp() for t in unread.filter(recv_time__gt=now).values_list('recv_time', flat=True))
+        counterCache = UnreadCounter.getCache()
+        counterCache.set(UnreadCounter.pendingKey(username), pending, UNREAD_COUNTER_EXP)
+        # 其他进程可能已经重新统计并开始incr/decr 不覆盖
+        counterCache.add(UnreadCounter.cacheKey(username), total, UNREAD_COUNTER_EXP)
+        return total, pending
+
+    @staticmethod
+    def get(username:str) -> int:
+        keys = [UnreadCounter.cacheKey(username), UnreadCounter.pendingKey(username)]
+        found = UnreadCounter.getCache().get_many(keys)
+        if len(found) < len(keys):
+            total, pending = UnreadCounter.reconcile(username)
+        else:
+            total, pending = found[keys[0]], found[keys[1]]
+        notArrived = len(pending) - bisect.bisect_right(pending, Tools.getNow())
+        return max(0, total - notArrived)
+
+    @staticmethod
+    def onSend(username:str, recvTime:datetime) -> None:
+        '''寄给username的新信件已写入数据库 未缓存时什么都不做 下次读取时会重新统计'''
+        counterCache = UnreadCounter.getCache()
+        recvStamp = recvTime.timestamp()
+        now = Tools.getNow()
+        if recvStamp > now and not UnreadCounter.addPending(username, recvStamp, now):
+            # 不能在到达前计入未读 放弃缓存项
+            counterCache.delete_many([UnreadCounter.cacheKey(username), UnreadCounter.pendingKey(username)])
+            return
+        try:
+            counterCache.incr(UnreadCounter.cacheKey(username))
+        except ValueError:
+            pass
+
+    @staticmethod
+    def addPending(username:str, recvStamp:float, now:float) -> bool:
+        '''把到达时间加入pending 同时去掉已到达的 取不到锁时返回False'''
+        counterCache = UnreadCounter.getCache()
+        lockKey = 'lock:' + UnreadCounter.pendingKey(username)
+        for _ in range(PENDING_LOCK_RETRIES):
+            if counterCache.add(lockKey, 1, PENDING_LOCK_TIMEOUT):
+                break
+            time.sleep(PENDING_LOCK_WAIT)
+        else:
+            return False
+        try:
+            key = UnreadCounter.pendingKey(username)
+            pending = counterCache.get(key)
+            if pending is None:
+                # 未缓存 下次读取时重新统计
+                return True
+            del pending[:bisect.bisect_right(pending, now)]
+            bisect.insort(pending, recvStamp)
+            counterCache.set(key, pending, UNREAD_COUNTER_EXP)
+            return True
+        finally:
+            counterCache.delete(lockKey)
+
+    @staticmethod
+    def invalidateAll() -> None:
+        '''到达时间被批量重算后 投递调度器的reload listener 清空缓存 全部重新统计'''
+        UnreadCounter.getCache().clear()
+
+    @staticmethod
+    def onRead(username:str) -> None:
+        '''username的一封已到达的信件由未读变为已读'''
+        try:
+            UnreadCounter.getCache().decr(UnreadCounter.cacheKey(username))
+        except ValueError:
+            pass
@@ -0,0 +1,217 @@
+from __future__ import annotations
+from typing import *
+
+import atexit
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Max
+
+from .models import DeliveryWatermark, Letter
+from .sharding import Shards
+
+
+logger = logging.getLogger(__name__)
+
+# 默认配置 可在settings.DELIVERY_SCHEDULER中覆盖
+DEFAULT_SCHEDULER_CONFIG:Dict[str,Any] = {
+    'ENABLED': True,
+    'POLL_INTERVAL': 5,         # 秒 拉取新寄出信件的间隔 远小于最短投递时间即可
+    'LOAD_CHUNK': 20000,        # 启动时分批读取的行数
+}
+
+RELOAD_CHUNK = 500              # 重新加载时按id查询的每批数量
+
+
+class DeliveryEvent(NamedTuple):
+    letter_id: int
+    sender_id: Optional[int]
+    receiver_id: Optional[int]
+    receiver_username: Optional[str]
+    recv_time: datetime
+
+
+class DeliveryScheduler:
+    '''
+    信件投递调度器
+
+    内存中按recv_time维护一个小顶堆 信件到达时向所有listener发出DeliveryEvent
+    堆的持久化就是Letter表本身（recv_time索引）加上DeliveryWatermark中记录的已投递时间点:
+      启动时 一次索引范围扫描读出 recv_time > watermark 的信件 已过期的立即补发（停机期间的到达） 其余入堆
+      运行中 每隔POLL_INTERVAL按主键拉取新寄出的信件入堆 因此其他进程寄出的信件也能在本进程投递
+    投递工作量只与到达的信件数有关 与收件箱的读取次数无关
+
+    分片时对每个分片分别扫描和拉取 watermark只有一个 在default中
+    每个进程各自运行一个调度器 各进程的listener（如本进程持有的推送连接）都能收到事件
+    listener应当是幂等的
+
+    recompute_delivery批量修改到达时间后增加DeliveryWatermark.generation 各进程拉取时发现变化即重新加载堆
+    并通知reload listener（如清空未读计数中缓存的到达时间） 已投递的信件可能再次发出
+    '''
+    INSTANCE = None
+    @staticmethod
+    def getInstance() -> DeliveryScheduler:
+        if DeliveryScheduler.INSTANCE is None:
+            DeliveryScheduler.INSTANCE = DeliveryScheduler()
+        return DeliveryScheduler.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.config = dict(DEFAULT_SCHEDULER_CONFIG)
+        self.config.update(getattr(settings, 'DELIVERY_SCHEDULER', {}))
+        self.heap:List[Tuple[float,int,DeliveryEvent]] = []
+        self.listeners:List[Callable[[List[DeliveryEvent]],Any]] = []
+        self.reloadListeners:List[Callable[[],Any]] = []
+        self.cond = threading.Condition()
+        self.thread:Optional[threading.Thread] = None
+        self.stopped = False
+        self.lastIds:Dict[str,int] = {}     # 每个数据库中已拉取的最大信件id
+        self.watermark:Optional[datetime] = None
+        self.generation:Optional[int] = None
+        self.deliveredUntil:Optional[datetime] = None
+
+    def addListener(self, listener:Callable[[List[DeliveryEvent]],Any]) -> None:
+        '''listener以一批同时到达的事件为参数 在调度线程中调用 不应阻塞'''
+        self.listeners.append(listener)
+
+    def addReloadListener(self, listener:Callable[[],Any]) -> None:
+        '''到达时间被批量重算、堆重新加载后在调度线程中调用'''
+        self.reloadListeners.append(listener)
+
+    def start(self) -> None:
+        if self.thread is not None or not self.config['ENABLED']:
+            return
+        self.thread = threading.Thread(target=self.run, name='delivery-scheduler', daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+
+    ##############################################
+
+    EVENT_FIELDS = ('id', 'sender_id', 'receiver_id', 'receiver__username', 'recv_time')
+
+    @staticmethod
+    def loadMark() -> DeliveryWatermark:
+        mark, _ = DeliveryWatermark.objects.get_or_create(id=1, defaults={'delivered_until': datetime.now()})
+        return mark
+
+    @staticmethod
+    def bumpGeneration() -> None:
+        '''到达时间已被批量修改 通知所有进程的调度器重新加载'''
+        DeliveryScheduler.loadMark()
+        DeliveryWatermark.objects.filter(id=1).update(generation=F('generation') + 1)
+
+    def saveWatermark(self) -> None:
+        '''持久化已投递的时间点 多个进程同时写时只会前移'''
+        until = self.deliveredUntil
+        if until is None or until == self.watermark:
+            return
+        DeliveryWatermark.objects.filter(id=1, delivered_until__lt=until).update(delivered_until=until)
+        self.watermark = until
+
+    def push(self, rows:Iterable[Tuple]) -> None:
+        for row in rows:
+            event = DeliveryEvent(*row)
+            heapq.heappush(self.heap, (event.recv_time.timestamp(), event.letter_id, event))
+
+    def recover(self) -> None:
+        '''启动时的一次范围扫描 补发停机期间到达的信件 并把途中的信件入堆'''
+        mark = DeliveryScheduler.loadMark()
+        self.watermark = mark.delivered_until
+        self.generation = mark.generation
+        self.heap = []
+        for db in Shards.databases():
+            self.lastIds[db] = Letter.objects.using(db).aggregate(m=Max('id'))['m'] or 0
+            queryset = Letter.objects.using(db).filter(recv_time__gt=self.watermark, id__lte=self.lastIds[db]) \
+                                     .order_by('recv_time', 'id').values_list(*self.EVENT_FIELDS)
+            for row in queryset.iterator(chunk_size=self.config['LOAD_CHUNK']):
+                self.push((row,))
+        logger.info('delivery scheduler loaded %d letters after %s', len(self.heap), self.watermark)
+
+    def reload(self) -> None:
+        '''重新加载堆 途中的信件可能被重算到watermark之前 recover扫描不到 按id找回后立即补发'''
+        inFlight = {event.letter_id for _, _, event in self.heap}
+        self.recover()
+        inFlight.difference_update(event.letter_id for _, _, event in self.heap)
+        ids = sorted(inFlight)
+        for db in Shards.databases():
+            for i in range(0, len(ids), RELOAD_CHUNK):
+                self.push(Letter.objects.using(db).filter(id__in=ids[i:i+RELOAD_CHUNK], recv_time__lte=self.watermark)
+                                        .values_list(*self.EVENT_FIELDS))
+
+    def poll(self) -> None:
+        '''拉取上次之后新寄出的信件 主键索引上的范围扫描 到达时间被重算过时重新加载'''
+        generation = DeliveryWatermark.objects.filter(id=1).values_list('generation', flat=True).first()
+        if self.generation is not None and generation is not None and generation != self.generation:
+            logger.info('delivery times were recomputed, reloading the delivery scheduler')
+            self.reload()
+            for listener in self.reloadListeners:
+                try:
+                    listener()
+                except Exception:
+                    logger.exception('delivery reload listener %r failed', listener)
+            return
+        for db in Shards.databases():
+            rows = list(Letter.objects.using(db).filter(id__gt=self.lastIds.get(db, 0)).order_by('id')
+                                      .values_list(*self.EVENT_FIELDS))
+            if rows:
+                self.lastIds[db] = rows[-1][0]
+                self.push(rows)
+
+    def popDue(self, now:float) -> List[DeliveryEvent]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def fire(self, events:List[DeliveryEvent]) -> None:
+        for listener in self.listeners:
+            try:
+                listener(events)
+            except Exception:
+                logger.exception('delivery listener %r failed', listener)
+
+    def run(self) -> None:
+        nextPoll = 0.0
+        try:
+            self.recover()
+        except Exception:
+            logger.exception('delivery scheduler failed to recover')
+        while True:
+            with self.cond:
+                if self.stopped:
+                    break
+            now = time.time()
+            try:
+                if now >= nextPoll:
+                    # 拉取新信件时顺带持久化watermark 避免每次投递都写库
+                    close_old_connections()
+                    self.poll()
+                    self.saveWatermark()
+                    nextPoll = now + self.config['POLL_INTERVAL']
+                due = self.popDue(now)
+                if due:
+                    self.fire(due)
+                    self.deliveredUntil = due[-1].recv_time
+            except Exception:
+                logger.exception('delivery scheduler iteration failed')
+            with self.cond:
+                wakeAt = min(nextPoll, self.heap[0][0]) if self.heap else nextPoll
+                if not self.stopped:
+                    self.cond.wait(max(0.0, wakeAt - time.time()))
+        try:
+            self.saveWatermark()
+        except Exception:
+            logger.exception('delivery scheduler failed to save watermark')
@@ -0,0 +1,166 @@
+from __future__ import annotations
+from typing import *
+
+import atexit
+import logging
+import math
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+
+from .models import User
+from .profiles import ProfileCache
+from .sharding import Shards
+
+
+logger = logging.getLogger(__name__)
+
+# 默认配置 可在settings.USER_EXP中覆盖
+DEFAULT_EXP_CONFIG:Dict[str,Any] = {
+    'FLUSH_INTERVAL': 10,       # 秒 缓冲的经验值写入数据库的间隔
+    'SEND': 5,                  # 寄出一封信
+    'RECEIVE': 2,               # 收到一封信（寄出时即计入收信人）
+    'LOGIN': 1,                 # 登录一次
+}
+
+EXP_PER_LEVEL = 50              # 升到第n+1级需要 EXP_PER_LEVEL*n*n 经验
+FLUSH_CHUNK = 500               # 一条UPDATE中的用户数上限
+
+
+def expLevel(exp:int) -> int:
+    return math.isqrt(max(exp, 0) // EXP_PER_LEVEL) + 1
+
+
+class ExpLedger:
+    '''
+    经验值的写回缓冲
+
+    各种活动只在内存中累加 {用户id: 增量} 后台线程每FLUSH_INTERVAL秒把缓冲整体取出
+    按增量分组 每组一条 UPDATE user SET exp = exp + n WHERE id IN (...) 全部在一个事务中（分片时每个分片一个事务）
+    用F表达式在数据库中累加 多个进程各自缓冲、各自写入也不会丢失
+    写入失败时增量放回缓冲 下次重试 进程正常退出时（atexit）写入最后一次
+    第一次有经验值要缓冲时才启动线程、注册atexit stop()写入后注销 之后再有经验值时重新启动
+    临时的数据库（测试、benchmark）销毁前应先调用stop() 否则退出时写入不存在的数据库
+
+    排行榜直接读数据库 最多落后FLUSH_INTERVAL秒 分片时每个分片各取前limit名再归并
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> ExpLedger:
+        if ExpLedger.INSTANCE is None:
+            with ExpLedger.LOCK:
+                if ExpLedger.INSTANCE is None:
+                    ExpLedger.INSTANCE = ExpLedger()
+        return ExpLedger.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.config = dict(DEFAULT_EXP_CONFIG)
+        self.config.update(getattr(settings, 'USER_EXP', {}))
+        self.pending:Dict[int,int] = {}
+        self.usernames:Dict[int,str] = {}   # 写入后删除资料缓存用
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread:Optional[threading.Thread] = None
+
+    def add(self, userId:int, username:str, amount:int) -> None:
+        if amount == 0:
+            return
+        with self.lock:
+            self.pending[userId] = self.pending.get(userId, 0) + amount
+            self.usernames[userId] = username
+        if self.thread is None:
+            self.start()
+
+    def award(self, user:Optional[User], event:str) -> None:
+        '''按配置中event（SEND / RECEIVE / LOGIN）的经验值记给user'''
+        if user is not None:
+            self.add(user.id, user.username, self.config[event])
+
+    def pendingExp(self, userId:int) -> int:
+        '''本进程中尚未写入数据库的经验值'''
+        with self.lock:
+            return self.pending.get(userId, 0)
+
+    ##############################################
+
+    def start(self) -> None:
+        with ExpLedger.LOCK:
+            if self.thread is not None:
+                return
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stopped,), name='exp-ledger', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        '''停止后台线程并写入缓冲'''
+        with ExpLedger.LOCK:
+            thread, self.thread = self.thread, None
+            self.stopped.set()
+            atexit.unregister(self.stop)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        self.flush()
+
+    def run(self, stopped:threading.Event) -> None:
+        while not stopped.wait(self.config['FLUSH_INTERVAL']):
+            close_old_connections()
+            self.flush()
+
+    def flush(self) -> int:
+        '''把缓冲写入数据库 返回写入的用户数'''
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, {}
+            usernames, self.usernames = self.usernames, {}
+
+        shards:Dict[str,Dict[int,List[int]]] = {}
+        for userId, amount in pending.items():
+            shards.setdefault(Shards.forId(userId), {}).setdefault(amount, []).append(userId)
+        flushed = []
+        for db, groups in shards.items():
+            userIds = [userId for ids in groups.values() for userId in ids]
+            try:
+                with transaction.atomic(using=db):
+                    for amount, ids in groups.items():
+                        for start in range(0, len(ids), FLUSH_CHUNK):
+                            User.objects.using(db).filter(id__in=ids[start:start+FLUSH_CHUNK]) \
+                                        .update(exp=F('exp') + amount)
+            except Exception:
+                logger.exception('failed to flush exp for %d users', len(userIds))
+                with self.lock:
+                    for userId in userIds:
+                        self.pending[userId] = self.pending.get(userId, 0) + pending[userId]
+                        self.usernames.setdefault(userId, usernames[userId])
+                continue
+            flushed.extend(userIds)
+        # update不触发post_save
+        ProfileCache.invalidate(usernames[userId] for userId in flushed)
+        return len(flushed)
+
+    ##############################################
+
+    @staticmethod
+    def leaderboard(limit:int) -> List[Dict]:
+        '''经验值最高的limit人 exp索引上的倒序扫描 同分时后注册的排在前面'''
+        rows = []
+        for db in Shards.databases():
+            rows.extend(User.objects.using(db).order_by('-exp', '-id').values_list('exp', 'id', 'username', 'nickname')[:limit])
+        rows.sort(reverse=True)
+        board = []
+        for i, (exp, _, username, nickname) in enumerate(rows[:limit]):
+            # 同分同名次 与rank一致
+            rank = board[-1]['rank'] if board and board[-1]['exp'] == exp else i + 1
+            board.append({'rank': rank, 'username': username, 'nickname': nickname, 'exp': exp, 'level': expLevel(exp)})
+        return board
+
+    @staticmethod
+    def rank(exp:int) -> int:
+        '''经验值为exp时的名次 exp索引上的范围计数'''
+        return sum(User.objects.using(db).filter(exp__gt=exp).count() for db in Shards.databases()) + 1
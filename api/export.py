@@ -0,0 +1,178 @@
+from __future__ import annotations
+from typing import *
+
+import heapq
+import json
+import zipfile
+from datetime import datetime
+
+from django.db.models import Q
+
+from .archive import ARCHIVE_BOXES, RECORD_ID, LetterArchive, loadSegment, parseTime
+from .logic import Tools
+from .models import Letter, User
+from .sharding import Shards
+
+
+EXPORT_CHUNK = 500              # 每次从数据库取出的行数
+EXPORT_FLUSH = 64 * 1024        # 输出缓冲达到此字节数时交给响应
+EXPORT_FORMATS = {
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'zip': 'application/zip',
+}
+
+
+class ZipStream:
+    '''只能追加写的文件对象 没有tell/seek 因此zipfile按流式格式（data descriptor）写入'''
+    def __init__(self):
+        self.chunks:List[bytes] = []
+        self.size = 0
+
+    def write(self, data:bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+class MailboxExport:
+    '''
+    导出一个用户的全部信件 包括收到的（已到达）和寄出的 以及已归档的
+
+    数据库中的信件用iterator分批读取 归档中的信件按索引中的id逐段读取 两者按id归并
+    输出按id升序 after为上次导出的最后一封信的id 从其后继续 因此导出可以断点续传
+    内存占用只与批大小有关 与信件总数无关
+    分片时寄出的信在各收信人的分片中 每个分片各读一路 同样按id归并
+    '''
+    def __init__(self, user:User, after:int=0):
+        self.user = user
+        self.after = after
+        self.now = Tools.getNow('datetime')
+        self.usernames:Dict[int,str] = {}
+
+    def hotLetters(self) -> Iterator[Dict]:
+        queryset = Letter.objects.filter(Q(sender=self.user) | Q(receiver=self.user, recv_time__lte=self.now),
+                                         id__gt=self.after).order_by('id') \
+                                 .values_list('id', 'sender_id', 'receiver_id', 'sender__username', 'receiver__username',
+                                              'receiver_alias', 'has_read', 'send_time', 'recv_time', 'content')
+        rows = heapq.merge(*(queryset.using(db).iterator(chunk_size=EXPORT_CHUNK) for db in Shards.databases()))
+        for row in rows:
+            if row[1] is not None and row[3] is None:
+                # 寄信人在另一个分片中 JOIN不到
+                self.resolveUsernames((row[1],))
+                row = row[:3] + (self.usernames.get(row[1]),) + row[4:]
+            yield self.letterDict(*row)
+
+    def archivedLetters(self) -> Iterator[Dict]:
+        '''
+        收件箱和发件箱的各个归档段按id归并 自己寄给自己的信在两边各有一份 由letters去重
+        段按时间分割 id范围可能重叠 按段中最小的id排序 归并到该id时才读入该段
+        同时在内存中的只有id范围与当前位置重叠的段
+        '''
+        segments = []
+        for box in ARCHIVE_BOXES:
+            archive = LetterArchive(self.user.id, box)
+            for seg in archive.index['segments']:
+                ids = [letterId for letterId in seg['ids'] if letterId > self.after]
+                if ids:
+                    segments.append((min(ids), str(archive.dir / seg['file'])))
+        segments.sort()
+        heap = []   # (id, 段的序号, 记录, 该段其余记录)
+        opened = 0
+        while heap or opened < len(segments):
+            while opened < len(segments) and (not heap or segments[opened][0] <= heap[0][0]):
+                records = iter(sorted((r for r in loadSegment(segments[opened][1]) if r[RECORD_ID] > self.after),
+                                      key=lambda r: r[RECORD_ID]))
+                record = next(records, None)
+                if record is not None:
+                    heapq.heappush(heap, (record[RECORD_ID], opened, record, records))
+                opened += 1
+            if not heap:
+                continue
+            _, n, record, records = heapq.heappop(heap)
+            following = next(records, None)
+            if following is not None:
+                heapq.heappush(heap, (following[RECORD_ID], n, following, records))
+            self.resolveUsernames((record[1], record[2]))
+            yield self.letterDict(record[0], record[1], record[2], self.usernames.get(record[1]),
+                                  self.usernames.get(record[2]), record[3], record[4],
+                                  parseTime(record[5]), parseTime(record[6]), record[7])
+
+    def resolveUsernames(self, userIds:Iterable[Optional[int]]) -> None:
+        missing = [uid for uid in userIds if uid is not None and uid not in self.usernames]
+        if missing:
+            self.usernames.update((userId, user.username)
+                                  for userId, user in Shards.usersByIds(missing, 'id', 'username').items())
+
+    def letterDict(self, letterId, senderId, receiverId, senderName, receiverName, receiverAlias, hasRead,
+                   sendTime:datetime, recvTime:datetime, content) -> Dict:
+        return {
+            'id': letterId,
+            'box': 'inbox' if receiverId == self.user.id else 'outbox',
+            'sender': senderName,
+            'receiver': receiverName,
+            'receiver_alias': receiverAlias,
+            'has_read': hasRead,
+            'send_time': sendTime.timestamp(),
+            'recv_time': recvTime.timestamp(),
+            'content': content,
+        }
+
+    def letters(self) -> Iterator[Dict]:
+        '''归档后尚未从数据库删除的信件会在两边各出现一次 只保留一份'''
+        lastId = None
+        for letter in heapq.merge(self.hotLetters(), self.archivedLetters(), key=lambda letter: letter['id']):
+            if letter['id'] != lastId:
+                lastId = letter['id']
+                yield letter
+
+    ##############################################
+
+    def jsonLines(self) -> Iterator[bytes]:
+        buffer = []
+        size = 0
+        for letter in self.letters():
+            line = (json.dumps(letter, ensure_ascii=False) + '\n').encode('utf-8')
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_FLUSH:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield b''.join(buffer)
+
+    @staticmethod
+    def letterText(letter:Dict) -> str:
+        timeFormat = '%Y-%m-%d %H:%M:%S'
+        return '寄信人: %s\n收信人: %s (%s)\n寄出: %s\n送达: %s\n\n%s\n' % (
+            letter['sender'] or '-', letter['receiver'] or '-', letter['receiver_alias'],
+            datetime.fromtimestamp(letter['send_time']).strftime(timeFormat),
+            datetime.fromtimestamp(letter['recv_time']).strftime(timeFormat),
+            letter['content'])
+
+    def zipChunks(self) -> Iterator[bytes]:
+        '''每封信一个文本文件 <box>/<时间>-<id>.txt 边写边输出'''
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for letter in self.letters():
+                timeKey = letter['recv_time'] if letter['box'] == 'inbox' else letter['send_time']
+                name = '%s/%s-%d.txt' % (letter['box'],
+                                         datetime.fromtimestamp(timeKey).strftime('%Y%m%d-%H%M%S'), letter['id'])
+                info = zipfile.ZipInfo(name, datetime.fromtimestamp(timeKey).timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr(info, MailboxExport.letterText(letter))
+                if stream.size >= EXPORT_FLUSH:
+                    yield stream.take()
+        yield stream.take()
+
+    def chunks(self, format:str) -> Iterator[bytes]:
+        return self.jsonLines() if format == 'jsonl' else self.zipChunks()
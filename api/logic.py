@@ -12,12 +12,15 @@ from hashlib import md5, sha256
 import re
 from PIL import Image, ImageDraw, ImageFont
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.http.response import HttpResponseBase
 from django.utils.decorators import classonlymethod
 from django.views.decorators.csrf import csrf_exempt
 from django.core import cache
 
 from .data import LocationName
+from .profiling import RequestProfiler
 from . import secret_infos
 
 
@@ -25,6 +28,7 @@ PASSWORD_SALT = secret_infos.PASSWORD_SALT
 RSESSION_CACHE_EXP = 1800 # refresh会话缓存的有效时间 0.5小时
 VERIFY_CODE_EXP = 180 # 验证码的有效期
 TOKEN_DURATION = 300 # access token的有效期 不宜过长
+TOKEN_ACCESS_SCOPE = 'top.moyingmoe.myletter.access' # access token的scope
 
 
 class GlobalVars:
@@ -42,11 +46,13 @@ class GlobalVars:
         # init availableLocations
         # TODO: 应该做个持久化，不然每次重启服务器都要跑一边user表。有空再弄
         from .models import User
-        
-        usedLocations = []
-        users = User.objects.all()
-        for user in users:
-            usedLocations.append((user.vlocation.position_x, user.vlocation.position_y))
+        from .sharding import Shards
+
+        # 用set查重 只取坐标两列 百万用户时也只需数秒
+        usedLocations = set()
+        for db in Shards.databases():
+            usedLocations.update(User.objects.using(db).exclude(vlocation=None)
+                                 .values_list('vlocation__position_x', 'vlocation__position_y'))
         for x in range(1920):
             for y in range(1920):
                 if (x,y) not in usedLocations:
@@ -146,6 +152,7 @@ class Tools:
 
     @staticmethod
     def getPasswordHash(password:str) -> str:
+        '''旧格式的密码哈希 新密码由PasswordService计算 见api/passwords.py'''
         return Tools.getSHA256(password + PASSWORD_SALT)
     
     @staticmethod
@@ -184,6 +191,25 @@ class JsonResponse:
     ERR_INPUT_USERNAME_UNIQUE = 301
     ERR_INPUT_PASSWORD = 302
     ERR_INPUT_NICKNAME = 303
+    ERR_INPUT_CONTENT = 304
+    ERR_INPUT_RECEIVER_ALIAS = 305
+    ERR_INPUT_REGION_LEVEL = 306
+    ERR_INPUT_MATCH_SCOPE = 307
+    ERR_INPUT_MATCHABLE = 308
+    ERR_QUERY_CURSOR = 400
+    ERR_QUERY_LIMIT = 401
+    ERR_QUERY_LETTER = 402
+    ERR_QUERY_ADDRESS = 403
+    ERR_QUERY_KEYWORD = 404
+    ERR_QUERY_FORMAT = 405
+    ERR_QUERY_BULLETIN = 406
+    ERR_QUERY_RADIUS = 407
+    ERR_QUERY_MATCH = 408
+    ERR_QUERY_TILE = 409
+    ERR_QUERY_REGION = 410
+    ERR_QUERY_DAYS = 411
+    ERR_QUERY_USERNAMES = 412
+    ERR_SERVER_BUSY = 500
     ERR_LIST = {
         # 请求类错误
         ERR_ARG: "请求参数获取失败 或请求方法错误",
@@ -199,8 +225,27 @@ class JsonResponse:
         ERR_INPUT_USERNAME_UNIQUE: "用户名已被使用",
         ERR_INPUT_PASSWORD: "密码不符合规范",
         ERR_INPUT_NICKNAME: "昵称不符合规范",
+        ERR_INPUT_CONTENT: "信件内容不符合规范",
+        ERR_INPUT_RECEIVER_ALIAS: "收信人姓名不符合规范",
+        ERR_INPUT_REGION_LEVEL: "地区层级不符合规范",
+        ERR_INPUT_MATCH_SCOPE: "匹配范围不符合规范",
+        ERR_INPUT_MATCHABLE: "匹配开关取值不符合规范",
         #  查询类错误
-
+        ERR_QUERY_CURSOR: "分页游标无效",
+        ERR_QUERY_LIMIT: "分页大小超出范围",
+        ERR_QUERY_LETTER: "信件不存在 或尚未送达",
+        ERR_QUERY_ADDRESS: "收信地址不存在",
+        ERR_QUERY_KEYWORD: "搜索关键词不符合规范",
+        ERR_QUERY_FORMAT: "不支持的导出格式",
+        ERR_QUERY_BULLETIN: "公告不存在 或尚未送达",
+        ERR_QUERY_RADIUS: "搜索半径超出范围",
+        ERR_QUERY_MATCH: "暂时没有可以匹配的笔友",
+        ERR_QUERY_TILE: "地图瓦片不存在 或地图不可用",
+        ERR_QUERY_REGION: "地区不存在",
+        ERR_QUERY_DAYS: "统计天数超出范围",
+        ERR_QUERY_USERNAMES: "用户名列表不符合规范",
+        # 服务端错误
+        ERR_SERVER_BUSY: "服务繁忙 请稍后再试",
     }
 
     @staticmethod
@@ -219,15 +264,28 @@ class APIInterface:
     methods:List[str] = ["POST", "GET"]
     # 接口的参数以及参数约束
     args:Dict[str,Tuple] = {}
+    # 可选参数的默认值 请求中缺少该参数时使用 默认值同样要通过args中的约束
+    defaults:Dict[str,Any] = {}
     # 接口允许返回的错误 ERR_METHOD, ERR_ARG, ERR_ARGTYPE总是被允许的
     allow_errors: List[int] = []
     
     __allow_errors_set: Set[int] = set()
 
+    # 以下为每个请求的状态 每个请求创建一个接口实例 各请求之间互不影响 不要在类上赋值
     # 返回值 无需继承
     result:Optional[Dict] = None
     # 错误值 无需继承
     error:Optional[int] = None
+    # 非JSON的响应（如流式下载） logic成功时若设置了response 则直接返回它而不是result 无需继承
+    response:Optional[HttpResponseBase] = None
+    # 当前请求 供需要读取请求头的接口使用（如条件请求） 无需继承
+    request:Optional[HttpRequest] = None
+
+    def __init__(self, request:Optional[HttpRequest]=None):
+        self.result = None
+        self.error = None
+        self.response = None
+        self.request = request
 
     # 接口逻辑 需继承 参数为args中参数（同名） 返回值为True表示成功 返回result False表示失败 返回error
     def logic(self):
@@ -249,7 +307,7 @@ class APIInterface:
                 argDict = request.POST
             else:
                 argDict = request.GET
-            reqav = RequestArgsVerify(argDict, cls.args)
+            reqav = RequestArgsVerify(argDict, cls.args, cls.defaults)
             retv = reqav.verify()
             if retv != 0:
                 # 请求参数有问题 返回错误信息
@@ -260,25 +318,29 @@ class APIInterface:
 
             # 调用接口逻辑
             parg = reqav.getData()
-            logicSucc = cls.logic(cls, **parg)
+            interface = cls(request)
+            logicSucc = interface.logic(**parg)
 
             assert isinstance(logicSucc, bool) # 返回值必须是True或False
             
             if logicSucc:
+                if interface.response is not None:
+                    return interface.response
                 # 接口成功调用 返回result
-                return JsonResponse.create(0, cls.result)
+                return JsonResponse.create(0, interface.result)
             else:
                 # 接口调用失败 抛出error
-                if cls.error not in cls.__allow_errors_set:
+                if interface.error not in cls.__allow_errors_set:
                     # 该错误不在allow_errors中
-                    raise ErrorNotAllow(cls.error)
-                return JsonResponse.create(cls.error)
+                    raise ErrorNotAllow(interface.error)
+                return JsonResponse.create(interface.error)
 
-        return view
+        # 未开启API_PROFILING时原样返回view
+        return RequestProfiler.wrapView(view, cls.__name__)
 
 
 class RequestArgsVerify:
-    def __init__(self, postObj, args):
+    def __init__(self, postObj, args, defaults=None):
         """
         从postObj中提取需要的参数，并对其进行合法性验证
         args的数据结构:
@@ -293,14 +355,19 @@ class RequestArgsVerify:
         bound1为None时 表示只进行类型验证 不做数据验证
         err表示数据不符合约束时 返回的错误码
         后面整个部分均为None时 表示本数据既不做验证 也不存储数值
+        defaults为可选参数的默认值 postObj中没有该参数时使用
         """
         self.data = {}
         self.args = args
         self.postObj = postObj
+        self.defaults = defaults or {}
 
     def loadData(self) -> None:
         for k in self.args:
-            self.data[k] = self.postObj[k]
+            if k not in self.postObj and k in self.defaults:
+                self.data[k] = self.defaults[k]
+            else:
+                self.data[k] = self.postObj[k]
 
     def verify(self) -> int:
         try:
@@ -457,6 +524,9 @@ class VerifyCode:
                     self.draw.point((x,y), self.getRandomFrontColor())
     
     def isCodeRight(self, code:str) -> bool:
+        if settings.VERIFY_CODE_TEST_BYPASS is not None and code == settings.VERIFY_CODE_TEST_BYPASS:
+            # 压测用的旁路 见settings.VERIFY_CODE_TEST_BYPASS
+            return True
         try:
             _, seedtimestr = self.seed.split(':')
             seedtime = float(seedtimestr)
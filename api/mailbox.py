@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import *
+
+import base64
+from datetime import datetime
+
+from django.db.models import Q, QuerySet
+
+from .archive import LetterArchive, formatTime
+from .bulletin import BulletinBoard
+from .logic import Tools
+from .models import Bulletin, Letter, User
+from .profiles import ProfileCache
+from .sharding import Shards
+
+
+class Mailbox:
+    '''
+    收件箱/发件箱的keyset分页
+
+    收件箱按(recv_time, id)倒序 由索引letter_inbox_idx支撑
+    发件箱按(send_time, id)倒序 由索引letter_outbox_idx支撑
+    游标记录上一页最后一封信的(时间, id) 取下一页只需一次索引范围扫描 与页码无关
+    列表不加载正文content
+    已归档的信件（见archive.py）与数据库中的信件按同样的(时间, id)顺序合并 游标通用
+    只有翻到最新的归档信件之后才会读取归档文件
+    收件箱还会合并所在地区的公告（见bulletin.py） 游标中的公告以负id表示
+    分片时（见sharding.py）收件箱只在自己的分片中 发件箱的信在各收信人的分片中 每个分片各取一页再归并
+    '''
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+
+    # 展示收/寄信人时不需要的字段
+    USER_DEFER = ('sender__password_hash', 'sender__session', 'receiver__password_hash', 'receiver__session')
+    # 列表中不需要的字段
+    LIST_DEFER = ('content',) + USER_DEFER
+
+    @staticmethod
+    def encodeCursor(time:datetime, letterId:int) -> str:
+        raw = '%s|%d' % (time.isoformat(), letterId)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+    @staticmethod
+    def decodeCursor(cursor:str) -> Optional[Tuple[datetime,int]]:
+        '''解析游标 格式错误时返回None'''
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+            timestr, idstr = raw.split('|')
+            return datetime.fromisoformat(timestr), int(idstr)
+        except (ValueError, UnicodeError):
+            return None
+
+    @staticmethod
+    def keysetPage(queryset:QuerySet, timeField:str, cursor:Optional[Tuple[datetime,int]],
+                   limit:int) -> Tuple[List[Letter], Optional[str]]:
+        '''按(timeField, id)倒序取一页 返回(信件列表, 下一页游标)'''
+        if cursor is not None:
+            ctime, cid = cursor
+            # 先用timeField <= ctime限定索引范围 再排除同一时间下已返回的信件
+            queryset = queryset.filter(**{timeField + '__lte': ctime}).filter(
+                Q(**{timeField + '__lt': ctime}) | Q(id__lt=cid))
+        letters = list(queryset.order_by('-' + timeField, '-id')[:limit+1])
+
+        nextCursor = None
+        if len(letters) > limit:
+            letters = letters[:limit]
+            last = letters[-1]
+            nextCursor = Mailbox.encodeCursor(getattr(last, timeField), last.id)
+        return letters, nextCursor
+
+    @staticmethod
+    def inboxPage(user:User, cursor:Optional[Tuple[datetime,int]]=None,
+                  limit:int=DEFAULT_LIMIT) -> Tuple[List[Letter], Optional[str]]:
+        '''收件箱 只包含已经到达（recv_time已过）的信件'''
+        queryset = Letter.objects.using(Shards.forId(user.id)) \
+                                 .filter(receiver=user, recv_time__lte=Tools.getNow('datetime')) \
+                                 .select_related('sender').defer(*Mailbox.LIST_DEFER)
+        letters, nextCursor = Mailbox.keysetPage(queryset, 'recv_time', cursor, limit)
+        Shards.attachUsers(letters, 'sender')
+        letters, nextCursor = Mailbox.mergeArchive(LetterArchive(user.id, 'inbox'), 'recv_time',
+                                                   letters, nextCursor, cursor, limit)
+        return Mailbox.mergeBulletins(user, letters, nextCursor, cursor, limit)
+
+    @staticmethod
+    def outboxPage(user:User, cursor:Optional[Tuple[datetime,int]]=None,
+                   limit:int=DEFAULT_LIMIT) -> Tuple[List[Letter], Optional[str]]:
+        '''发件箱 包含尚在投递途中的信件'''
+        queryset = Letter.objects.filter(sender=user) \
+                                 .select_related('receiver').defer(*Mailbox.LIST_DEFER)
+        letters, nextCursor = Mailbox.mergePages([Mailbox.keysetPage(queryset.using(db), 'send_time', cursor, limit)
+                                                  for db in Shards.databases()], 'send_time', limit)
+        return Mailbox.mergeArchive(LetterArchive(user.id, 'outbox'), 'send_time', letters, nextCursor, cursor, limit)
+
+    @staticmethod
+    def mergePages(pages:List[Tuple[List[Letter], Optional[str]]], timeField:str,
+                   limit:int) -> Tuple[List[Letter], Optional[str]]:
+        '''把各分片按同一游标取出的页归并为一页 每个分片的前limit封中一定包含归并后的前limit封'''
+        if len(pages) == 1:
+            return pages[0]
+        letters = sorted((letter for page, _ in pages for letter in page),
+                         key=lambda letter: (getattr(letter, timeField), letter.id), reverse=True)
+        if len(letters) <= limit and all(nextCursor is None for _, nextCursor in pages):
+            return letters, None
+        letters = letters[:limit]
+        last = letters[-1]
+        return letters, Mailbox.encodeCursor(getattr(last, timeField), last.id)
+
+    @staticmethod
+    def mergeArchive(archive:LetterArchive, timeField:str, letters:List[Letter], nextCursor:Optional[str],
+                     cursor:Optional[Tuple[datetime,int]], limit:int) -> Tuple[List[Letter], Optional[str]]:
+        '''把归档中的信件合并进数据库中取出的一页'''
+        maxKey = archive.maxKey()
+        if maxKey is None:
+            return letters, nextCursor
+        if nextCursor is not None and (formatTime(getattr(letters[-1], timeField)), letters[-1].id) > maxKey:
+            # 这一页还没有翻到归档的范围
+            return letters, nextCursor
+
+        hotIds = set(letter.id for letter in letters)
+        archived = [letter for letter in LetterArchive.toLetters(archive.page(cursor, limit + 1))
+                    if letter.id not in hotIds] # 归档后尚未从数据库删除的信件以数据库为准
+        merged = sorted(letters + archived, key=lambda letter: (getattr(letter, timeField), letter.id), reverse=True)
+        if nextCursor is None and len(merged) <= limit:
+            return merged, None
+        merged = merged[:limit]
+        last = merged[-1]
+        return merged, Mailbox.encodeCursor(getattr(last, timeField), last.id)
+
+    @staticmethod
+    def mergeBulletins(user:User, letters:List[Letter], nextCursor:Optional[str],
+                       cursor:Optional[Tuple[datetime,int]], limit:int) -> Tuple[List[Union[Letter,Bulletin]], Optional[str]]:
+        '''把地区公告合并进收件箱的一页 公告的排序键为(到达时间, -id)'''
+        bulletins = BulletinBoard.page(user, cursor, limit + 1)
+        if not bulletins:
+            return letters, nextCursor
+
+        def key(item):
+            return (item.recv_time, -item.id) if isinstance(item, Bulletin) else (item.recv_time, item.id)
+        merged = sorted(letters + bulletins, key=key, reverse=True)
+        if nextCursor is None and len(merged) <= limit:
+            return merged, None
+        merged = merged[:limit]
+        return merged, Mailbox.encodeCursor(*key(merged[-1]))
+
+    @staticmethod
+    def pageProfiles(items:Iterable[Union[Letter,Bulletin]], counterpart:str) -> Dict[str,Dict]:
+        '''一页中所有对方（公告为发布人）的资料 一次批量读取缓存'''
+        users = (item.sender if isinstance(item, Bulletin) else getattr(item, counterpart) for item in items)
+        return ProfileCache.getProfiles(user.username for user in users if user is not None)
+
+    @staticmethod
+    def userBrief(user:Optional[User]) -> Optional[Dict]:
+        if user is None:
+            return None
+        return {'username': user.username, 'nickname': user.nickname}
+
+    @staticmethod
+    def letterBrief(letter:Letter, counterpart:str) -> Dict:
+        '''信件摘要 不含正文 counterpart为'sender'或'receiver' 即列表中要展示的对方'''
+        return {
+            'type': 'letter',
+            'id': letter.id,
+            counterpart: Mailbox.userBrief(getattr(letter, counterpart)),
+            'receiver_alias': letter.receiver_alias,
+            'has_read': letter.has_read,
+            'send_time': letter.send_time.timestamp(),
+            'recv_time': letter.recv_time.timestamp(),
+        }
+
+    @staticmethod
+    def bulletinBrief(bulletin:Bulletin) -> Dict:
+        '''公告摘要 不含正文'''
+        return {
+            'type': 'bulletin',
+            'id': bulletin.id,
+            'sender': Mailbox.userBrief(bulletin.sender),
+            'region': bulletin.region,
+            'level': BulletinBoard.regionLevel(bulletin.region),
+            'has_read': bulletin.has_read,
+            'send_time': bulletin.send_time.timestamp(),
+            'recv_time': bulletin.recv_time.timestamp(),
+        }
+
+    @staticmethod
+    def inboxBrief(item:Union[Letter,Bulletin]) -> Dict:
+        if isinstance(item, Bulletin):
+            return Mailbox.bulletinBrief(item)
+        return Mailbox.letterBrief(item, 'sender')
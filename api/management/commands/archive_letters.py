@@ -0,0 +1,79 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Q
+
+from api.archive import LetterArchive, archiveConfig
+from api.logic import Tools
+from api.models import Letter
+from api.sharding import Shards
+
+
+class Command(BaseCommand):
+    help = '把到达已久且已读的信件移入归档文件 并从Letter表中删除 适合由cron定期执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--age-days', type=int, default=None, help='默认为settings.LETTER_ARCHIVE["AGE_DAYS"]')
+        parser.add_argument('--batch', type=int, default=5000)
+        parser.add_argument('--flush', type=int, default=50000, help='累积多少封信后写一次归档并删除')
+        parser.add_argument('--dry-run', action='store_true', help='只统计可归档的信件数')
+
+    def handle(self, *args, **options):
+        ageDays = options['age_days'] if options['age_days'] is not None else archiveConfig()['AGE_DAYS']
+        cutoff = Tools.getNow('datetime') - timedelta(days=ageDays)
+        queryset = Letter.objects.filter(has_read=True, recv_time__lt=cutoff) \
+                                 .filter(Q(receiver__isnull=False) | Q(sender__isnull=False))
+        if options['dry_run']:
+            count = sum(queryset.using(db).count() for db in Shards.databases())
+            self.stdout.write('%d letters older than %s can be archived' % (count, cutoff))
+            return
+
+        self.inbox = {}
+        self.outbox = {}
+        self.pending = []
+        start = time.perf_counter()
+        total = 0
+        # 信件在收信人所在的分片 各分片依次归档 归档文件按用户存放 与分片无关
+        for db in Shards.databases():
+            lastId = 0
+            while True:
+                letters = list(queryset.using(db).filter(id__gt=lastId).order_by('id')[:options['batch']])
+                if not letters:
+                    break
+                for letter in letters:
+                    record = LetterArchive.toRecord(letter)
+                    if letter.receiver_id is not None:
+                        self.inbox.setdefault(letter.receiver_id, []).append(record)
+                    if letter.sender_id is not None:
+                        self.outbox.setdefault(letter.sender_id, []).append(record)
+                    self.pending.append(letter.id)
+                lastId = letters[-1].id
+                total += len(letters)
+                if len(self.pending) >= options['flush']:
+                    self.flush(db)
+            self.flush(db)
+        elapsed = time.perf_counter() - start
+        self.stdout.write('%d letters archived in %.1fs (%.0f rows/s)' % (total, elapsed, total / max(elapsed, 1e-9)))
+
+    def flush(self, db:str):
+        '''
+        先写归档文件 再删数据库db中的行 中途失败时重复执行即可（已归档的id会被跳过）
+        全文索引中的行保留 搜索结果从归档中取出
+        '''
+        for box, buffers in (('inbox', self.inbox), ('outbox', self.outbox)):
+            for userId, records in buffers.items():
+                LetterArchive(userId, box).append(records)
+            buffers.clear()
+        # 归档文件全部落盘后才能删除数据库中的行 一次sync比逐个文件fsync快得多
+        os.sync()
+
+        connection = connections[db]
+        sql = 'DELETE FROM %s WHERE id IN (%%s)' % connection.ops.quote_name(Letter._meta.db_table)
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            for start in range(0, len(self.pending), 500):
+                chunk = self.pending[start:start+500]
+                cursor.execute(sql % ', '.join(['%s'] * len(chunk)), chunk)
+        self.pending = []
@@ -0,0 +1,55 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bench import REGRESSION_THRESHOLD, BenchRunner
+
+
+class Command(BaseCommand):
+    help = '运行api的benchmark 在临时SQLite库上执行 输出JSON结果 并可与基线比较'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='只运行名称包含这些子串的benchmark')
+        parser.add_argument('--output', '-o', help='结果JSON的输出路径 默认输出到stdout')
+        parser.add_argument('--baseline', '-b', help='基线JSON路径 存在时与之比较')
+        parser.add_argument('--save-baseline', action='store_true', help='把本次结果写入--baseline路径')
+        parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                            help='median变慢超过该比例视为退化 默认%(default)s')
+        parser.add_argument('--scale', type=float, default=1.0, help='按比例缩放每轮调用次数')
+        parser.add_argument('--users', type=int, default=20, help='预置用户数')
+        parser.add_argument('--letters', type=int, default=200, help='预置信件数')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--list', action='store_true', help='只列出所有benchmark')
+
+    def handle(self, *args, **options):
+        runner = BenchRunner(options['names'], options['scale'], users=options['users'],
+                             letters=options['letters'], seed=options['seed'])
+        if options['list']:
+            for bench in runner.selected():
+                self.stdout.write('%-40s %s' % (bench.name, bench.group))
+            return
+
+        result = runner.run(log=lambda line: self.stderr.write(line))
+        if options['output']:
+            BenchRunner.save(result, options['output'])
+        else:
+            self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+
+        baselinePath = options['baseline']
+        if baselinePath is None:
+            return
+        if options['save_baseline']:
+            BenchRunner.save(result, baselinePath)
+            self.stderr.write('baseline saved to %s' % baselinePath)
+            return
+        try:
+            baseline = BenchRunner.load(baselinePath)
+        except FileNotFoundError:
+            raise CommandError('baseline %s not found, run with --save-baseline first' % baselinePath)
+
+        regressions = BenchRunner.compare(result, baseline, options['threshold'])
+        for reg in regressions:
+            self.stderr.write('REGRESSION %-40s %.2fus -> %.2fus (x%.2f)' % (
+                reg['name'], reg['baseline']*1e6, reg['current']*1e6, reg['ratio']))
+        if regressions:
+            raise CommandError('%d benchmark(s) regressed beyond %.0f%%' % (len(regressions), options['threshold']*100))
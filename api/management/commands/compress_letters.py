@@ -0,0 +1,135 @@
+import bisect
+import itertools
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.db.models import Max
+
+from api.compression import ContentCompressor, DICTIONARY_SIZE, trainDictionary
+from api.models import CompressionDictionary, Letter
+from api.sharding import Shards
+
+
+class Command(BaseCommand):
+    help = ('按当前的压缩配置批量重写信件正文 可先从已有信件训练共享字典 输出数据库大小和读信延迟的变化 '
+            '分片时依次处理各分片 大小为各分片之和')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000)
+        parser.add_argument('--train', type=int, default=0, metavar='SAMPLES',
+                            help='从随机抽取的SAMPLES封信训练一个新的共享字典')
+        parser.add_argument('--dict-size', type=int, default=DICTIONARY_SIZE)
+        parser.add_argument('--measure', type=int, default=2000, metavar='READS',
+                            help='前后各随机读取READS封信测量延迟 0为不测量')
+        parser.add_argument('--vacuum', action='store_true', help='重写后VACUUM 回收空闲页')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        # 各分片的主键范围 (分片, 最小id, 最大id)
+        self.ranges = []
+        for db in Shards.databases():
+            maxId = Letter.objects.using(db).aggregate(m=Max('id'))['m']
+            if maxId is not None:
+                self.ranges.append((db, Shards.idBase(db) + 1, maxId))
+        sampleIds = self.randomIds(options['measure'])
+
+        before = self.measure(sampleIds)
+        if options['train']:
+            self.train(options['train'], options['dict_size'])
+        for db in Shards.databases():
+            self.rewrite(db, options['batch'])
+            if options['vacuum']:
+                with connections[db].cursor() as cursor:
+                    cursor.execute('VACUUM')
+        after = self.measure(sampleIds)
+
+        for label, (dbSize, contentSize, mean, p99) in (('before', before), ('after', after)):
+            self.stdout.write('%-6s  db %8.1f MiB  content %8.1f MiB  read mean %.3fms p99 %.3fms' % (
+                label, dbSize / 2**20, contentSize / 2**20, mean*1000, p99*1000))
+
+    def randomIds(self, count:int):
+        '''在各分片的主键范围内均匀抽取count个(分片, id) 已删除的id读不到'''
+        if not self.ranges:
+            return []
+        spans = [maxId - minId + 1 for _, minId, maxId in self.ranges]
+        cumSpans = list(itertools.accumulate(spans))
+        sample = []
+        for _ in range(count):
+            i = bisect.bisect(cumSpans, self.rng.randrange(cumSpans[-1]))
+            db, minId, maxId = self.ranges[i]
+            sample.append((db, self.rng.randint(minId, maxId)))
+        return sample
+
+    def train(self, samples:int, size:int):
+        shards = {}
+        for db, letterId in self.randomIds(samples):
+            shards.setdefault(db, set()).add(letterId)
+        texts = [letter.content for db, ids in shards.items()
+                 for letter in Letter.objects.using(db).filter(id__in=ids).only('content')]
+        data = trainDictionary(texts, size)
+        dictionary = CompressionDictionary.objects.create(data=data, sample_count=len(texts))
+        ContentCompressor.getInstance().reloadDictionary()
+        self.stdout.write('dictionary %d trained from %d letters (%d bytes)' % (dictionary.id, len(texts), len(data)))
+
+    def rewrite(self, db:str, batch:int):
+        '''按主键分批读出db中的原始存储值 解码后按当前配置重新编码 与原值不同时写回'''
+        connection = connections[db]
+        compressor = ContentCompressor.getInstance()
+        table = connection.ops.quote_name(Letter._meta.db_table)
+        column = connection.ops.quote_name(Letter._meta.get_field('content').column)
+        select = 'SELECT id, %s FROM %s WHERE id > %%s ORDER BY id LIMIT %%s' % (column, table)
+        update = 'UPDATE %s SET %s = %%s WHERE id = %%s' % (table, column)
+
+        start = time.perf_counter()
+        total = changed = 0
+        lastId = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(select, [lastId, batch])
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            for letterId, value in rows:
+                encoded = compressor.encode(compressor.decode(value))
+                if isinstance(value, str) or bytes(value) != encoded:
+                    updates.append((connection.Database.Binary(encoded), letterId))
+            with transaction.atomic(using=db), connection.cursor() as cursor:
+                cursor.executemany(update, updates)
+            total += len(rows)
+            changed += len(updates)
+            lastId = rows[-1][0]
+        elapsed = time.perf_counter() - start
+        self.stdout.write('%s: %d letters scanned, %d rewritten in %.1fs (%.0f rows/s)' % (
+            db, total, changed, elapsed, total / max(elapsed, 1e-9)))
+
+    def measure(self, sampleIds):
+        '''(各分片数据库有效大小之和, 正文总字节数, 读信平均延迟, p99延迟)'''
+        dbSize = contentSize = 0
+        for db in Shards.databases():
+            connection = connections[db]
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA page_size')
+                pageSize = cursor.fetchone()[0]
+                cursor.execute('PRAGMA page_count')
+                pageCount = cursor.fetchone()[0]
+                cursor.execute('PRAGMA freelist_count')
+                freePages = cursor.fetchone()[0]
+                cursor.execute('SELECT COALESCE(SUM(LENGTH(CAST(%s AS BLOB))), 0) FROM %s' % (
+                    connection.ops.quote_name(Letter._meta.get_field('content').column),
+                    connection.ops.quote_name(Letter._meta.db_table)))
+                contentSize += cursor.fetchone()[0]
+            dbSize += (pageCount - freePages) * pageSize
+
+        latencies = []
+        for db, letterId in sampleIds:
+            start = time.perf_counter()
+            Letter.objects.using(db).filter(id=letterId).values_list('content', flat=True).first()
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        mean = sum(latencies) / len(latencies) if latencies else 0.0
+        p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        return dbSize, contentSize, mean, p99
@@ -0,0 +1,196 @@
+import bisect
+import itertools
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+
+from api.models import Letter, User, VirtualLocation
+from api.passwords import PasswordService
+from api.routing import PostalRouter
+from api.sharding import Shards
+
+
+WORDS = [
+    "你好", "好久不见", "最近", "天气", "下雨", "晴天", "城里", "小区", "邮局", "信", "回信", "朋友",
+    "今天", "昨天", "明天", "想念", "故事", "一起", "散步", "咖啡", "书", "音乐", "花", "猫",
+    "窗外", "街角", "旅行", "远方", "地址", "邮票", "祝好", "谢谢", "等待", "希望", "记得", "晚安",
+]
+
+
+@contextmanager
+def rawTimestamps(*fields):
+    '''临时关闭auto_now_add 使bulk_create可以写入生成的时间'''
+    saved = [(f, f.auto_now_add) for f in fields]
+    for f, _ in saved:
+        f.auto_now_add = False
+    try:
+        yield
+    finally:
+        for f, flag in saved:
+            f.auto_now_add = flag
+
+
+class Command(BaseCommand):
+    help = ('批量生成合成的用户、会话和信件数据 用于压力测试 同一seed生成的数据相同 '
+            '批量写入不经过signal 完成后执行rebuild_search_index和rebuild_region_stats重建全文索引和地区统计 '
+            '（--skip-rebuild时需手动执行） 未读计数在第一次读取时从数据库统计 '
+            '按连续的主键直接写入单个数据库 分片时不可用 应使用import_users导入')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--letters', type=int, default=100000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch', type=int, default=10000, help='每个事务写入的行数')
+        parser.add_argument('--prefix', default='syn', help='生成用户名的前缀 不可与已有用户冲突')
+        parser.add_argument('--password', default='password', help='所有生成用户的密码')
+        parser.add_argument('--days', type=int, default=365, help='注册时间和信件的时间跨度（天）')
+        parser.add_argument('--session-ratio', type=float, default=0.3, help='拥有refresh会话的用户比例')
+        parser.add_argument('--match-ratio', type=float, default=0.0, help='愿意被随机匹配为笔友的用户比例')
+        parser.add_argument('--locality', type=float, default=0.6, help='收信人与寄信人同城的概率')
+        parser.add_argument('--zipf', type=float, default=1.1, help='寄/收信活跃度的Zipf指数')
+        parser.add_argument('--skip-rebuild', action='store_true',
+                            help='不重建全文索引和地区统计 之后需手动执行rebuild_search_index、rebuild_region_stats')
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.now = datetime.now()
+        if Shards.enabled():
+            raise CommandError('gen_population writes a single database, it cannot run with SHARD_DATABASES set')
+        if User.objects.filter(username__startswith=options['prefix']).exists():
+            raise CommandError('users with prefix "%s" already exist, use --prefix' % options['prefix'])
+
+        start = time.perf_counter()
+        userIds, positions = self.generateUsers()
+        if options['letters'] > 0 and len(userIds) > 1:
+            self.generateLetters(userIds, positions)
+        if options['skip_rebuild']:
+            self.stdout.write('search index and region stats are stale, run rebuild_search_index and rebuild_region_stats')
+        else:
+            rebuildStart = time.perf_counter()
+            call_command('rebuild_search_index', stdout=self.stdout)
+            call_command('rebuild_region_stats', stdout=self.stdout)
+            self.stdout.write('rebuilt derived data in %.1fs' % (time.perf_counter() - rebuildStart))
+        self.stdout.write('done in %.1fs' % (time.perf_counter() - start))
+
+    def report(self, what:str, rows:int, elapsed:float) -> None:
+        self.stdout.write('%-16s %10d rows %8.1fs %10.0f rows/s' % (what, rows, elapsed, rows / max(elapsed, 1e-9)))
+
+    def batches(self, iterable, size:int):
+        it = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(it, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def freePositions(self, count:int):
+        used = set(VirtualLocation.objects.values_list('position_x', 'position_y'))
+        if count > 1920*1920 - len(used):
+            raise CommandError('not enough free positions for %d users' % count)
+        sample = self.rng.sample(range(1920*1920), count + len(used))
+        return [pos for pos in (divmod(p, 1920) for p in sample) if pos not in used][:count]
+
+    def generateUsers(self):
+        opts = self.options
+        count = opts['users']
+        positions = self.freePositions(count)
+        passwordHash = PasswordService.computeHash(opts['password'])
+        vlocId = (VirtualLocation.objects.aggregate(m=Max('id'))['m'] or 0) + 1
+        userId = (User.objects.aggregate(m=Max('id'))['m'] or 0) + 1
+        span = opts['days'] * 86400
+        nowStamp = int(self.now.timestamp())
+
+        start = time.perf_counter()
+        with rawTimestamps(User._meta.get_field('reg_date')):
+            for chunk in self.batches(range(count), opts['batch']):
+                vlocs = []
+                users = []
+                for i in chunk:
+                    vloc = VirtualLocation.createLocationByPos(positions[i])
+                    vloc.id = vlocId + i
+                    vlocs.append(vloc)
+                    session = None
+                    if self.rng.random() < opts['session_ratio']:
+                        session = '%064x:%d' % (self.rng.getrandbits(256), nowStamp - self.rng.randint(0, 86400))
+                    user = User(id=userId + i, username='%s%07d' % (opts['prefix'], i),
+                                password_hash=passwordHash, nickname='居民%d' % i, vlocation_id=vloc.id,
+                                session=session, reg_date=self.now - timedelta(seconds=self.rng.randint(0, span)))
+                    if opts['match_ratio'] > 0 and self.rng.random() < opts['match_ratio']:
+                        user.matchable = True
+                        user.matchable_time = user.reg_date
+                    users.append(user)
+                with transaction.atomic():
+                    VirtualLocation.objects.bulk_create(vlocs)
+                    User.objects.bulk_create(users)
+        self.report('users+locations', count, time.perf_counter() - start)
+        return list(range(userId, userId + count)), positions
+
+    def zipfCumWeights(self, n:int):
+        weights = [1 / (rank ** self.options['zipf']) for rank in range(1, n+1)]
+        self.rng.shuffle(weights)
+        return list(itertools.accumulate(weights))
+
+    def generateLetters(self, userIds, positions):
+        opts = self.options
+        rng = self.rng
+        n = len(userIds)
+        senderWeights = self.zipfCumWeights(n)
+        receiverWeights = self.zipfCumWeights(n)
+        # 按城市分组 用于生成同城通信
+        byCity = {}
+        for i, pos in enumerate(positions):
+            byCity.setdefault((pos[1] // 480)*4 + pos[0] // 480, []).append(i)
+        cityOf = [(pos[1] // 480)*4 + pos[0] // 480 for pos in positions]
+        contents = [''.join(rng.choice(WORDS) + ('，' if rng.random() < 0.2 else '')
+                            for _ in range(max(4, int(rng.lognormvariate(4, 0.6)))))
+                    for _ in range(4096)]
+        # 正文以压缩格式存储 直接写INSERT时需要预先编码
+        contentField = Letter._meta.get_field('content')
+        contents = [contentField.get_db_prep_value(c, connection) for c in contents]
+
+        router = PostalRouter.getInstance()
+        letterId = (Letter.objects.aggregate(m=Max('id'))['m'] or 0) + 1
+        span = opts['days'] * 86400
+        total = opts['letters']
+        start = time.perf_counter()
+
+        def pick(cumWeights):
+            return bisect.bisect(cumWeights, rng.random() * cumWeights[-1])
+
+        # 信件量最大 bulk_create逐值编译SQL在SQLite上只有约1万行/秒
+        # 这里直接用一条预编译的INSERT做executemany
+        fields = ['id', 'sender_id', 'receiver_id', 'receiver_alias', 'has_read', 'send_time', 'recv_time', 'content']
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            connection.ops.quote_name(Letter._meta.db_table),
+            ', '.join(connection.ops.quote_name(Letter._meta.get_field(f).column) for f in fields),
+            ', '.join(['%s'] * len(fields)))
+
+        for chunk in self.batches(range(total), opts['batch']):
+            pairs = []
+            for i in chunk:
+                s = pick(senderWeights)
+                if rng.random() < opts['locality'] and len(byCity[cityOf[s]]) > 1:
+                    r = rng.choice(byCity[cityOf[s]])
+                else:
+                    r = pick(receiverWeights)
+                if r == s:
+                    r = (r + 1) % n
+                pairs.append((s, r))
+            delays = router.batchDeliverySeconds([positions[s] for s, _ in pairs], [positions[r] for _, r in pairs])
+            rows = []
+            for i, (s, r), delay in zip(chunk, pairs, delays):
+                sendTime = self.now - timedelta(seconds=rng.randint(0, span))
+                recvTime = sendTime + timedelta(seconds=delay)
+                rows.append((letterId + i, userIds[s], userIds[r], '居民%d' % r,
+                             recvTime < self.now and rng.random() < 0.8,
+                             str(sendTime), str(recvTime), rng.choice(contents)))
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+        self.report('letters', total, time.perf_counter() - start)
@@ -0,0 +1,206 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Max
+
+from api.logic import JsonResponse, RequestArgsVerify
+from api.models import User, UserShard, VirtualLocation
+from api.passwords import PasswordService
+from api.profiles import ProfileCache
+from api.sharding import Shards
+from api.stats import RegionStats
+from api.views import RegisterInterface
+
+
+# 与注册接口相同的字段和校验规则
+IMPORT_FIELDS = ('username', 'password', 'nickname')
+IMPORT_ARGS = {k: RegisterInterface.args[k] for k in IMPORT_FIELDS}
+
+
+class Command(BaseCommand):
+    help = ('从CSV（带表头）或JSONL批量导入用户 字段为username, password, nickname 校验规则与注册接口相同 '
+            '地址随机分配 密码在进程池中计算哈希 每批一个事务 '
+            '运行中的服务进程不知道本命令分配的地址 应在停机时导入 或导入后重启服务')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='输入文件 -为标准输入')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), default=None, help='缺省时按扩展名判断')
+        parser.add_argument('--batch', type=int, default=5000, help='每个事务写入的用户数')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='计算密码哈希的进程数 0为在本进程中计算')
+        parser.add_argument('--rejects', default=None, help='被拒绝的行写入此文件（JSONL） 不含密码')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        self.rejectFile = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+        self.rejected = {}
+        self.seen = set()
+        self.imported = 0
+        self.start = time.perf_counter()
+
+        pool = ProcessPoolExecutor(options['workers'], initializer=django.setup) if options['workers'] > 0 else None
+        try:
+            rows = self.validRows(self.readRows(stream, format))
+            # 流水线: 写入一批时 进程池已经在计算下一批的哈希
+            pending = None
+            for batch in self.batches(rows, options['batch']):
+                passwords = [row[2] for row in batch]
+                hashes = pool.map(PasswordService.computeHash, passwords, chunksize=max(1, len(batch) // (4 * options['workers']))) \
+                         if pool is not None else map(PasswordService.computeHash, passwords)
+                if pending is not None:
+                    self.writeBatch(*pending)
+                pending = (batch, hashes)
+            if pending is not None:
+                self.writeBatch(*pending)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if stream is not sys.stdin:
+                stream.close()
+            if self.rejectFile is not None:
+                self.rejectFile.close()
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write('imported %d users in %.1fs (%.0f rows/s), rejected %d' % (
+            self.imported, elapsed, self.imported / max(elapsed, 1e-9), sum(self.rejected.values())))
+        for code, n in sorted(self.rejected.items()):
+            self.stdout.write('  %d %-24s %d' % (code, JsonResponse.ERR_LIST.get(code, ''), n))
+
+    ##############################################
+
+    def readRows(self, stream, format):
+        '''(行号, dict或None)'''
+        if format == 'csv':
+            reader = csv.DictReader(stream)
+            for row in reader:
+                # 列数不足时缺少的字段为None 去掉后按缺少参数拒绝
+                yield reader.line_num, {k: v for k, v in row.items() if v is not None}
+            return
+        for lineNo, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield lineNo, row if isinstance(row, dict) else None
+
+    def validRows(self, rows):
+        '''按注册接口的规则校验 同一输入中重复的用户名也拒绝 产出(行号, 用户名, 密码, 昵称)'''
+        for lineNo, row in rows:
+            if row is None:
+                self.reject(lineNo, None, JsonResponse.ERR_ARGTYPE)
+                continue
+            verify = RequestArgsVerify(row, IMPORT_ARGS)
+            code = verify.verify()
+            if code != 0:
+                self.reject(lineNo, row.get('username'), code)
+                continue
+            data = verify.data
+            if data['username'] in self.seen:
+                self.reject(lineNo, data['username'], JsonResponse.ERR_INPUT_USERNAME_UNIQUE)
+                continue
+            self.seen.add(data['username'])
+            yield lineNo, data['username'], data['password'], data['nickname']
+
+    def reject(self, lineNo, username, code) -> None:
+        self.rejected[code] = self.rejected.get(code, 0) + 1
+        if self.rejectFile is not None:
+            self.rejectFile.write(json.dumps({'line': lineNo, 'username': username, 'code': code,
+                                              'reason': JsonResponse.ERR_LIST.get(code)}, ensure_ascii=False) + '\n')
+
+    def batches(self, iterable, size:int):
+        it = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(it, size))
+            if not chunk:
+                return
+            yield chunk
+
+    ##############################################
+
+    def writeBatch(self, batch, hashes) -> None:
+        hashes = list(hashes)
+        users = []
+        committed = []  # 分片的事务各自提交 [(分片, 居民)]
+        try:
+            # default的事务是IMMEDIATE的 在事务中查重 并发的注册不会插进来（分片时查的是default中的用户名目录）
+            with transaction.atomic():
+                names = [row[1] for row in batch]
+                existing = set((UserShard if Shards.enabled() else User).objects.filter(username__in=names)
+                               .values_list('username', flat=True))
+                accepted = []
+                for row, passwordHash in zip(batch, hashes):
+                    if row[1] in existing:
+                        self.reject(row[0], row[1], JsonResponse.ERR_INPUT_USERNAME_UNIQUE)
+                    else:
+                        accepted.append((row, passwordHash))
+                positions = VirtualLocation.getRandomPositions(len(accepted))
+                if len(positions) < len(accepted):
+                    raise CommandError('not enough free positions, %d users imported before line %d'
+                                       % (self.imported, accepted[0][0][0]))
+
+                shards = {}
+                for item, pos in zip(accepted, positions):
+                    shards.setdefault(Shards.forPosition(*pos), []).append((item, pos))
+                if Shards.enabled():
+                    UserShard.objects.bulk_create([UserShard(username=row[1], shard=Shards.aliases().index(db))
+                                                   for db, items in shards.items() for (row, _), _ in items])
+                for db, items in shards.items():
+                    with transaction.atomic(using=db):
+                        residents = self.insertResidents(db, items)
+                    users.extend(residents)
+                    if db != 'default':
+                        committed.append((db, residents))
+        except BaseException:
+            # 用户名目录随default的事务回滚 已提交到其他分片的居民没有目录项 无法登录也无法再导入 在此删除
+            self.removeResidents(committed)
+            raise
+
+        RegionStats.onImport([user.vlocation for user in users], users[0].reg_date if users else None)
+        # bulk_create不触发post_save 删除可能缓存了的“不存在”
+        ProfileCache.invalidate(user.username for user in users)
+        self.imported += len(users)
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write('%10d imported %8d rejected %8.0f rows/s' % (
+            self.imported, sum(self.rejected.values()), self.imported / max(elapsed, 1e-9)))
+
+    def removeResidents(self, committed) -> None:
+        '''刚写入的居民还没有任何关联的行 直接DELETE 不经过ORM的级联（级联会查default中的表）'''
+        for db, users in committed:
+            connection = connections[db]
+            try:
+                with transaction.atomic(using=db), connection.cursor() as cursor:
+                    for model, ids in ((User, [user.id for user in users]),
+                                       (VirtualLocation, [user.vlocation.id for user in users])):
+                        sql = 'DELETE FROM %s WHERE id IN (%%s)' % connection.ops.quote_name(model._meta.db_table)
+                        for start in range(0, len(ids), 500):
+                            chunk = ids[start:start+500]
+                            cursor.execute(sql % ', '.join(['%s'] * len(chunk)), chunk)
+            except Exception as e:
+                self.stderr.write('failed to remove %d residents from %s (ids %d-%d): %s' % (
+                    len(users), db, users[0].id, users[-1].id, e))
+
+    def insertResidents(self, db, items):
+        '''写入一个数据库 主键在事务中按当前最大值连续分配 bulk_create后不需要再查回id'''
+        vlocId = max(VirtualLocation.objects.using(db).aggregate(m=Max('id'))['m'] or 0, Shards.idBase(db)) + 1
+        userId = max(User.objects.using(db).aggregate(m=Max('id'))['m'] or 0, Shards.idBase(db)) + 1
+        vlocs, users = [], []
+        for i, ((row, passwordHash), pos) in enumerate(items):
+            vloc = VirtualLocation.createLocationByPos(pos)
+            vloc.id = vlocId + i
+            vlocs.append(vloc)
+            users.append(User(id=userId + i, username=row[1], password_hash=passwordHash, nickname=row[3],
+                              vlocation=vloc, session=None))
+        VirtualLocation.objects.using(db).bulk_create(vlocs)
+        User.objects.using(db).bulk_create(users)
+        return users
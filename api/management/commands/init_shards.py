@@ -0,0 +1,13 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from api.sharding import Shards
+
+
+class Command(BaseCommand):
+    help = '为default和每个分片建表（migrate --run-syncdb） 并设置各分片的主键起点 可重复执行'
+
+    def handle(self, *args, **options):
+        for db in ['default'] + Shards.aliases():
+            call_command('migrate', run_syncdb=True, database=db, verbosity=0)
+            self.stdout.write('%s ready' % db)
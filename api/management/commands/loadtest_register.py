@@ -0,0 +1,221 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import User, VirtualLocation
+
+
+BYPASS_CODE = 'loadtest-bypass'
+
+
+def percentile(sortedValues, p:float) -> float:
+    if not sortedValues:
+        return 0.0
+    k = min(len(sortedValues) - 1, max(0, int(round(p / 100 * (len(sortedValues) - 1)))))
+    return sortedValues[k]
+
+
+class PhaseStats:
+    '''一个压测阶段（注册/登录）的统计'''
+    def __init__(self, name:str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.codes = {}
+        self.transportErrors = 0
+        self.start = None
+        self.end = None
+
+    def record(self, latency:float, code) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+            if code is None:
+                self.transportErrors += 1
+            else:
+                self.codes[code] = self.codes.get(code, 0) + 1
+
+    def summary(self) -> dict:
+        lat = sorted(self.latencies)
+        elapsed = (self.end or time.perf_counter()) - (self.start or 0)
+        return {
+            'requests': len(lat),
+            'elapsed': elapsed,
+            'throughput': len(lat) / elapsed if elapsed > 0 else 0,
+            'codes': {str(k): v for k, v in sorted(self.codes.items())},
+            'transport_errors': self.transportErrors,
+            'latency_ms': {
+                'p50': percentile(lat, 50) * 1000,
+                'p90': percentile(lat, 90) * 1000,
+                'p99': percentile(lat, 99) * 1000,
+                'max': (lat[-1] if lat else 0) * 1000,
+            },
+        }
+
+
+class Command(BaseCommand):
+    help = ('注册/登录压测 启动多个本地服务进程（或使用--url指定的服务） 以验证码旁路并发注册和登录 '
+            '报告吞吐、延迟分位数、重复分配的地址和泄漏的地址')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', action='append', help='已启动的服务根地址 可重复 指定后不再自行启动服务')
+        parser.add_argument('--workers', type=int, default=4, help='自行启动的服务进程数')
+        parser.add_argument('--port', type=int, default=8100, help='自行启动服务的起始端口')
+        parser.add_argument('--db', help='压测使用的SQLite文件 默认使用临时文件（--url模式下默认为settings中的库）')
+        parser.add_argument('--registrations', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--duplicate-ratio', type=float, default=0.05,
+                            help='使用重复用户名的注册比例 用于触发IntegrityError分支')
+        parser.add_argument('--no-login', action='store_true', help='跳过登录阶段')
+        parser.add_argument('--no-warmup', action='store_true', help='不预热各进程的地址分配器')
+        parser.add_argument('--json', help='把报告写入该JSON文件')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.procs = []
+        self.prefix = 'lt%x' % (int(time.time()) & 0xffffff)
+        try:
+            if options['url']:
+                self.urls = [u.rstrip('/') for u in options['url']]
+                self.dbPath = options['db'] or str(settings.DATABASES['default']['NAME'])
+            else:
+                self.dbPath = options['db'] or os.path.join(tempfile.mkdtemp(prefix='myletter-lt-'), 'lt.sqlite3')
+                self.urls = self.startServers()
+            report = self.run()
+        finally:
+            for proc in self.procs:
+                proc.terminate()
+            for proc in self.procs:
+                proc.wait()
+
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        self.stdout.write(text)
+        if options['json']:
+            Path(options['json']).write_text(text, encoding='utf-8')
+
+    ##############################################
+    # 服务进程
+
+    def startServers(self):
+        env = dict(os.environ, MYLETTER_DB_NAME=self.dbPath, MYLETTER_VERIFY_CODE_BYPASS=BYPASS_CODE)
+        manage = str(Path(settings.BASE_DIR) / 'manage.py')
+        subprocess.run([sys.executable, manage, 'migrate', '--run-syncdb', '-v0'], env=env, check=True)
+        urls = []
+        for i in range(self.options['workers']):
+            port = self.options['port'] + i
+            self.procs.append(subprocess.Popen(
+                [sys.executable, manage, 'runserver', '127.0.0.1:%d' % port, '--noreload'],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            urls.append('http://localhost:%d' % port)
+        for url in urls:
+            self.waitReady(url)
+        return urls
+
+    def waitReady(self, url:str, timeout:float=30) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.post(url, 'user/username_available/', {'username': 'ping'})[1] is not None:
+                return
+            time.sleep(0.2)
+        raise CommandError('server %s did not start' % url)
+
+    ##############################################
+    # 请求
+
+    def post(self, url:str, api:str, data:dict):
+        body = urllib.parse.urlencode(data).encode('utf-8')
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url + '/myletter/api/' + api, body, timeout=60) as resp:
+                payload = json.loads(resp.read().decode('utf-8'))
+            code = payload.get('code')
+        except (urllib.error.URLError, OSError, ValueError):
+            payload, code = None, None
+        return time.perf_counter() - start, code, payload
+
+    def register(self, i:int, username:str, stats:PhaseStats):
+        latency, code, _ = self.post(self.urls[i % len(self.urls)], 'user/register/', {
+            'username': username, 'password': 'loadtest', 'nickname': 'lt%d' % i,
+            'randomkey': '0:0', 'verifycode': BYPASS_CODE})
+        stats.record(latency, code)
+        return username if code == 0 else None
+
+    def login(self, i:int, username:str, stats:PhaseStats):
+        latency, code, _ = self.post(self.urls[i % len(self.urls)], 'user/login/', {
+            'username': username, 'password': 'loadtest', 'randomkey': '0:0', 'verifycode': BYPASS_CODE})
+        stats.record(latency, code)
+
+    def runPhase(self, stats:PhaseStats, func, items):
+        stats.start = time.perf_counter()
+        with ThreadPoolExecutor(self.options['concurrency']) as pool:
+            results = list(pool.map(lambda item: func(item[0], item[1], stats), enumerate(items)))
+        stats.end = time.perf_counter()
+        return results
+
+    def run(self):
+        opts = self.options
+        if not opts['no_warmup']:
+            # 每个进程第一次注册时要初始化地址分配器 预热后再计时
+            warm = PhaseStats('warmup')
+            for i, _ in enumerate(self.urls):
+                self.register(i, '%swarm%d' % (self.prefix, i), warm)
+
+        count = opts['registrations']
+        dupEvery = int(1 / opts['duplicate_ratio']) if opts['duplicate_ratio'] > 0 else 0
+        names = []
+        for i in range(count):
+            if dupEvery and i % dupEvery == dupEvery - 1 and names:
+                names.append(names[-1])
+            else:
+                names.append('%s%06d' % (self.prefix, i))
+
+        regStats = PhaseStats('register')
+        registered = [n for n in self.runPhase(regStats, self.register, names) if n is not None]
+        report = {'workers': self.urls, 'register': regStats.summary()}
+
+        if not opts['no_login']:
+            loginStats = PhaseStats('login')
+            self.runPhase(loginStats, self.login, registered)
+            report['login'] = loginStats.summary()
+
+        report['addresses'] = self.checkAddresses()
+        return report
+
+    ##############################################
+    # 地址一致性检查
+
+    def checkAddresses(self):
+        vloc = VirtualLocation._meta.db_table
+        user = User._meta.db_table
+        conn = sqlite3.connect(self.dbPath)
+        try:
+            duplicated = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(n), 0) FROM (SELECT COUNT(*) AS n FROM %s u JOIN %s v '
+                'ON u.vlocation_id = v.id GROUP BY v.position_x, v.position_y HAVING COUNT(*) > 1)' % (user, vloc)
+            ).fetchone()
+            leaked = conn.execute(
+                'SELECT COUNT(*) FROM %s v WHERE NOT EXISTS (SELECT 1 FROM %s u WHERE u.vlocation_id = v.id)'
+                % (vloc, user)).fetchone()[0]
+            total = conn.execute('SELECT COUNT(*) FROM %s' % vloc).fetchone()[0]
+        finally:
+            conn.close()
+        return {
+            'locations': total,
+            # 被多个用户占用的坐标数 以及这些坐标上的用户总数
+            'duplicated_positions': duplicated[0],
+            'users_on_duplicated_positions': duplicated[1],
+            # 已写入但没有任何用户引用的VirtualLocation 即注册失败后泄漏的地址
+            'leaked_locations': leaked,
+        }
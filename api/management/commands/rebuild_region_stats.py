@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.stats import RegionStats
+
+
+class Command(BaseCommand):
+    help = '从数据库和归档重新统计各地区的居民和信件数 批量导入之后需要执行 执行期间的增量更新会被覆盖 应在低峰期运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000, help='每次写入的行数')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        total = RegionStats.rebuild(options['batch'])
+        self.stdout.write('%d region/day rows written in %.1fs' % (total, time.perf_counter() - start))
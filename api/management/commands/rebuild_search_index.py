@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.search import LetterSearch
+
+
+class Command(BaseCommand):
+    help = '重建信件全文索引 批量导入信件（不经过Letter.save）之后需要执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        total = LetterSearch.rebuild(options['batch'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write('%d letters indexed in %.1fs (%.0f rows/s)' % (total, elapsed, total / max(elapsed, 1e-9)))
@@ -0,0 +1,62 @@
+import time
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from api.delivery import DeliveryScheduler
+from api.logic import Tools
+from api.models import Letter
+from api.routing import PostalRouter
+from api.sharding import Shards
+
+
+class Command(BaseCommand):
+    help = ('按当前的邮路参数批量重算信件的到达时间 默认只重算尚未到达的信件 '
+            '完成后通知运行中的服务: 各进程的投递调度器在POLL_INTERVAL内重新加载并清空未读计数缓存 '
+            '不需要重启 关闭了投递调度器（DELIVERY_SCHEDULER ENABLED=False）的服务需要重启')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=20000)
+        parser.add_argument('--all', action='store_true', help='同时重算已经到达的信件')
+
+    def handle(self, *args, **options):
+        router = PostalRouter.getInstance()
+        # 信件和收信人在同一分片 寄信人可能在另一个分片 其位置按id另取
+        queryset = Letter.objects.exclude(sender_id=None).exclude(receiver__vlocation=None)
+        if not options['all']:
+            queryset = queryset.filter(recv_time__gt=Tools.getNow('datetime'))
+
+        start = time.perf_counter()
+        total = 0
+        for db in Shards.databases():
+            connection = connections[db]
+            sql = 'UPDATE %s SET %s = %%s WHERE id = %%s' % (
+                connection.ops.quote_name(Letter._meta.db_table),
+                connection.ops.quote_name(Letter._meta.get_field('recv_time').column))
+            lastId = 0
+            while True:
+                rows = list(queryset.using(db).filter(id__gt=lastId).order_by('id').values_list(
+                    'id', 'send_time', 'sender_id',
+                    'receiver__vlocation__position_x', 'receiver__vlocation__position_y')[:options['batch']])
+                if not rows:
+                    break
+                lastId = rows[-1][0]
+                senders = {user.id: user.vlocation for user in Shards.usersByIds(
+                    (r[2] for r in rows), 'vlocation__position_x', 'vlocation__position_y', related=('vlocation',)).values()
+                    if user.vlocation is not None}
+                rows = [r for r in rows if r[2] in senders]
+                delays = router.batchDeliverySeconds(
+                    [(senders[r[2]].position_x, senders[r[2]].position_y) for r in rows], [(r[3], r[4]) for r in rows])
+                updates = [(str(r[1] + timedelta(seconds=d)), r[0]) for r, d in zip(rows, delays)]
+                with transaction.atomic(using=db), connection.cursor() as cursor:
+                    cursor.executemany(sql, updates)
+                total += len(rows)
+
+        # 运行中的调度器堆里是旧的到达时间 由共享的generation通知其重新加载
+        DeliveryScheduler.bumpGeneration()
+        # 未读计数中缓存了投递途中信件的到达时间 共享缓存在此清空 进程内的缓存由各进程的调度器重新加载时清空
+        caches['counter'].clear()
+        elapsed = time.perf_counter() - start
+        self.stdout.write('%d letters updated in %.1fs (%.0f rows/s)' % (total, elapsed, total / max(elapsed, 1e-9)))
@@ -0,0 +1,98 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+
+from api.search import LetterSearch
+from api.sharding import Shards
+
+
+class Command(BaseCommand):
+    help = ('把已有数据库的表结构升级到当前的模型: 建立缺少的表 添加缺少的列、索引和约束 已是最新时什么都不做 可重复执行 '
+            '本项目不使用迁移 migrate --run-syncdb只建立新表 不修改已有的表 更新代码后应停机执行本命令再启动服务 '
+            '只会添加 不会删除或修改已有的列（如password_hash的长度 SQLite不限制长度 无需修改） '
+            '升级后按提示执行rebuild_search_index、rebuild_region_stats重建派生数据')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只列出需要的修改 不执行')
+
+    def handle(self, *args, **options):
+        self.dryRun = options['dry_run']
+        changed = 0
+        for db in ['default'] + Shards.aliases():
+            changed += self.upgrade(db)
+        if changed and not self.dryRun:
+            self.stdout.write('existing letters are not in the search index and region stats may be incomplete, '
+                              'run rebuild_search_index and rebuild_region_stats')
+        elif not changed:
+            self.stdout.write('schema is up to date')
+
+    def upgrade(self, db) -> int:
+        '''返回db需要的修改数'''
+        connection = connections[db]
+        models = [model for model in apps.get_app_config('api').get_models() if router.allow_migrate_model(db, model)]
+        tables = set(connection.introspection.table_names())
+        changed = 0
+        hasLetters = any(model._meta.model_name == 'letter' for model in models)
+        with connection.schema_editor() as editor:
+            for model in models:
+                changed += self.upgradeModel(db, connection, editor, model, tables)
+        if hasLetters and LetterSearch.legacyTables(db):
+            # 分词方式变了 旧索引不能增量维护（删除时需要写入时的分词）
+            changed += self.apply(db, 'drop old search index %s' % ', '.join(LetterSearch.legacyTables(db)),
+                                  lambda: LetterSearch.dropLegacyTables(db))
+        if not self.dryRun:
+            Shards.seedSequences(db)
+            if hasLetters:
+                LetterSearch.ensureTable(db)
+        return changed
+
+    def upgradeModel(self, db, connection, editor, model, tables) -> int:
+        table = model._meta.db_table
+        if table not in tables:
+            return self.apply(db, 'create table %s' % table, lambda: editor.create_model(model))
+
+        changed = 0
+        with connection.cursor() as cursor:
+            columns = {column.name for column in connection.introspection.get_table_description(cursor, table)}
+        for field in model._meta.local_concrete_fields:
+            if field.column not in columns:
+                changed += self.apply(db, 'add column %s.%s' % (table, field.column),
+                                      lambda field=field: self.addColumn(editor, model, field))
+        if changed and self.dryRun:
+            # 列还不存在 无法继续检查索引
+            return changed
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+        indexed = {tuple(info['columns']) for info in constraints.values() if info['index'] or info['unique']}
+        for field in model._meta.local_concrete_fields:
+            if field.db_index and not field.unique and (field.column,) not in indexed:
+                changed += self.apply(db, 'add index on %s.%s' % (table, field.column),
+                                      lambda field=field: [editor.execute(sql) for sql in editor._field_indexes_sql(model, field)])
+        for index in model._meta.indexes:
+            if index.name not in constraints:
+                changed += self.apply(db, 'add index %s' % index.name, lambda index=index: editor.add_index(model, index))
+        for constraint in model._meta.constraints:
+            if constraint.name not in constraints:
+                changed += self.apply(db, 'add constraint %s' % constraint.name,
+                                      lambda constraint=constraint: editor.add_constraint(model, constraint))
+        return changed
+
+    def addColumn(self, editor, model, field) -> None:
+        '''
+        ALTER TABLE ADD COLUMN 带上字段的默认值 已有的行取默认值
+        不用schema_editor.add_field: SQLite上它会重建整张表 并假定模型的其他列都已存在 缺少多列时失败
+        '''
+        definition, params = editor.column_sql(model, field)
+        default = editor.effective_default(field)
+        if default is not None:
+            # DDL中不能用参数 默认值直接写入语句
+            definition += ' DEFAULT %s' % editor.quote_value(default)
+        editor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            editor.quote_name(model._meta.db_table), editor.quote_name(field.column), definition), params or None)
+
+    def apply(self, db, description, action) -> int:
+        self.stdout.write('%s: %s%s' % (db, description, ' (dry run)' if self.dryRun else ''))
+        if not self.dryRun:
+            action()
+        return 1
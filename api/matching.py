@@ -0,0 +1,179 @@
+from __future__ import annotations
+from typing import *
+
+import bisect
+import random
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+
+from .logic import Tools
+from .models import COMMUNITY_SIZE, REGION_LEVELS, MatchPair, User, communityRegionKeys
+from .sharding import Shards
+
+
+MATCH_SCOPES = ('world',) + REGION_LEVELS   # 匹配范围 world为不限地区
+REFRESH_INTERVAL = 5                        # 秒 查询时若距上次同步超过此时间 拉取其他进程修改的matchable
+REFRESH_OVERLAP = timedelta(seconds=2)      # 同步窗口向前重叠 容忍各进程时钟和事务提交的先后
+SAMPLE_TRIES = 32                           # 随机抽样的次数 都不可用时退化为扫描整个池
+MATCHED_CACHE_SIZE = 10000                  # 缓存匹配记录的用户数
+
+
+class MatchPool:
+    '''
+    随机笔友匹配的候选池
+
+    每个地区（以及全世界 键为''）一个array 存放该地区愿意被匹配的用户id 随机取下标即为O(1)抽样
+    用户的地址注册后不再改变 因此退出匹配时只从members中删除 池中留下的id在抽样时跳过（惰性删除）
+    再次加入时恢复原来的位置 失效的id超过总数的四分之一时整体压缩
+
+    每个用户匹配过的人存为有序的array 按需从MatchPair加载 最近使用的MATCHED_CACHE_SIZE个用户留在内存中
+    同一对用户在多个进程中同时匹配时由MatchPair的唯一约束保证只成功一次
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> MatchPool:
+        if MatchPool.INSTANCE is None:
+            with MatchPool.LOCK:
+                if MatchPool.INSTANCE is None:
+                    pool = MatchPool()
+                    pool.refresh()
+                    MatchPool.INSTANCE = pool
+        return MatchPool.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.pools:Dict[str, array] = {}
+        self.members:Dict[int, Tuple[str,str,str]] = {}     # 用户id -> 所在地区键
+        self.stale:Set[int] = set()                         # 已退出但仍留在池中的用户
+        self.matched:OrderedDict[int, array] = OrderedDict()
+        self.lastSync:Optional[datetime] = None
+        self.lastRefresh = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, userId:int, x:int, y:int) -> None:
+        with self.lock:
+            if userId in self.members:
+                return
+            regions = communityRegionKeys(x // COMMUNITY_SIZE, y // COMMUNITY_SIZE)
+            self.members[userId] = regions
+            if userId in self.stale:
+                self.stale.discard(userId)
+                return
+            for key in ('',) + regions:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = self.pools[key] = array('q')
+                pool.append(userId)
+
+    def remove(self, userId:int) -> None:
+        with self.lock:
+            if self.members.pop(userId, None) is None:
+                return
+            self.stale.add(userId)
+            if len(self.stale) * 4 > len(self.members) + len(self.stale):
+                self.compact()
+
+    def compact(self) -> None:
+        '''去掉池中失效的id 调用方持有self.lock'''
+        stale = self.stale
+        self.pools = {key: array('q', (uid for uid in pool if uid not in stale)) for key, pool in self.pools.items()}
+        self.stale = set()
+
+    def refresh(self) -> None:
+        '''拉取上次同步之后修改过matchable的用户 matchable_time上的范围扫描'''
+        now = time.time()
+        if now - self.lastRefresh < REFRESH_INTERVAL:
+            return
+        self.lastRefresh = now
+        queryset = User.objects.exclude(vlocation=None)
+        if self.lastSync is None:
+            queryset = queryset.filter(matchable=True)
+        else:
+            queryset = queryset.filter(matchable_time__gte=self.lastSync - REFRESH_OVERLAP)
+        self.lastSync = Tools.getNow('datetime')
+        for db in Shards.databases():
+            rows = queryset.using(db).values_list('id', 'matchable', 'vlocation__position_x', 'vlocation__position_y')
+            for userId, matchable, x, y in rows.iterator(chunk_size=20000):
+                if matchable:
+                    self.add(userId, x, y)
+                else:
+                    self.remove(userId)
+
+    ##############################################
+
+    def matchedIds(self, userId:int) -> array:
+        '''userId匹配过的用户id 有序'''
+        with self.lock:
+            ids = self.matched.get(userId)
+            if ids is not None:
+                self.matched.move_to_end(userId)
+                return ids
+        ids = array('q', MatchPair.objects.filter(user_id=userId).order_by('partner_id')
+                                           .values_list('partner_id', flat=True))
+        with self.lock:
+            self.matched[userId] = ids
+            if len(self.matched) > MATCHED_CACHE_SIZE:
+                self.matched.popitem(last=False)
+        return ids
+
+    def recordMatched(self, userId:int, partnerId:int) -> None:
+        with self.lock:
+            ids = self.matched.get(userId)
+            if ids is not None:
+                i = bisect.bisect_left(ids, partnerId)
+                if i == len(ids) or ids[i] != partnerId:
+                    ids.insert(i, partnerId)
+
+    def sample(self, key:str, userId:int, excluded:array) -> Optional[int]:
+        '''从key地区的池中随机取一个可匹配的用户 不是自己也不在excluded中'''
+        def available(uid:int) -> bool:
+            if uid == userId or uid not in self.members:
+                return False
+            i = bisect.bisect_left(excluded, uid)
+            return i == len(excluded) or excluded[i] != uid
+
+        pool = self.pools.get(key)
+        if not pool:
+            return None
+        for _ in range(SAMPLE_TRIES):
+            uid = pool[random.randrange(len(pool))]
+            if available(uid):
+                return uid
+        # 池中大部分都不可用 只有池很小或几乎匹配遍了才会走到这里
+        candidates = [uid for uid in pool if available(uid)]
+        return random.choice(candidates) if candidates else None
+
+    def match(self, user:User, scope:str) -> Optional[User]:
+        '''为user在scope范围内匹配一个没有匹配过的笔友 并记录这一对'''
+        self.refresh()
+        vloc = user.vlocation
+        key = '' if scope == 'world' else vloc.getRegionKeys()[REGION_LEVELS.index(scope)]
+        excluded = self.matchedIds(user.id)
+        for _ in range(3):
+            partnerId = self.sample(key, user.id, excluded)
+            if partnerId is None:
+                return None
+            try:
+                with transaction.atomic():
+                    MatchPair.objects.bulk_create([MatchPair(user_id=user.id, partner_id=partnerId),
+                                                   MatchPair(user_id=partnerId, partner_id=user.id)])
+                created = True
+            except IntegrityError:
+                # 其他进程刚刚匹配了这一对 本进程的缓存已过期
+                created = False
+            self.recordMatched(user.id, partnerId)
+            self.recordMatched(partnerId, user.id)
+            if not created:
+                excluded = self.matchedIds(user.id)
+                continue
+            partner = User.objects.using(Shards.forId(partnerId)).select_related('vlocation').filter(id=partnerId).first()
+            if partner is not None:
+                return partner
+        return None
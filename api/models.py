@@ -1,17 +1,24 @@
 from __future__ import annotations
 from typing import *
 
+import functools
 import random
 
 from django.db import models
 from django.core import cache
 from . import secret_infos
 
+from .compression import CompressedTextField
 from .data import LocationName
-from .logic import RSESSION_CACHE_EXP, GlobalVars, Tools
+from .logic import RSESSION_CACHE_EXP, TOKEN_ACCESS_SCOPE, GlobalVars, Tools
+from .revocation import TokenRevocation
+from .sharding import Shards
 
 # Create your models here.
 
+REGION_LEVELS = ('city', 'block', 'community') # 地区层级 与VirtualLocation.getRegionKeys对应
+
+
 class VirtualLocation(models.Model):
     position_x = models.IntegerField() # 虚拟地址x坐标
     position_y = models.IntegerField() # 虚拟地址y坐标
@@ -68,6 +75,13 @@ class VirtualLocation(models.Model):
         city_id, block_id, community_id, _, _ = self.getAddressInfo()
         return '%d%s'%(10+city_id, str(block_id*16+community_id).zfill(4))
     
+    def getRegionKeys(self) -> Tuple[str,str,str]:
+        '''所在城市、市区、小区的地区键 形如 ('3', '3-5', '3-5-12') 与REGION_LEVELS对应'''
+        city_id, block_id, community_id, _, _ = self.getAddressInfo()
+        city = str(city_id)
+        block = '%s-%d' % (city, block_id)
+        return (city, block, '%s-%d' % (block, community_id))
+    
     @staticmethod
     def createLocationByPos(pos:Tuple[int, int]) -> VirtualLocation:
         '''从pos创建location
@@ -113,15 +127,37 @@ class VirtualLocation(models.Model):
         randi = random.randint(0, len(GlobalVars.getInstance().availableLocations)-1)
         return GlobalVars.getInstance().availableLocations.pop(randi)
 
+    @staticmethod
+    def getRandomPositions(count:int) -> List[Tuple[int,int]]:
+        '''批量获取count个随机的可用坐标 与最后一个交换后弹出 每个O(1) 可用坐标不足时返回全部'''
+        locations = GlobalVars.getInstance().availableLocations
+        positions = []
+        for _ in range(min(count, len(locations))):
+            randi = random.randrange(len(locations))
+            locations[randi], locations[-1] = locations[-1], locations[randi]
+            positions.append(locations.pop())
+        return positions
+
+
+COMMUNITY_SIZE = 40 # 小区格子的边长 与getAddressInfo一致 按小区汇总（统计、匹配、地图）时用坐标整除此值
+
+
+@functools.lru_cache(maxsize=None)
+def communityRegionKeys(cx:int, cy:int) -> Tuple[str,str,str]:
+    '''小区格子(x//COMMUNITY_SIZE, y//COMMUNITY_SIZE)的地区键 全世界只有48*48个小区 按格子缓存'''
+    return VirtualLocation(position_x=cx*COMMUNITY_SIZE, position_y=cy*COMMUNITY_SIZE).getRegionKeys()
+
 
 class User(models.Model):
     username = models.CharField(max_length=30, unique=True) # 用户名 唯一
-    password_hash = models.CharField(max_length=64) # 密码的哈希值（64位16进制小写字符串）
+    password_hash = models.CharField(max_length=128) # 密码的哈希值 见api/passwords.py（旧格式为64位16进制小写字符串）
     nickname = models.CharField(max_length=30, null=True) # 昵称
     reg_date = models.DateTimeField(auto_now_add=True) # 注册时间
-    exp = models.BigIntegerField(default=0) # 经验值
+    exp = models.BigIntegerField(default=0, db_index=True) # 经验值 由ExpLedger缓冲写入 索引用于排行榜
     vlocation = models.ForeignKey(VirtualLocation, null=True, on_delete=models.SET_NULL) # 虚拟地址
     session = models.CharField(max_length=64, null=True) # refresh会话码
+    matchable = models.BooleanField(default=False) # 愿意被随机匹配为笔友？
+    matchable_time = models.DateTimeField(null=True, db_index=True) # 上次修改matchable的时间 匹配池据此增量同步
     
     def createSession(self, createTime:int) -> str:
         username = self.username
@@ -132,12 +168,20 @@ class User(models.Model):
         rsessionCache.set(username, sessionCode, RSESSION_CACHE_EXP)
         
         self.session = sessionCode
-        self.save()
+        self.save(update_fields=['session'])
         
         return sessionCode
     
     @staticmethod
     def verifySession(username:str, sessionCode:str) -> bool:
+        # 已吊销的会话 其他进程的缓存中可能还有
+        try:
+            createTime = int(sessionCode.rsplit(':', 1)[1])
+        except (IndexError, ValueError):
+            return False
+        if TokenRevocation.getInstance().isSessionRevoked(username, createTime):
+            return False
+
         rsessionCache = cache.caches['rsession']
         rightSessionCode = rsessionCache.get(username, '!NOCACHE!')
         if rightSessionCode != '!NOCACHE!':
@@ -145,9 +189,19 @@ class User(models.Model):
             return sessionCode == rightSessionCode
         
         # 未找到 查表
-        user = User.objects.get(username=username)
+        user = User.getUserByUsername(username)
+        if user is None:
+            return False
         rightSessionCode = user.session
         return sessionCode == rightSessionCode and rightSessionCode is not None
+
+    @staticmethod
+    def endSession(username:str) -> None:
+        '''结束refresh会话 本进程的缓存直接删除 其他进程缓存的会话由TokenRevocation拒绝'''
+        cache.caches['rsession'].delete(username)
+        db = Shards.forUsername(username)
+        if db is not None:
+            User.objects.using(db).filter(username=username).update(session=None)
     
     @staticmethod
     def createToken(username:str, signtime:int, duration:int, scope:str) -> str:
@@ -231,6 +285,13 @@ class User(models.Model):
                 'success': False,
                 'reason': 'EXPIRATION'
             }
+
+        # 最后检查是否已被吊销 只查共享内存中的吊销表
+        if TokenRevocation.getInstance().isTokenRevoked(username, signtime, payloadDict.get('random')):
+            return {
+                'success': False,
+                'reason': 'REVOKED'
+            }
         
         return {
             'success': True,
@@ -243,17 +304,40 @@ class User(models.Model):
                 'payload': {
                     'username': username,
                     'signtime': signtime,
-                    'expiration': expiration
+                    'expiration': expiration,
+                    'random': payloadDict.get('random')
                 }
             }
         }
 
+    @staticmethod
+    def getUserByToken(token:str, opScope:str=TOKEN_ACCESS_SCOPE) -> Optional[User]:
+        '''验证access token并返回其对应的用户 token无效或用户不存在时返回None'''
+        tokenInfo = User.analyzeToken(token, opScope)
+        if not tokenInfo['success']:
+            return None
+        return User.getUserByUsername(tokenInfo['data']['payload']['username'])
+
+    @staticmethod
+    def getUserByUsername(username:str) -> Optional[User]:
+        '''按用户名取用户 分片时先查用户所在的分片 不存在时返回None'''
+        db = Shards.forUsername(username)
+        if db is None:
+            return None
+        try:
+            return User.objects.using(db).get(username=username)
+        except User.DoesNotExist:
+            return None
 
     @staticmethod
     def searchUserByLocation(city_name:str, block_name:str, community_name:str, 
                              building_index:int, room_index:int) -> Optional[User]:
+        # 收信地址所在城市的分片
+        db = Shards.forCityName(city_name)
+        if db is None:
+            return None
         try:
-            user = User.objects.get(vlocation__city_name = city_name,
+            user = User.objects.using(db).get(vlocation__city_name = city_name,
                                     vlocation__block_name = block_name,
                                     vlocation__community_name = community_name,
                                     vlocation__building_index = building_index,
@@ -267,8 +351,95 @@ class Letter(models.Model):
     # 信件
     receiver = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="receiver") # 收信人
     receiver_alias = models.CharField(max_length=30) # 写信人给出的收信人姓名 可能和收信人nickname不一致
-    sender = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="sender") # 寄信人
+    # 寄信人 分片时可能在另一个数据库中 因此不建外键约束 见api/sharding.py
+    sender = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="sender", db_constraint=False)
     has_read = models.BooleanField(default=False) # 已读？
     send_time = models.DateTimeField(auto_now_add=True) # 发出时间
     recv_time = models.DateTimeField() # 接收时间 根据二者虚拟距离计算得出
-    content = models.TextField() # 信件正文
\ No newline at end of file
+    content = CompressedTextField() # 信件正文 压缩存储
+
+    class Meta:
+        indexes = [
+            # 收件箱按(到达时间, id)做keyset分页
+            models.Index(fields=['receiver', 'recv_time', 'id'], name='letter_inbox_idx'),
+            # 发件箱按(发出时间, id)做keyset分页
+            models.Index(fields=['sender', 'send_time', 'id'], name='letter_outbox_idx'),
+            # 投递调度器按到达时间做范围扫描
+            models.Index(fields=['recv_time', 'id'], name='letter_delivery_idx'),
+        ]
+
+
+class DeliveryWatermark(models.Model):
+    # 投递调度器的进度 只有一行 此时间点之前到达的信件均已投递
+    delivered_until = models.DateTimeField()
+    generation = models.IntegerField(default=0) # 到达时间被批量重算的次数 变化时各进程的调度器重新加载
+
+
+class CompressionDictionary(models.Model):
+    # 信件正文压缩用的共享字典 已压缩的内容引用字典id 因此不能删除
+    data = models.BinaryField()
+    sample_count = models.IntegerField() # 训练样本数
+    created_time = models.DateTimeField(auto_now_add=True)
+
+
+class Bulletin(models.Model):
+    # 地区公告 每条只存一份 读收件箱时合并进该地区每个居民的收件箱
+    sender = models.ForeignKey(User, null=True, on_delete=models.SET_NULL, related_name="bulletins") # 发布人
+    region = models.CharField(max_length=16) # 目标地区 见VirtualLocation.getRegionKeys
+    send_time = models.DateTimeField(auto_now_add=True) # 发出时间
+    recv_time = models.DateTimeField() # 到达时间 按发布人到地区中心的距离计算
+    content = CompressedTextField() # 正文 压缩存储
+
+    class Meta:
+        indexes = [
+            # 收件箱按(地区, 到达时间, id)合并公告
+            models.Index(fields=['region', 'recv_time', 'id'], name='bulletin_region_idx'),
+        ]
+
+
+class BulletinRead(models.Model):
+    # 公告的已读标记 居民读过的每条公告一行
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    bulletin = models.ForeignKey(Bulletin, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'bulletin'], name='bulletin_read_unique'),
+        ]
+
+
+class MatchPair(models.Model):
+    # 已匹配过的笔友 每次匹配写入两行（双方各一行） 查某人匹配过谁只需一次索引范围扫描
+    # MatchPair在default中 分片时用户在各分片中 不建外键约束
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="matches", db_constraint=False)
+    partner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+", db_constraint=False)
+    match_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'partner'], name='match_pair_unique'),
+        ]
+
+
+class RegionStat(models.Model):
+    # 各地区每天的统计 注册和寄信时增量更新 见api/stats.py
+    region = models.CharField(max_length=16) # 地区键 见VirtualLocation.getRegionKeys
+    level = models.SmallIntegerField() # REGION_LEVELS中的下标
+    bucket = models.DateField() # 日期
+    residents = models.IntegerField(default=0) # 当天新入住的居民
+    letters_sent = models.IntegerField(default=0) # 当天从该地区寄出的信件
+    letters_received = models.IntegerField(default=0) # 当天到达该地区的信件（按到达时间）
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['region', 'bucket'], name='region_stat_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['level', 'bucket'], name='region_stat_level_idx'),
+        ]
+
+
+class UserShard(models.Model):
+    # 分片时的用户名目录 只在default中 保证用户名全局唯一 按用户名查询时据此找到分片 见api/sharding.py
+    username = models.CharField(max_length=30, unique=True)
+    shard = models.SmallIntegerField() # settings.SHARD_DATABASES中的下标
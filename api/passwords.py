@@ -0,0 +1,230 @@
+from __future__ import annotations
+from typing import *
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+
+from .logic import PASSWORD_SALT, Tools
+
+
+logger = logging.getLogger(__name__)
+
+# 默认配置 可在settings.PASSWORD_HASHING中覆盖
+DEFAULT_PASSWORD_CONFIG:Dict[str,Any] = {
+    'N': 1 << 14,               # scrypt的代价参数 每次计算占用128*N*R字节内存（默认16MB）
+    'R': 8,
+    'P': 1,
+    'WORKERS': os.cpu_count() or 1, # 同时计算的数量
+    'MAX_PENDING': 64,          # 排队和计算中的请求上限 超过时立即拒绝
+    'TIMEOUT': 5,               # 秒 排队加计算的最长等待时间
+}
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+LEGACY_HASH_LENGTH = 64         # 旧格式: SHA256(密码+PASSWORD_SALT)的16进制
+WARNING_INTERVAL = 10           # 秒 队列已满的警告日志最多这么久一条
+
+
+def passwordConfig() -> Dict[str,Any]:
+    config = dict(DEFAULT_PASSWORD_CONFIG)
+    config.update(getattr(settings, 'PASSWORD_HASHING', {}))
+    return config
+
+
+def b64encode(data:bytes) -> str:
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def b64decode(text:str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordServiceBusy(Exception):
+    '''排队的请求已满或等待超时'''
+
+
+class PasswordService:
+    '''
+    密码哈希服务
+
+    密码用scrypt计算 格式为 scrypt$N$R$P$盐$哈希（base64） PASSWORD_SALT仍拼在密码后作为全局的pepper
+    一次计算约几十毫秒、十几MB内存 在有界的线程池中进行（hashlib.scrypt计算时释放GIL）:
+    同时计算的不超过WORKERS个 排队和计算中的不超过MAX_PENDING个 超过或等待超过TIMEOUT时抛出PasswordServiceBusy
+    突发的登录请求因此只会排队或被快速拒绝 不会让所有请求线程同时卡在哈希上、耗尽内存
+
+    旧格式的哈希（64位16进制的SHA256）仍可验证 验证通过时返回scrypt的新哈希 由调用方写回
+    N/R/P调整后 旧参数的哈希同样在登录时重新计算
+    metrics()返回排队和计算的统计
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> PasswordService:
+        if PasswordService.INSTANCE is None:
+            with PasswordService.LOCK:
+                if PasswordService.INSTANCE is None:
+                    PasswordService.INSTANCE = PasswordService(passwordConfig())
+        return PasswordService.INSTANCE
+
+    ##############################################
+
+    def __init__(self, config:Dict[str,Any]):
+        self.config = config
+        self.executor = ThreadPoolExecutor(max_workers=config['WORKERS'], thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(config['MAX_PENDING'])
+        self.lock = threading.Lock()
+        self.lastWarning = 0.0
+        self.counters:Dict[str,Any] = {
+            'submitted': 0,         # 进入队列的计算
+            'rejected': 0,          # 队列已满被拒绝
+            'timeouts': 0,          # 等待超时
+            'completed': 0,
+            'pending': 0,           # 排队和计算中
+            'running': 0,           # 计算中
+            'max_pending': 0,
+            'wait_seconds': 0.0,    # 累计排队时间
+            'run_seconds': 0.0,     # 累计计算时间
+            'legacy_verified': 0,   # 验证通过的旧格式哈希
+            'rehashed': 0,          # 验证通过后重新计算的哈希
+        }
+
+    def count(self, name:str, n:Union[int,float]=1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def metrics(self) -> Dict[str,Any]:
+        with self.lock:
+            metrics = dict(self.counters)
+        done = max(metrics['completed'], 1)
+        metrics['avg_wait_ms'] = metrics['wait_seconds'] / done * 1000
+        metrics['avg_run_ms'] = metrics['run_seconds'] / done * 1000
+        metrics['workers'] = self.config['WORKERS']
+        return metrics
+
+    ##############################################
+    # 哈希计算 不经过线程池 可在任意线程或进程中调用（import_users的进程池）
+
+    @staticmethod
+    def derive(password:str, salt:bytes, n:int, r:int, p:int) -> bytes:
+        return hashlib.scrypt((password + PASSWORD_SALT).encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256*n*r*p, dklen=KEY_BYTES)
+
+    @staticmethod
+    def computeHash(password:str) -> str:
+        '''按当前配置计算新的哈希'''
+        config = passwordConfig()
+        salt = os.urandom(SALT_BYTES)
+        key = PasswordService.derive(password, salt, config['N'], config['R'], config['P'])
+        return 'scrypt$%d$%d$%d$%s$%s' % (config['N'], config['R'], config['P'], b64encode(salt), b64encode(key))
+
+    @staticmethod
+    def parseHash(passwordHash:str) -> Optional[Tuple[int,int,int,bytes,bytes]]:
+        '''scrypt格式的哈希 -> (N, R, P, 盐, 哈希) 其他格式返回None'''
+        parts = passwordHash.split('$')
+        if len(parts) != 6 or parts[0] != 'scrypt':
+            return None
+        try:
+            return int(parts[1]), int(parts[2]), int(parts[3]), b64decode(parts[4]), b64decode(parts[5])
+        except ValueError:
+            return None
+
+    @staticmethod
+    def isLegacy(passwordHash:str) -> bool:
+        return len(passwordHash) == LEGACY_HASH_LENGTH and '$' not in passwordHash
+
+    @staticmethod
+    def checkHash(password:str, passwordHash:str) -> bool:
+        '''密码是否与哈希一致 旧格式和scrypt格式都可以'''
+        if PasswordService.isLegacy(passwordHash):
+            return hmac.compare_digest(passwordHash, Tools.getPasswordHash(password))
+        parsed = PasswordService.parseHash(passwordHash)
+        if parsed is None:
+            return False
+        n, r, p, salt, key = parsed
+        return hmac.compare_digest(key, PasswordService.derive(password, salt, n, r, p))
+
+    def isCurrent(self, passwordHash:str) -> bool:
+        '''是否为当前配置下的scrypt哈希'''
+        parsed = PasswordService.parseHash(passwordHash)
+        return parsed is not None and parsed[:3] == (self.config['N'], self.config['R'], self.config['P'])
+
+    ##############################################
+    # 经过线程池
+
+    def run(self, func:Callable, *args) -> Any:
+        '''在线程池中执行func 队列已满或超时时抛出PasswordServiceBusy'''
+        if not self.slots.acquire(blocking=False):
+            self.count('rejected')
+            now = time.monotonic()
+            if now - self.lastWarning > WARNING_INTERVAL:
+                self.lastWarning = now
+                logger.warning('password service queue is full: %s', self.metrics())
+            raise PasswordServiceBusy()
+        with self.lock:
+            self.counters['submitted'] += 1
+            self.counters['pending'] += 1
+            self.counters['max_pending'] = max(self.counters['max_pending'], self.counters['pending'])
+        submitTime = time.perf_counter()
+
+        def task():
+            startTime = time.perf_counter()
+            with self.lock:
+                self.counters['running'] += 1
+                self.counters['wait_seconds'] += startTime - submitTime
+            try:
+                return func(*args)
+            finally:
+                with self.lock:
+                    self.counters['running'] -= 1
+                    self.counters['run_seconds'] += time.perf_counter() - startTime
+                    self.counters['completed'] += 1
+
+        def release(_):
+            # 完成或被取消时归还名额
+            with self.lock:
+                self.counters['pending'] -= 1
+            self.slots.release()
+
+        future = self.executor.submit(task)
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=self.config['TIMEOUT'])
+        except TimeoutError:
+            # 还在排队的直接取消 已开始计算的算完后丢弃
+            future.cancel()
+            self.count('timeouts')
+            raise PasswordServiceBusy()
+
+    def hash(self, password:str) -> str:
+        return self.run(PasswordService.computeHash, password)
+
+    def verify(self, password:str, passwordHash:str) -> Tuple[bool, Optional[str]]:
+        '''
+        验证密码 返回(是否正确, 新哈希)
+        旧格式或旧参数的哈希验证通过时新哈希为重新计算的结果 调用方应写回 否则为None
+        重新计算时队列已满则这次不升级 下次登录再试
+        '''
+        if PasswordService.isLegacy(passwordHash):
+            # 旧格式只需一次SHA256 不必排队
+            if not PasswordService.checkHash(password, passwordHash):
+                return False, None
+            self.count('legacy_verified')
+        elif not self.run(PasswordService.checkHash, password, passwordHash):
+            return False, None
+        elif self.isCurrent(passwordHash):
+            return True, None
+
+        try:
+            newHash = self.hash(password)
+        except PasswordServiceBusy:
+            return True, None
+        self.count('rehashed')
+        return True, newHash
@@ -0,0 +1,115 @@
+from __future__ import annotations
+from typing import *
+
+import logging
+
+from django.conf import settings
+from django.core import cache
+from django.core.cache.backends.locmem import LocMemCache
+
+from .models import User, VirtualLocation
+from .sharding import Shards
+
+
+PROFILE_VERSION = 1             # 缓存项的格式版本 修改profileEntry的格式时加一 旧格式的缓存项自然失效
+PROFILE_CACHE_EXP = 86400       # 资料缓存的有效期
+PROFILE_MISS_EXP = 300          # 不存在的用户名也缓存 避免反复查库 注册时删除
+PROFILE_FIELDS = frozenset(('username', 'nickname', 'exp', 'reg_date', 'vlocation')) # 资料依赖的User字段
+PROFILE_ROW = ('username', 'nickname', 'exp', 'reg_date', 'vlocation__position_x', 'vlocation__position_y',
+               'vlocation__city_name', 'vlocation__block_name', 'vlocation__community_name',
+               'vlocation__building_index', 'vlocation__room_index')
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    '''
+    用户资料的只读模型 用于展示寄信人、收信人等
+
+    每个用户一个缓存项 为预先算好地址和邮编的元组 (昵称, 完整地址, 邮编, 经验值, 注册时间戳)
+    缓存键带有PROFILE_VERSION 格式变化时不需要清空缓存
+    getProfiles一次批量读取缓存 未命中的用户合并为一次数据库查询（分片时每个分片一次） 查不到的用户名缓存为空元组
+    昵称、经验值、地址变化时删除缓存项: 经save保存的由post_save信号处理（只写session等无关字段的不处理）
+    用update等不触发信号的方式修改时 调用方需要自行invalidate
+    删除只作用于CACHES['profile'] 多进程部署时必须是共享缓存（见settings） 否则其他进程在过期前一直返回旧资料
+    '''
+    @staticmethod
+    def getCache():
+        return cache.caches['profile']
+
+    @staticmethod
+    def isProcessLocal() -> bool:
+        return isinstance(ProfileCache.getCache(), LocMemCache)
+
+    @staticmethod
+    def checkBackend() -> None:
+        '''启动时调用 非DEBUG下资料缓存只在进程内时警告'''
+        if not settings.DEBUG and ProfileCache.isProcessLocal():
+            logger.warning("CACHES['profile'] is a per-process LocMemCache, profile changes only invalidate the "
+                           "worker that made them; set MYLETTER_MEMCACHED to share it")
+
+    @staticmethod
+    def cacheKey(username:str) -> str:
+        return 'profile:' + username
+
+    @staticmethod
+    def profileEntry(row:Tuple) -> Tuple:
+        '''PROFILE_ROW顺序的一行 -> 缓存项'''
+        username, nickname, exp, regDate, x, y = row[:6]
+        address, postcode = None, None
+        if x is not None:
+            # 只为复用地址和邮编的计算 不写入数据库
+            vloc = VirtualLocation(position_x=x, position_y=y, city_name=row[6], block_name=row[7],
+                                   community_name=row[8], building_index=row[9], room_index=row[10])
+            address, postcode = vloc.getFullAddress(), vloc.getPostCode()
+        return (nickname, address, postcode, exp, regDate.timestamp())
+
+    @staticmethod
+    def profileDict(username:str, entry:Tuple) -> Dict:
+        return {
+            'username': username,
+            'nickname': entry[0],
+            'address': entry[1],
+            'postcode': entry[2],
+            'exp': entry[3],
+            'reg_date': entry[4],
+        }
+
+    @staticmethod
+    def getProfiles(usernames:Iterable[str]) -> Dict[str, Dict]:
+        '''批量获取资料 返回{用户名: 资料} 不存在的用户不出现在结果中'''
+        usernames = set(u for u in usernames if u)
+        if not usernames:
+            return {}
+        profileCache = ProfileCache.getCache()
+        keys = {ProfileCache.cacheKey(u): u for u in usernames}
+        found = profileCache.get_many(keys, version=PROFILE_VERSION)
+        entries = {keys[key]: entry for key, entry in found.items()}
+
+        missing = usernames - entries.keys()
+        if missing:
+            loaded = {}
+            for db, names in Shards.groupUsernames(missing).items():
+                loaded.update((row[0], ProfileCache.profileEntry(row))
+                              for row in User.objects.using(db).filter(username__in=names).values_list(*PROFILE_ROW))
+            profileCache.set_many({ProfileCache.cacheKey(u): entry for u, entry in loaded.items()},
+                                  PROFILE_CACHE_EXP, version=PROFILE_VERSION)
+            profileCache.set_many({ProfileCache.cacheKey(u): () for u in missing - loaded.keys()},
+                                  PROFILE_MISS_EXP, version=PROFILE_VERSION)
+            entries.update(loaded)
+        return {u: ProfileCache.profileDict(u, entry) for u, entry in entries.items() if entry}
+
+    @staticmethod
+    def getProfile(username:str) -> Optional[Dict]:
+        return ProfileCache.getProfiles([username]).get(username)
+
+    @staticmethod
+    def invalidate(usernames:Iterable[str]) -> None:
+        ProfileCache.getCache().delete_many([ProfileCache.cacheKey(u) for u in usernames], version=PROFILE_VERSION)
+
+    @staticmethod
+    def onUserSaved(sender, instance:User, created:bool, update_fields=None, **kwargs) -> None:
+        '''post_save 新用户删除的是“不存在”的缓存项'''
+        if created or update_fields is None or PROFILE_FIELDS.intersection(update_fields):
+            ProfileCache.invalidate([instance.username])
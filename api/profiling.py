@@ -0,0 +1,142 @@
+from __future__ import annotations
+from typing import *
+
+import cProfile
+import functools
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+
+
+# 默认配置 可在settings.API_PROFILING中覆盖其中任意项
+DEFAULT_PROFILING_CONFIG:Dict[str,Any] = {
+    'ENABLED': False,           # 总开关 关闭时不对view做任何包装
+    'SAMPLE_RATE': 0.0,         # 随机采样率 0~1
+    'HEADER': 'HTTP_X_MYLETTER_PROFILE', # 触发profile的请求头（request.META中的键名）
+    'HEADER_TOKEN': None,       # 请求头需携带的口令 为None时不接受请求头触发
+    'DIR': 'profiles',          # 输出目录 相对路径相对于BASE_DIR
+    'MAX_FILES': 200,           # 目录中最多保留的profile数 超出时删除最旧的
+    'TRACEMALLOC': False,       # 是否同时记录tracemalloc快照
+    'TRACEMALLOC_TOP': 30,      # tracemalloc报告中保留的条目数
+}
+
+
+class RequestProfiler:
+    '''
+    APIInterface的按请求profile工具
+
+    settings.API_PROFILING['ENABLED']为False时 wrapView直接返回原view 没有任何额外开销
+    开启后 请求被采样命中 或携带了正确的profile请求头时 记录该请求的cProfile数据
+    （以及可选的tracemalloc快照） 写入输出目录 文件名包含时间、接口名和耗时
+    '''
+    INSTANCE = None
+    @staticmethod
+    def getInstance() -> RequestProfiler:
+        if RequestProfiler.INSTANCE is None:
+            RequestProfiler.INSTANCE = RequestProfiler()
+        return RequestProfiler.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.config = dict(DEFAULT_PROFILING_CONFIG)
+        self.config.update(getattr(settings, 'API_PROFILING', {}))
+        outdir = Path(self.config['DIR'])
+        if not outdir.is_absolute():
+            outdir = Path(settings.BASE_DIR) / outdir
+        self.outdir = outdir
+        # cProfile和tracemalloc都是进程级的 同一时刻只profile一个请求
+        # 已有请求在profile时 其余命中的请求直接跳过
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def isEnabled() -> bool:
+        return bool(getattr(settings, 'API_PROFILING', {}).get('ENABLED', False))
+
+    @staticmethod
+    def wrapView(view:Callable, name:str) -> Callable:
+        '''为view包装profile逻辑 未开启时原样返回'''
+        if not RequestProfiler.isEnabled():
+            return view
+        profiler = RequestProfiler.getInstance()
+
+        @functools.wraps(view)
+        def profiledView(request, *args, **kwargs):
+            if not profiler.shouldProfile(request) or not profiler.lock.acquire(blocking=False):
+                return view(request, *args, **kwargs)
+            try:
+                return profiler.profileCall(name, view, request, *args, **kwargs)
+            finally:
+                profiler.lock.release()
+
+        return profiledView
+
+    def shouldProfile(self, request) -> bool:
+        token = self.config['HEADER_TOKEN']
+        if token is not None and request.META.get(self.config['HEADER']) == token:
+            return True
+        rate = self.config['SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def profileCall(self, name:str, view:Callable, request, *args, **kwargs):
+        traceMem = self.config['TRACEMALLOC'] and not tracemalloc.is_tracing()
+        if traceMem:
+            tracemalloc.start()
+        prof = cProfile.Profile()
+        startTime = time.perf_counter()
+        try:
+            return prof.runcall(view, request, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - startTime
+            snapshot = None
+            if traceMem:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            try:
+                self.dump(name, request, elapsed, prof, snapshot)
+            except OSError:
+                # 写profile失败不应影响请求本身
+                pass
+
+    def dump(self, name:str, request, elapsed:float, prof:cProfile.Profile,
+             snapshot:Optional[tracemalloc.Snapshot]) -> None:
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        basename = '%s_%s_%dms' % (datetime.now().strftime('%Y%m%d-%H%M%S-%f'), name, int(elapsed*1000))
+        prof.dump_stats(str(self.outdir / (basename + '.prof')))
+
+        if snapshot is not None:
+            stats = snapshot.statistics('lineno')
+            buffer = StringIO()
+            buffer.write('%s %s %s %.3fms\n' % (name, request.method, request.path, elapsed*1000))
+            buffer.write('total traced: %d bytes\n\n' % sum(stat.size for stat in stats))
+            for stat in stats[:self.config['TRACEMALLOC_TOP']]:
+                buffer.write(str(stat) + '\n')
+            with open(self.outdir / (basename + '.mem.txt'), 'w', encoding='utf-8') as f:
+                f.write(buffer.getvalue())
+
+        self.rotate()
+
+    def rotate(self) -> None:
+        '''只保留最新的MAX_FILES个profile 连同其内存快照一并删除'''
+        profs = sorted(self.outdir.glob('*.prof'))
+        for old in profs[:max(0, len(profs) - self.config['MAX_FILES'])]:
+            for path in (old, old.with_suffix('.mem.txt')):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def summary(path:str, sortby:str='cumulative', limit:int=30) -> str:
+        '''把.prof文件渲染为文本报告 便于在服务器上直接查看'''
+        buffer = StringIO()
+        pstats.Stats(path, stream=buffer).sort_stats(sortby).print_stats(limit)
+        return buffer.getvalue()
@@ -0,0 +1,271 @@
+from __future__ import annotations
+from typing import *
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qs
+
+from .logic import TOKEN_ACCESS_SCOPE, JsonResponse
+
+
+PUSH_WS_PATH = '/myletter/api/push/ws/'
+PUSH_POLL_PATH = '/myletter/api/push/poll/'
+PUSH_QUEUE_SIZE = 64        # 每个连接最多缓存的未发送消息 满了之后丢弃新消息 客户端可重新拉取收件箱
+PUSH_HEARTBEAT = 30         # websocket空闲时发送心跳的间隔（秒）
+POLL_TIMEOUT_MAX = 60       # 长轮询最长等待时间（秒）
+PUSH_RECENT_TTL = 2*POLL_TIMEOUT_MAX # 每个用户最近的消息保留的时间（秒） 两次长轮询之间到达的消息由此补发
+PUSH_SWEEP_INTERVAL = 60    # 清理过期的最近消息的间隔（秒）
+
+
+def cursorOf(message:Dict) -> Tuple[float,int]:
+    '''消息的游标 (到达时间, 信件id) 各进程的投递调度器都按到达时间投递 因此游标在进程之间通用'''
+    return (message['recv_time'], message['letter_id'])
+
+
+def formatCursor(cursor:Tuple[float,int]) -> str:
+    # repr可以精确还原浮点数
+    return '%r_%d' % cursor
+
+
+def parseCursor(text:str) -> Optional[Tuple[float,int]]:
+    try:
+        recvTime, letterId = text.split('_')
+        return (float(recvTime), int(letterId))
+    except ValueError:
+        return None
+
+
+class PushConnection:
+    '''一个推送连接 只保存用户名和消息队列 大量空闲连接时内存占用很小'''
+    __slots__ = ('username', 'queue')
+
+    def __init__(self, username:str):
+        self.username = username
+        self.queue:asyncio.Queue = asyncio.Queue(PUSH_QUEUE_SIZE)
+
+
+class PushHub:
+    '''
+    进程内的推送分发中心
+
+    连接注册表为 用户名 -> 连接集合 所有连接属于同一个事件循环
+    DeliveryScheduler在自己的线程中调用onDeliver 通过call_soon_threadsafe把消息投到事件循环
+
+    长轮询在两次请求之间没有连接 因此每个用户还保留最近PUSH_RECENT_TTL秒内的消息（最多PUSH_QUEUE_SIZE条）
+    客户端带上次返回的游标轮询时 先补发游标之后的消息 无法确定是否有遗漏时（游标早于保留范围、消息超出条数）
+    返回reset 客户端应重新拉取收件箱
+    最近消息只在事件循环中读写 不需要加锁
+    '''
+    INSTANCE = None
+    @staticmethod
+    def getInstance() -> PushHub:
+        if PushHub.INSTANCE is None:
+            PushHub.INSTANCE = PushHub()
+        return PushHub.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.connections:Dict[str,Set[PushConnection]] = {}
+        self.loop:Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+        self.recent:Dict[str,deque] = {}                # 用户名 -> (游标, 消息)
+        self.dropped:Dict[str,Tuple[float,int]] = {}    # 用户名 -> 因条数超出而丢弃的最新消息的游标
+        self.startTime = 0.0                            # 开始保留最近消息的时间
+        self.lastCursor:Tuple[float,int] = (0.0, 0)     # 本进程最近投递的消息
+        self.lastSweep = 0.0
+
+    def register(self, conn:PushConnection) -> None:
+        if self.loop is None:
+            self.startTime = time.time()
+        self.loop = asyncio.get_running_loop()
+        with self.lock:
+            self.connections.setdefault(conn.username, set()).add(conn)
+
+    def unregister(self, conn:PushConnection) -> None:
+        with self.lock:
+            conns = self.connections.get(conn.username)
+            if conns is not None:
+                conns.discard(conn)
+                if not conns:
+                    del self.connections[conn.username]
+
+    def connectionCount(self) -> int:
+        with self.lock:
+            return sum(len(conns) for conns in self.connections.values())
+
+    def deliverLocal(self, username:str, message:Dict) -> None:
+        '''在事件循环中执行 记入最近消息 并放入该用户所有连接的队列'''
+        now = time.time()
+        cursor = cursorOf(message)
+        self.lastCursor = max(self.lastCursor, cursor)
+        recent = self.recent.get(username)
+        if recent is None:
+            recent = self.recent[username] = deque()
+        recent.append((cursor, message))
+        if len(recent) > PUSH_QUEUE_SIZE:
+            self.dropped[username] = recent.popleft()[0]
+        if now - self.lastSweep > PUSH_SWEEP_INTERVAL:
+            self.sweep(now)
+        for conn in tuple(self.connections.get(username, ())):
+            try:
+                conn.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+    def sweep(self, now:float) -> None:
+        '''删除超过PUSH_RECENT_TTL的最近消息'''
+        self.lastSweep = now
+        expired = now - PUSH_RECENT_TTL
+        for username in list(self.recent):
+            recent = self.recent[username]
+            while recent and recent[0][1]['recv_time'] < expired:
+                recent.popleft()
+            if not recent:
+                del self.recent[username]
+        for username in [u for u, cursor in self.dropped.items() if cursor[0] < expired]:
+            del self.dropped[username]
+
+    def recentSince(self, username:str, since:Tuple[float,int]) -> Tuple[List[Dict], bool]:
+        '''在事件循环中执行 返回(游标之后的最近消息, 是否可能有遗漏)'''
+        # 游标早于开始保留的时间、之后有消息因条数超出被丢弃、或已超过保留时间且之后又有投递
+        reset = (since[0] < self.startTime or since < self.dropped.get(username, (0.0, 0))
+                 or (since[0] < time.time() - PUSH_RECENT_TTL and since < self.lastCursor))
+        events = [message for cursor, message in self.recent.get(username, ()) if cursor > since]
+        return events, reset
+
+    def publish(self, username:str, message:Dict) -> None:
+        '''可在任意线程调用 还没有任何连接时（如WSGI进程）什么都不做'''
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.deliverLocal, username, message)
+
+    def onDeliver(self, events) -> None:
+        '''投递调度器的listener'''
+        for event in events:
+            if event.receiver_username:
+                self.publish(event.receiver_username, {
+                    'type': 'letter',
+                    'letter_id': event.letter_id,
+                    'recv_time': event.recv_time.timestamp(),
+                })
+
+
+class PushRouter:
+    '''
+    ASGI入口 推送路径由本类直接处理 其余请求交给Django
+
+    websocket: PUSH_WS_PATH?token=<access token>
+        连接建立后服务器推送 {"type": "letter", "letter_id", "recv_time"} 空闲时推送 {"type": "ping"}
+    长轮询: GET PUSH_POLL_PATH?token=<access token>&timeout=<秒>&since=<游标>
+        返回 {"code": 0, "data": {"events": [...], "cursor": 游标, "reset": bool}} 超时时events为空
+        下次轮询时带上返回的cursor 两次轮询之间到达的消息立即返回
+        reset为true时可能有消息遗漏 客户端应重新拉取收件箱 第一次轮询不带since
+    token即access token 与其他接口相同 只在建立连接时验证一次
+    '''
+    def __init__(self, djangoApp):
+        self.djangoApp = djangoApp
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'websocket' and scope['path'] == PUSH_WS_PATH:
+            return await self.websocket(scope, receive, send)
+        if scope['type'] == 'http' and scope['path'] == PUSH_POLL_PATH:
+            return await self.longPoll(scope, receive, send)
+        return await self.djangoApp(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def authenticate(scope) -> Tuple[Optional[str], Dict[str,List[str]]]:
+        '''从query string中取token并验证 返回(用户名, query参数)'''
+        from .models import User
+        query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+        token = query.get('token', [''])[0]
+        tokenInfo = User.analyzeToken(token, TOKEN_ACCESS_SCOPE)
+        if not tokenInfo['success']:
+            return None, query
+        return tokenInfo['data']['payload']['username'], query
+
+    async def websocket(self, scope, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        username, _ = PushRouter.authenticate(scope)
+        if username is None:
+            await send({'type': 'websocket.close', 'code': 4000 + JsonResponse.ERR_TOKEN_ACCESS_DENIED})
+            return
+        await send({'type': 'websocket.accept'})
+
+        hub = PushHub.getInstance()
+        conn = PushConnection(username)
+        hub.register(conn)
+        writer = asyncio.ensure_future(self.websocketWriter(conn, send))
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                # 客户端发来的消息只用作心跳 忽略内容
+        finally:
+            hub.unregister(conn)
+            writer.cancel()
+
+    async def websocketWriter(self, conn:PushConnection, send):
+        while True:
+            try:
+                message = await asyncio.wait_for(conn.queue.get(), PUSH_HEARTBEAT)
+            except asyncio.TimeoutError:
+                message = {'type': 'ping'}
+            await send({'type': 'websocket.send', 'text': json.dumps(message, ensure_ascii=False)})
+
+    async def longPoll(self, scope, receive, send):
+        username, query = PushRouter.authenticate(scope)
+        if username is None:
+            return await self.sendJson(send, {'code': JsonResponse.ERR_TOKEN_ACCESS_DENIED,
+                                              'reason': JsonResponse.ERR_LIST[JsonResponse.ERR_TOKEN_ACCESS_DENIED]})
+        try:
+            timeout = min(POLL_TIMEOUT_MAX, max(0.0, float(query.get('timeout', ['25'])[0])))
+        except ValueError:
+            timeout = None
+        since = parseCursor(query['since'][0]) if 'since' in query else (0.0, 0)
+        if timeout is None or since is None:
+            return await self.sendJson(send, {'code': JsonResponse.ERR_ARGTYPE,
+                                              'reason': JsonResponse.ERR_LIST[JsonResponse.ERR_ARGTYPE]})
+
+        hub = PushHub.getInstance()
+        conn = PushConnection(username)
+        # 先注册再读最近消息 中间没有await 不会漏掉或重复
+        hub.register(conn)
+        events, reset = hub.recentSince(username, since) if 'since' in query else ([], False)
+        try:
+            if not events:
+                events.append(await asyncio.wait_for(conn.queue.get(), timeout))
+                # 同时到达的其他消息一并返回
+                while not conn.queue.empty():
+                    events.append(conn.queue.get_nowait())
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            hub.unregister(conn)
+        # 没有消息时游标推进到本进程最近投递的位置 之后到达的消息不会早于它
+        cursor = max([since, hub.lastCursor, (hub.startTime, 0)] + [cursorOf(event) for event in events])
+        await self.sendJson(send, {'code': 0, 'data': {'events': events, 'cursor': formatCursor(cursor), 'reset': reset}})
+
+    async def sendJson(self, send, obj:Dict):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,235 @@
+from __future__ import annotations
+from typing import *
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from hashlib import blake2b
+from pathlib import Path
+
+from django.conf import settings
+
+from .logic import RSESSION_CACHE_EXP, TOKEN_DURATION, Tools
+
+
+logger = logging.getLogger(__name__)
+
+# 默认配置 可在settings.TOKEN_REVOCATION中覆盖
+DEFAULT_REVOCATION_CONFIG:Dict[str,Any] = {
+    'PATH': Path(settings.BASE_DIR) / 'revocation.bin',
+    'SLOTS': 1 << 18,           # 哈希表的槽数 取2的幂 每槽24字节
+}
+
+MAGIC = b'MLREVOK1'
+HEADER = struct.Struct('<8sQQQQ')   # magic, 槽数, 序号（奇数时正在写入）, 已占用的槽数, 占用达到此数时清理
+HEADER_SIZE = 64
+ENTRY = struct.Struct('<QqQ')       # 键的哈希（0为从未使用）, 过期时间, 值
+SEQ_OFFSET = 16
+USED_OFFSET = 24
+COMPACT_OFFSET = 32
+MAX_LOAD = 0.5                  # 已占用的槽超过此比例时清理过期项 清理后仍超过时 再占用1/8的槽后才再次清理
+READ_RETRIES = 100              # 无锁读取的重试次数 超过后加锁读取（写入的进程可能已经中途退出）
+USER_REVOCATION_TTL = max(TOKEN_DURATION, RSESSION_CACHE_EXP) # 此后吊销前签发的token和会话都已自然失效
+
+
+def revocationConfig() -> Dict[str,Any]:
+    config = dict(DEFAULT_REVOCATION_CONFIG)
+    config.update(getattr(settings, 'TOKEN_REVOCATION', {}))
+    return config
+
+
+class TokenRevocation:
+    '''
+    access token和refresh会话的吊销表 同一台机器上的所有进程共享
+
+    表是映射到内存的文件（mmap） 开放寻址的哈希表 每项为 (键的64位哈希, 过期时间, 值) 三种键:
+        n:<random>      吊销单个access token（token载荷中的random） 过期时间为token的过期时间
+        u:<用户名>      该用户此时刻及以前签发的access token和会话全部失效 值为该时刻
+        s:<用户名>      该用户此时刻及以前创建的会话失效（退出登录） 值为该时刻
+    过期的项视为不存在 吊销表只需要记住尚未自然过期的token 表的大小只与吊销的频率有关
+
+    analyzeToken每次只做两次内存中的查找 不查数据库 不加锁:
+    写入方（吊销很少发生）持有文件锁 写入前后各把头部的序号加一 读取方读到奇数或前后序号不同时重试
+    已占用的槽过半时写入方就地清理过期项 读取方在此期间同样会重试
+
+    只在同一台机器上共享 多机部署时吊销只对收到请求的机器生效
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> TokenRevocation:
+        if TokenRevocation.INSTANCE is None:
+            with TokenRevocation.LOCK:
+                if TokenRevocation.INSTANCE is None:
+                    config = revocationConfig()
+                    TokenRevocation.INSTANCE = TokenRevocation(config['PATH'], config['SLOTS'])
+        return TokenRevocation.INSTANCE
+
+    ##############################################
+
+    def __init__(self, path:Union[str,Path], slots:int):
+        if slots <= 0 or slots & (slots - 1):
+            raise ValueError('TOKEN_REVOCATION SLOTS must be a power of two')
+        self.path = Path(path)
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+        # lockf是进程级的锁 同一进程的线程之间还需要lock
+        self.lock = threading.Lock()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            head = os.pread(self.fd, HEADER.size, 0)
+            if len(head) == HEADER.size and HEADER.unpack(head)[0] == MAGIC:
+                # 已有的表 槽数以文件为准 所有进程一致
+                slots = HEADER.unpack(head)[1]
+            else:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, HEADER_SIZE + slots*ENTRY.size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, 0, 0, int(slots*MAX_LOAD)), 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self.mask = slots - 1
+        self.map = mmap.mmap(self.fd, HEADER_SIZE + slots*ENTRY.size)
+
+    @staticmethod
+    def keyHash(key:str) -> int:
+        # 0表示空槽
+        return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def seq(self) -> int:
+        return struct.unpack_from('<Q', self.map, SEQ_OFFSET)[0]
+
+    ##############################################
+    # 读取
+
+    def probe(self, keyHash:int, now:int) -> Optional[int]:
+        '''未过期的项的值 不存在时返回None'''
+        i = keyHash & self.mask
+        for _ in range(self.slots):
+            key, expires, value = ENTRY.unpack_from(self.map, HEADER_SIZE + i*ENTRY.size)
+            if key == 0:
+                return None
+            if key == keyHash:
+                return value if expires > now else None
+            i = (i + 1) & self.mask
+        return None
+
+    def lookup(self, key:str) -> Optional[int]:
+        keyHash = TokenRevocation.keyHash(key)
+        now = int(Tools.getNow())
+        for _ in range(READ_RETRIES):
+            seq = self.seq()
+            if seq & 1:
+                continue
+            value = self.probe(keyHash, now)
+            if self.seq() == seq:
+                return value
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_SH)
+            try:
+                return self.probe(keyHash, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def notBefore(self, username:str, sessions:bool=False) -> int:
+        '''此时刻及以前签发的token（sessions为True时为会话）已被吊销 没有吊销时为0'''
+        values = [self.lookup('u:' + username) or 0]
+        if sessions:
+            values.append(self.lookup('s:' + username) or 0)
+        return max(values)
+
+    def isTokenRevoked(self, username:str, signtime:int, nonce:Optional[str]) -> bool:
+        if nonce and self.lookup('n:' + nonce) is not None:
+            return True
+        return signtime <= self.notBefore(username)
+
+    def isSessionRevoked(self, username:str, createTime:int) -> bool:
+        return createTime <= self.notBefore(username, True)
+
+    def issueTime(self, username:str) -> int:
+        '''
+        新token和会话的签发时间 通常为当前时间
+        与吊销在同一秒内签发时推迟一秒 否则会被刚写入的吊销项拒绝
+        '''
+        return max(int(Tools.getNow()), self.notBefore(username, True) + 1)
+
+    ##############################################
+    # 写入
+
+    def revokeToken(self, nonce:str, expiration:int) -> None:
+        '''吊销单个access token 记住到它自然过期为止'''
+        self.put('n:' + nonce, expiration, 0)
+
+    def revokeUser(self, username:str) -> None:
+        '''吊销该用户目前为止签发的全部access token和会话'''
+        now = int(Tools.getNow())
+        self.put('u:' + username, now + USER_REVOCATION_TTL, now)
+
+    def revokeSessions(self, username:str) -> None:
+        '''吊销该用户目前为止创建的会话 其他进程缓存中的会话也随之失效'''
+        now = int(Tools.getNow())
+        self.put('s:' + username, now + RSESSION_CACHE_EXP, now)
+
+    def put(self, key:str, expires:int, value:int) -> None:
+        '''写入一项 已存在时过期时间和值都取较大者'''
+        keyHash = TokenRevocation.keyHash(key)
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                # 上一个写入方可能中途退出 序号停在奇数 从下一个奇数开始
+                seq = self.seq() | 1
+                struct.pack_into('<Q', self.map, SEQ_OFFSET, seq)
+                try:
+                    now = int(Tools.getNow())
+                    used, compactAt = struct.unpack_from('<QQ', self.map, USED_OFFSET)
+                    if used >= compactAt:
+                        self.compact(now)
+                    self.insert(keyHash, expires, value, now)
+                finally:
+                    struct.pack_into('<Q', self.map, SEQ_OFFSET, seq + 1)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def insert(self, keyHash:int, expires:int, value:int, now:int) -> None:
+        '''在写锁中调用 探测到空槽为止 找不到相同的键时优先复用途中第一个过期的槽'''
+        i = keyHash & self.mask
+        reuse = None
+        for _ in range(self.slots):
+            offset = HEADER_SIZE + i*ENTRY.size
+            key, oldExpires, oldValue = ENTRY.unpack_from(self.map, offset)
+            if key == keyHash:
+                if oldExpires <= now:
+                    oldExpires, oldValue = expires, value
+                ENTRY.pack_into(self.map, offset, keyHash, max(expires, oldExpires), max(value, oldValue))
+                return
+            if key == 0:
+                break
+            if reuse is None and oldExpires <= now:
+                reuse = i
+            i = (i + 1) & self.mask
+        else:
+            if reuse is None:
+                raise RuntimeError('token revocation table is full, increase TOKEN_REVOCATION SLOTS')
+        if reuse is None:
+            reuse = i
+            used = struct.unpack_from('<Q', self.map, USED_OFFSET)[0]
+            struct.pack_into('<Q', self.map, USED_OFFSET, used + 1)
+        ENTRY.pack_into(self.map, HEADER_SIZE + reuse*ENTRY.size, keyHash, expires, value)
+
+    def compact(self, now:int) -> None:
+        '''在写锁中调用 清空整个表后重新插入未过期的项 使探测链变短'''
+        live = []
+        for i in range(self.slots):
+            entry = ENTRY.unpack_from(self.map, HEADER_SIZE + i*ENTRY.size)
+            if entry[0] != 0 and entry[1] > now:
+                live.append(entry)
+        self.map[HEADER_SIZE:] = bytes(self.slots*ENTRY.size)
+        struct.pack_into('<Q', self.map, USED_OFFSET, 0)
+        for entry in live:
+            self.insert(*entry, now)
+        compactAt = max(int(self.slots*MAX_LOAD), len(live) + self.slots // 8)
+        struct.pack_into('<Q', self.map, COMPACT_OFFSET, compactAt)
+        if len(live) >= self.slots*MAX_LOAD:
+            logger.warning('token revocation table has %d live entries in %d slots', len(live), self.slots)
@@ -0,0 +1,163 @@
+from __future__ import annotations
+from typing import *
+
+import math
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError: # numpy是可选依赖 只用于批量计算
+    np = None
+
+from .models import COMMUNITY_SIZE
+
+
+# 虚拟世界的网格层级 与VirtualLocation.getAddressInfo一致
+WORLD_SIZE = 1920
+CITY_SIZE = 480         # 4x4个城市
+BLOCK_SIZE = 160        # 每城3x3个市区 每区4x4个小区（COMMUNITY_SIZE）
+COMMUNITY_COUNT = 16 * 9 * 16
+
+# 各级邮路的速度（格/小时）和各级邮局的处理时间（小时）
+LOCAL_SPEED = 40            # 小区内投递 步行
+COMMUNITY_LINK_SPEED = 120  # 小区邮局 <-> 市区枢纽
+BLOCK_LINK_SPEED = 240      # 市区枢纽 <-> 城市枢纽
+CITY_LINK_SPEED = 480       # 城市枢纽之间
+COMMUNITY_HANDLING = 0.5
+BLOCK_HANDLING = 1.0
+CITY_HANDLING = 2.0
+
+
+class PostalRouter:
+    '''
+    信件投递时间计算
+
+    信件从寄信人的小区邮局出发 沿 小区 -> 市区枢纽 -> 城市枢纽 -> 城市枢纽 -> 市区枢纽 -> 小区 的邮路
+    走到两地层级上最近的公共枢纽为止 各级枢纽位于其区域中心
+    任意两个小区之间的转运时间在初始化时预先算好 存为16*9*16阶的方阵（单位分钟）
+    一次投递时间 = 查表得到的转运时间 + 两端在小区内的步行投递时间
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> PostalRouter:
+        if PostalRouter.INSTANCE is None:
+            with PostalRouter.LOCK:
+                if PostalRouter.INSTANCE is None:
+                    PostalRouter.INSTANCE = PostalRouter()
+        return PostalRouter.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.communityCenters:List[Tuple[float,float]] = [(0.0, 0.0)] * COMMUNITY_COUNT
+        for x in range(0, WORLD_SIZE, COMMUNITY_SIZE):
+            for y in range(0, WORLD_SIZE, COMMUNITY_SIZE):
+                self.communityCenters[PostalRouter.communityIndex(x, y)] = \
+                    (x + COMMUNITY_SIZE/2, y + COMMUNITY_SIZE/2)
+        self.transit = self.buildTransitTable()
+        self.transitArray = None
+        if np is not None:
+            self.transitArray = np.frombuffer(self.transit, dtype=np.uint16).reshape(COMMUNITY_COUNT, COMMUNITY_COUNT)
+
+    @staticmethod
+    def communityIndex(x:int, y:int) -> int:
+        '''坐标所在小区的全局编号 按 城市 -> 市区 -> 小区 排列 同一城市的小区编号连续'''
+        city_id = (y // CITY_SIZE)*4 + x // CITY_SIZE
+        block_id = (y % CITY_SIZE // BLOCK_SIZE)*3 + x % CITY_SIZE // BLOCK_SIZE
+        community_id = (y % BLOCK_SIZE // COMMUNITY_SIZE)*4 + x % BLOCK_SIZE // COMMUNITY_SIZE
+        return (city_id*9 + block_id)*16 + community_id
+
+    @staticmethod
+    def regionCenter(index:int, size:int) -> Tuple[float,float]:
+        '''城市/市区的中心 index为该区域内任一小区的全局编号'''
+        city_id, rest = divmod(index, 9*16)
+        block_id = rest // 16
+        x = (city_id % 4)*CITY_SIZE
+        y = (city_id // 4)*CITY_SIZE
+        if size == BLOCK_SIZE:
+            x += (block_id % 3)*BLOCK_SIZE
+            y += (block_id // 3)*BLOCK_SIZE
+        return (x + size/2, y + size/2)
+
+    def buildTransitTable(self) -> array:
+        '''预计算任意两个小区之间的转运时间（分钟）'''
+        def hours(p1, p2, speed):
+            return math.hypot(p1[0] - p2[0], p1[1] - p2[1]) / speed
+
+        # 每个小区到其市区枢纽、再到城市枢纽的耗时
+        toBlock = []
+        toCity = []
+        for c in range(COMMUNITY_COUNT):
+            blockHub = PostalRouter.regionCenter(c, BLOCK_SIZE)
+            cityHub = PostalRouter.regionCenter(c, CITY_SIZE)
+            t = COMMUNITY_HANDLING + hours(self.communityCenters[c], blockHub, COMMUNITY_LINK_SPEED) + BLOCK_HANDLING
+            toBlock.append(t)
+            toCity.append(t + hours(blockHub, cityHub, BLOCK_LINK_SPEED) + CITY_HANDLING)
+        cityHubs = [PostalRouter.regionCenter(city*9*16, CITY_SIZE) for city in range(16)]
+
+        perCity = 9*16
+        table = array('H')
+        for c1 in range(COMMUNITY_COUNT):
+            city1, block1 = c1 // perCity, c1 // 16
+            row = []
+            for city2 in range(16):
+                base = city2*perCity
+                if city2 != city1:
+                    # 经两个城市枢纽
+                    head = toCity[c1] + hours(cityHubs[city1], cityHubs[city2], CITY_LINK_SPEED)
+                    row.extend(head + toCity[c2] - CITY_HANDLING for c2 in range(base, base + perCity))
+                    continue
+                for c2 in range(base, base + perCity):
+                    if c2 == c1:
+                        row.append(COMMUNITY_HANDLING)
+                    elif c2 // 16 == block1:
+                        # 同一市区 只经过市区枢纽
+                        row.append(toBlock[c1] + toBlock[c2] - BLOCK_HANDLING)
+                    else:
+                        # 同一城市 经过城市枢纽
+                        row.append(toCity[c1] + toCity[c2] - CITY_HANDLING)
+            table.extend(round(h*60) for h in row)
+        return table
+
+    def localHours(self, x:int, y:int, community:int) -> float:
+        cx, cy = self.communityCenters[community]
+        return math.hypot(x - cx, y - cy) / LOCAL_SPEED
+
+    def deliverySeconds(self, sender:Tuple[int,int], receiver:Tuple[int,int]) -> float:
+        '''从sender坐标寄到receiver坐标的投递耗时（秒）'''
+        c1 = PostalRouter.communityIndex(*sender)
+        c2 = PostalRouter.communityIndex(*receiver)
+        local = self.localHours(sender[0], sender[1], c1) + self.localHours(receiver[0], receiver[1], c2)
+        return self.transit[c1*COMMUNITY_COUNT + c2]*60 + local*3600
+
+    def deliveryTime(self, sender:Tuple[int,int], receiver:Tuple[int,int],
+                     sendTime:Optional[datetime]=None) -> datetime:
+        if sendTime is None:
+            sendTime = datetime.now()
+        return sendTime + timedelta(seconds=self.deliverySeconds(sender, receiver))
+
+    def batchDeliverySeconds(self, senders:Sequence[Tuple[int,int]],
+                             receivers:Sequence[Tuple[int,int]]) -> List[float]:
+        '''批量计算投递耗时（秒） 安装了numpy时向量化计算'''
+        if self.transitArray is None:
+            return [self.deliverySeconds(s, r) for s, r in zip(senders, receivers)]
+
+        s = np.asarray(senders, dtype=np.int64).reshape(-1, 2)
+        r = np.asarray(receivers, dtype=np.int64).reshape(-1, 2)
+        c1 = PostalRouter.vectorCommunityIndex(s[:,0], s[:,1])
+        c2 = PostalRouter.vectorCommunityIndex(r[:,0], r[:,1])
+        half = COMMUNITY_SIZE / 2
+        # 小区中心 = 所在小区左上角 + 半个小区
+        local = (np.hypot(s[:,0] % COMMUNITY_SIZE - half, s[:,1] % COMMUNITY_SIZE - half) +
+                 np.hypot(r[:,0] % COMMUNITY_SIZE - half, r[:,1] % COMMUNITY_SIZE - half)) / LOCAL_SPEED
+        return (self.transitArray[c1, c2].astype(np.float64)*60 + local*3600).tolist()
+
+    @staticmethod
+    def vectorCommunityIndex(x, y):
+        city_id = (y // CITY_SIZE)*4 + x // CITY_SIZE
+        block_id = (y % CITY_SIZE // BLOCK_SIZE)*3 + x % CITY_SIZE // BLOCK_SIZE
+        community_id = (y % BLOCK_SIZE // COMMUNITY_SIZE)*4 + x % BLOCK_SIZE // COMMUNITY_SIZE
+        return (city_id*9 + block_id)*16 + community_id
@@ -0,0 +1,349 @@
+from __future__ import annotations
+from typing import *
+
+import base64
+import re
+from pathlib import Path
+
+from django.db import connections, router, transaction
+
+from .archive import ARCHIVE_BOXES, LetterArchive, archiveConfig
+from .logic import Tools
+from .mailbox import Mailbox
+from .models import Letter, User
+from .sharding import Shards
+
+
+SEARCH_TABLE = 'letter_fts2'
+LEGACY_SEARCH_TABLES = ('letter_fts',)  # 分词方式不同的旧索引表 upgrade_schema删除后需要rebuild_search_index
+SNIPPET_RADIUS = 24     # 摘要中匹配位置前后保留的字符数
+
+CJK_RUN = re.compile(r'[㐀-䶿一-鿿豈-﫿]+')
+WORD = re.compile(r'\w+')
+
+
+class LetterSearch:
+    '''
+    信件全文搜索 基于SQLite FTS5
+
+    正文是压缩存储的 因此使用contentless的FTS5表 只保存索引 不保存第二份正文:
+      body   正文分词后的文本 连续的汉字切成重叠的二元组 每个汉字另外作为一元追加在末尾 其他文字交给unicode61分词
+             二元组之间没有插入一元 多字词按二元组的短语匹配 单字词匹配一元 无论在词首还是词尾
+      owners 寄信人和收信人 形如 "u12 u34" 搜索时作为索引内的条件 只在自己的信里求交集
+    trigram分词器要求查询至少3个字符 不适合以双字词为主的中文 所以在写入前自行切分
+    摘要在取出一页结果后从解压的正文中生成 高亮以字符区间返回
+
+    Letter的save/delete通过signal同步 contentless表删除时需要原始的分词文本 因此在pre_save/pre_delete中取旧值
+    bulk_create、queryset.update和直接写SQL不会触发signal 批量导入后需执行rebuild_search_index
+    archive_letters移入归档的信件保留索引行 搜索命中的信件数据库中没有时从该用户的归档中取出 与读信相同
+    rebuild同时索引归档中的信件
+    分片时每个分片有自己的索引表 只索引本分片的信件 搜索时各分片分别查询后按相关度归并
+    '''
+    # 已确认建过索引表的数据库
+    ensured:Set[str] = set()
+
+    @staticmethod
+    def ensureTable(using:str='default') -> None:
+        connection = connections[using]
+        name = str(connection.settings_dict['NAME'])
+        if name in LetterSearch.ensured:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                           "body, owners, content='', tokenize='unicode61')" % SEARCH_TABLE)
+        # 在事务中建的表可能随事务回滚 提交后才记住
+        transaction.on_commit(lambda: LetterSearch.ensured.add(name), using=using)
+
+    @staticmethod
+    def onPostMigrate(sender, using:str='default', **kwargs) -> None:
+        '''建表时同时建立索引表 避免第一次写信时在事务中建表'''
+        if router.allow_migrate_model(using, Letter):
+            LetterSearch.ensureTable(using)
+
+    @staticmethod
+    def legacyTables(using:str='default') -> List[str]:
+        '''分词方式不同的旧索引表'''
+        tables = set(connections[using].introspection.table_names())
+        return [table for table in LEGACY_SEARCH_TABLES if table in tables]
+
+    @staticmethod
+    def dropLegacyTables(using:str='default') -> None:
+        with connections[using].cursor() as cursor:
+            for table in LetterSearch.legacyTables(using):
+                cursor.execute('DROP TABLE %s' % table)
+
+    @staticmethod
+    def dropTable(using:str='default') -> None:
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % SEARCH_TABLE)
+        LetterSearch.ensured.discard(str(connection.settings_dict['NAME']))
+
+    ##############################################
+
+    @staticmethod
+    def segment(text:str, unigrams:bool=True) -> str:
+        '''
+        把汉字串切成重叠的二元组 单个汉字保留为一元
+        unigrams为True时（写入索引）多字汉字串的每个字再作为一元追加在末尾 查询短语时为False
+        '''
+        chars = []
+
+        def bigrams(match):
+            run = match.group(0)
+            if len(run) == 1:
+                return ' %s ' % run
+            chars.append(run)
+            return ' %s ' % ' '.join(map(str.__add__, run, run[1:]))
+        segmented = CJK_RUN.sub(bigrams, text)
+        if unigrams and chars:
+            segmented += ' ' + ' '.join(''.join(chars))
+        return segmented
+
+    @staticmethod
+    def owners(senderId:Optional[int], receiverId:Optional[int]) -> str:
+        return ' '.join('u%d' % uid for uid in (senderId, receiverId) if uid is not None)
+
+    @staticmethod
+    def indexRow(letter:Letter) -> Tuple[int,str,str]:
+        return letter.id, LetterSearch.segment(letter.content), LetterSearch.owners(letter.sender_id, letter.receiver_id)
+
+    @staticmethod
+    def insertRows(rows:Sequence[Tuple[int,str,str]], using:str='default') -> None:
+        LetterSearch.ensureTable(using)
+        with connections[using].cursor() as cursor:
+            cursor.executemany('INSERT INTO %s (rowid, body, owners) VALUES (%%s, %%s, %%s)' % SEARCH_TABLE, rows)
+
+    @staticmethod
+    def indexedIds(ids:Sequence[int], using:str='default') -> Set[int]:
+        '''ids中已建立索引的 从FTS5的docsize影子表中查'''
+        LetterSearch.ensureTable(using)
+        found = set()
+        with connections[using].cursor() as cursor:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start+500]
+                cursor.execute('SELECT id FROM %s_docsize WHERE id IN (%s)' % (SEARCH_TABLE, ', '.join(['%s'] * len(chunk))),
+                               chunk)
+                found.update(row[0] for row in cursor.fetchall())
+        return found
+
+    @staticmethod
+    def deleteRows(rows:Sequence[Tuple[int,str,str]], using:str='default') -> None:
+        '''删除时给出的分词文本必须与写入时一致 对未建立索引的行执行删除会损坏索引 因此先过滤'''
+        indexed = LetterSearch.indexedIds([row[0] for row in rows], using)
+        rows = [row for row in rows if row[0] in indexed]
+        if not rows:
+            return
+        with connections[using].cursor() as cursor:
+            cursor.executemany("INSERT INTO %s (%s, rowid, body, owners) VALUES ('delete', %%s, %%s, %%s)"
+                               % (SEARCH_TABLE, SEARCH_TABLE), rows)
+
+    ##############################################
+    # signal
+
+    @staticmethod
+    def previousRow(instance:Letter, using:str) -> Optional[Tuple[int,str,str]]:
+        try:
+            old = Letter.objects.using(using).only('id', 'sender_id', 'receiver_id', 'content').get(id=instance.id)
+        except Letter.DoesNotExist:
+            return None
+        return LetterSearch.indexRow(old)
+
+    @staticmethod
+    def onPreSave(sender, instance:Letter, raw=False, using:str='default', **kwargs) -> None:
+        instance._search_previous = LetterSearch.previousRow(instance, using) if instance.id is not None else None
+
+    @staticmethod
+    def onPostSave(sender, instance:Letter, created=False, raw=False, using:str='default', **kwargs) -> None:
+        previous = getattr(instance, '_search_previous', None)
+        current = LetterSearch.indexRow(instance)
+        if previous == current:
+            return
+        if previous is not None:
+            LetterSearch.deleteRows([previous], using)
+        LetterSearch.insertRows([current], using)
+
+    @staticmethod
+    def onPreDelete(sender, instance:Letter, using:str='default', **kwargs) -> None:
+        previous = LetterSearch.previousRow(instance, using)
+        if previous is not None:
+            LetterSearch.deleteRows([previous], using)
+
+    ##############################################
+    # 查询
+
+    @staticmethod
+    def keywords(query:str) -> List[str]:
+        '''把查询拆成关键词 汉字串和其他单词分开'''
+        words = []
+        for word in WORD.findall(query):
+            pos = 0
+            for match in CJK_RUN.finditer(word):
+                words.extend(w for w in (word[pos:match.start()], match.group(0)) if w)
+                pos = match.end()
+            if word[pos:]:
+                words.append(word[pos:])
+        return words
+
+    @staticmethod
+    def matchExpression(words:List[str], userId:int) -> str:
+        '''所有关键词都要出现 汉字词按二元组组成短语 单个汉字匹配一元'''
+        terms = []
+        for word in words:
+            terms.append('"%s"' % LetterSearch.segment(word, unigrams=False).strip().replace('"', '""'))
+        return 'owners : u%d AND body : (%s)' % (userId, ' AND '.join(terms))
+
+    @staticmethod
+    def encodeCursor(score:float, letterId:int) -> str:
+        raw = '%r|%d' % (score, letterId)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+    @staticmethod
+    def decodeCursor(cursor:str) -> Optional[Tuple[float,int]]:
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+            scorestr, idstr = raw.split('|')
+            return float(scorestr), int(idstr)
+        except (ValueError, UnicodeError):
+            return None
+
+    @staticmethod
+    def search(user:User, query:str, cursor:Optional[Tuple[float,int]]=None,
+               limit:int=20) -> Tuple[List[Tuple[Letter,Dict]], Optional[str]]:
+        '''
+        在user寄出和收到（已到达）的信中搜索 按bm25相关度排序 返回([(信件, 摘要)], 下一页游标)
+        游标记录上一页最后一条的(相关度, id) 索引更新后相关度会略有变化 翻页结果只保证大致连续
+        '''
+        words = LetterSearch.keywords(query)
+        if not words:
+            return [], None
+
+        # 分片时每个分片各取limit+1条 再按(相关度, id)归并
+        hits = []
+        for db in Shards.databases():
+            hits.extend((score, rowid, db) for rowid, score in LetterSearch.searchHits(db, words, user, cursor, limit))
+        hits.sort()
+
+        nextCursor = None
+        if len(hits) > limit:
+            hits = hits[:limit]
+            nextCursor = LetterSearch.encodeCursor(hits[-1][0], hits[-1][1])
+        letters = {}
+        for db in set(hit[2] for hit in hits):
+            letters.update(Letter.objects.using(db).select_related('sender', 'receiver').defer(*Mailbox.USER_DEFER)
+                                         .in_bulk([hit[1] for hit in hits if hit[2] == db]))
+        Shards.attachUsers(letters.values(), 'sender')
+        archived = [hit[1] for hit in hits if hit[1] not in letters]
+        if archived:
+            letters.update((letter.id, letter) for letter in LetterSearch.archivedLetters(user.id, archived))
+        return [(letters[hit[1]], LetterSearch.snippet(letters[hit[1]].content, words))
+                for hit in hits if hit[1] in letters], nextCursor
+
+    @staticmethod
+    def searchHits(using:str, words:List[str], user:User, cursor:Optional[Tuple[float,int]],
+                   limit:int) -> List[Tuple[int,float]]:
+        '''
+        一个数据库中排在cursor之后的前limit+1条 [(id, 相关度)]
+        Letter表中没有的是已归档的信件 都已到达 owners已限定为user的信
+        '''
+        LetterSearch.ensureTable(using)
+        connection = connections[using]
+        sql = '''SELECT f.rowid, f.score FROM (
+                     SELECT rowid, bm25(%(fts)s, 1.0, 0.0) AS score FROM %(fts)s WHERE %(fts)s MATCH %%s
+                 ) f LEFT JOIN %(letter)s l ON l.id = f.rowid
+                 WHERE (l.id IS NULL OR l.sender_id = %%s OR (l.receiver_id = %%s AND l.recv_time <= %%s))''' % {
+            'fts': SEARCH_TABLE, 'letter': connection.ops.quote_name(Letter._meta.db_table)}
+        params = [LetterSearch.matchExpression(words, user.id), user.id, user.id,
+                  connection.ops.adapt_datetimefield_value(Tools.getNow('datetime'))]
+        if cursor is not None:
+            sql += ' AND (f.score > %s OR (f.score = %s AND f.rowid > %s))'
+            params += [cursor[0], cursor[0], cursor[1]]
+        sql += ' ORDER BY f.score, f.rowid LIMIT %s'
+        params.append(limit + 1)
+        with connection.cursor() as c:
+            c.execute(sql, params)
+            return c.fetchall()
+
+    @staticmethod
+    def archivedLetters(userId:int, letterIds:Sequence[int]) -> List[Letter]:
+        '''从userId的收件箱和发件箱归档中取出这些信件 不存在的（如已删除的信件留下的索引行）忽略'''
+        records = {}
+        for box in ARCHIVE_BOXES:
+            missing = [letterId for letterId in letterIds if letterId not in records]
+            if missing:
+                records.update(LetterArchive(userId, box).getMany(missing))
+        return LetterArchive.toLetters(list(records.values()))
+
+    @staticmethod
+    def snippet(content:str, words:List[str]) -> Dict:
+        '''截取第一个关键词附近的正文 highlights为摘要中各关键词出现的[起, 止)字符区间'''
+        pattern = re.compile('|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True)), re.IGNORECASE)
+        first = pattern.search(content)
+        center = first.start() if first else 0
+        start = max(0, center - SNIPPET_RADIUS)
+        end = min(len(content), center + SNIPPET_RADIUS*2)
+        text = content[start:end]
+        return {
+            'text': ('…' if start > 0 else '') + text + ('…' if end < len(content) else ''),
+            'highlights': [[m.start() + (start > 0), m.end() + (start > 0)] for m in pattern.finditer(text)],
+        }
+
+    ##############################################
+
+    @staticmethod
+    def rebuild(batch:int=5000) -> int:
+        '''删除并重建索引 分片时重建每个分片的索引 包括归档中的信件 返回索引的信件数'''
+        total = 0
+        for db in Shards.databases():
+            LetterSearch.dropLegacyTables(db)
+            LetterSearch.dropTable(db)
+            LetterSearch.ensureTable(db)
+            lastId = 0
+            while True:
+                letters = list(Letter.objects.using(db).filter(id__gt=lastId).order_by('id')
+                                             .only('id', 'sender_id', 'receiver_id', 'content')[:batch])
+                if not letters:
+                    break
+                with transaction.atomic(using=db):
+                    LetterSearch.insertRows([LetterSearch.indexRow(letter) for letter in letters], db)
+                total += len(letters)
+                lastId = letters[-1].id
+        return total + LetterSearch.rebuildArchived(batch)
+
+    @staticmethod
+    def rebuildArchived(batch:int) -> int:
+        '''
+        索引已归档的信件 写入信件id所在分片的索引表
+        每封信在收信人的inbox归档中有一份 收信人已删除时只在寄信人的outbox归档中
+        归档后尚未从数据库删除的信件已经索引过 跳过
+        '''
+        root = Path(archiveConfig()['DIR'])
+        if not root.is_dir():
+            return 0
+        total = 0
+        pending:Dict[str,List[Tuple[int,str,str]]] = {}
+
+        def flush(db:str) -> int:
+            rows, pending[db] = pending.get(db, []), []
+            hot = set(Letter.objects.using(db).filter(id__in=[row[0] for row in rows]).values_list('id', flat=True))
+            rows = [row for row in rows if row[0] not in hot]
+            with transaction.atomic(using=db):
+                LetterSearch.insertRows(rows, db)
+            return len(rows)
+
+        for path in root.glob('*/*'):
+            if not (path.is_dir() and path.name.isdigit()):
+                continue
+            for box in ARCHIVE_BOXES:
+                for record in LetterArchive(int(path.name), box).iterRecords():
+                    letterId, senderId, receiverId, content = record[0], record[1], record[2], record[7]
+                    if box == 'outbox' and receiverId is not None:
+                        continue
+                    db = Shards.forId(letterId)
+                    rows = pending.setdefault(db, [])
+                    rows.append((letterId, LetterSearch.segment(content), LetterSearch.owners(senderId, receiverId)))
+                    if len(rows) >= batch:
+                        total += flush(db)
+        for db in list(pending):
+            total += flush(db)
+        return total
@@ -0,0 +1,260 @@
+from __future__ import annotations
+from typing import *
+
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+from .data import LocationName
+
+
+# 按城市分片的模型（model_name） 其余模型只在default中
+SHARDED_MODELS = frozenset(('virtuallocation', 'user', 'letter', 'bulletin', 'bulletinread'))
+# 第i个分片的自增主键从 (i+1) << SHARD_ID_BITS 开始 由id即可知道所在的分片
+SHARD_ID_BITS = 40
+DIRECTORY_CACHE_SIZE = 100000   # 进程内缓存的用户名 -> 分片数 超过后清空
+
+
+class Shards:
+    '''
+    按城市把居民分到多个数据库
+
+    分片的单位是城市组: 城市id % 分片数 相同的城市在同一个分片中
+    居民（User及其VirtualLocation）、寄给他的信、他所在地区的公告和公告的已读标记都在他所在城市的分片中
+    因此收件箱、读信、公告只访问一个分片 寄信只写收信人所在的分片 写入量随分片数分摊
+
+    寄信人可能在另一个分片: Letter.sender不建外键约束 展示时由attachUsers按id到各分片取
+    发件箱、导出、排行榜等按寄信人/全体用户的查询对每个分片各查一次再归并
+    用户名的唯一性由default中的UserShard目录保证 登录等按用户名的查询先查目录
+
+    settings.SHARD_DATABASES为空（默认）时不分片 所有函数都返回'default' 与不分片时的行为完全一致
+    '''
+    directory:Dict[str,str] = {}
+    directoryLock = threading.Lock()
+
+    @staticmethod
+    def aliases() -> List[str]:
+        return getattr(settings, 'SHARD_DATABASES', [])
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(Shards.aliases())
+
+    @staticmethod
+    def databases() -> List[str]:
+        '''存放分片模型的全部数据库'''
+        return Shards.aliases() or ['default']
+
+    @staticmethod
+    def forCity(cityId:int) -> str:
+        aliases = Shards.aliases()
+        return aliases[cityId % len(aliases)] if aliases else 'default'
+
+    @staticmethod
+    def forPosition(x:int, y:int) -> str:
+        return Shards.forCity((y // 480)*4 + x // 480)
+
+    @staticmethod
+    def forCityName(cityName:str) -> Optional[str]:
+        '''收信地址中的城市名 -> 分片 不存在的城市返回None'''
+        try:
+            return Shards.forCity(LocationName.City.index(cityName))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def forRegion(region:str) -> str:
+        '''地区键 见VirtualLocation.getRegionKeys'''
+        return Shards.forCity(int(region.split('-')[0]))
+
+    @staticmethod
+    def forId(objId:Optional[int]) -> str:
+        '''分片模型的主键 -> 分片 不属于任何分片的id（如客户端传入的错误id）落在第一个分片 查不到即可'''
+        aliases = Shards.aliases()
+        if not aliases:
+            return 'default'
+        index = ((objId or 0) >> SHARD_ID_BITS) - 1
+        return aliases[index] if 0 <= index < len(aliases) else aliases[0]
+
+    @staticmethod
+    def idBase(alias:str) -> int:
+        '''alias中的主键都大于此值 不分片时为0'''
+        aliases = Shards.aliases()
+        return (aliases.index(alias) + 1) << SHARD_ID_BITS if alias in aliases else 0
+
+    ##############################################
+    # 用户名目录
+
+    @staticmethod
+    def forUsername(username:str) -> Optional[str]:
+        '''用户名 -> 分片 用户不存在时返回None 不分片时总是'default' '''
+        aliases = Shards.aliases()
+        if not aliases:
+            return 'default'
+        alias = Shards.directory.get(username)
+        if alias is not None:
+            return alias
+        from .models import UserShard
+        index = UserShard.objects.filter(username=username).values_list('shard', flat=True).first()
+        if index is None:
+            # 不存在的用户名不缓存 随时可能注册
+            return None
+        alias = aliases[index]
+        with Shards.directoryLock:
+            if len(Shards.directory) > DIRECTORY_CACHE_SIZE:
+                Shards.directory.clear()
+            Shards.directory[username] = alias
+        return alias
+
+    @staticmethod
+    def groupUsernames(usernames:Iterable[str]) -> Dict[str, List[str]]:
+        '''按分片分组 不存在的用户名不出现在结果中'''
+        usernames = list(usernames)
+        aliases = Shards.aliases()
+        if not aliases:
+            return {'default': usernames} if usernames else {}
+        groups:Dict[str, List[str]] = {}
+        missing = []
+        for username in usernames:
+            alias = Shards.directory.get(username)
+            if alias is None:
+                missing.append(username)
+            else:
+                groups.setdefault(alias, []).append(username)
+        if missing:
+            from .models import UserShard
+            rows = list(UserShard.objects.filter(username__in=missing).values_list('username', 'shard'))
+            with Shards.directoryLock:
+                for username, index in rows:
+                    Shards.directory[username] = aliases[index]
+            for username, index in rows:
+                groups.setdefault(aliases[index], []).append(username)
+        return groups
+
+    @staticmethod
+    def claimUsername(username:str, alias:str) -> None:
+        '''注册前在目录中占用用户名 已被占用时抛出IntegrityError 不分片时什么都不做'''
+        aliases = Shards.aliases()
+        if not aliases:
+            return
+        from .models import UserShard
+        UserShard.objects.create(username=username, shard=aliases.index(alias))
+
+    ##############################################
+    # 跨分片取用户
+
+    @staticmethod
+    def usersByIds(userIds:Iterable[int], *fields:str, related:Sequence[str]=()) -> Dict:
+        '''{id: User} 每个分片一次查询 fields非空时只加载这些字段 related为同一分片中的select_related'''
+        groups:Dict[str, List[int]] = {}
+        for userId in set(userIds):
+            groups.setdefault(Shards.forId(userId), []).append(userId)
+        from .models import User
+        users = {}
+        for alias, ids in groups.items():
+            queryset = User.objects.using(alias)
+            if related:
+                queryset = queryset.select_related(*related)
+            if fields:
+                queryset = queryset.only(*fields)
+            users.update(queryset.in_bulk(ids))
+        return users
+
+    @staticmethod
+    def attachUsers(objects:Iterable, field:str) -> None:
+        '''
+        补上select_related在本分片中没有取到的用户（另一个分片的寄信人）
+        在本分片中JOIN不到时select_related缓存的是None 不会再查询
+        '''
+        if not Shards.enabled():
+            return
+        objects = [obj for obj in objects if getattr(obj, field + '_id') is not None
+                   and obj._meta.get_field(field).get_cached_value(obj, None) is None]
+        if not objects:
+            return
+        users = Shards.usersByIds((getattr(obj, field + '_id') for obj in objects), 'id', 'username', 'nickname')
+        for obj in objects:
+            user = users.get(getattr(obj, field + '_id'))
+            if user is not None:
+                setattr(obj, field, user)
+
+    ##############################################
+
+    @staticmethod
+    def seedSequences(using:str) -> None:
+        '''
+        把分片中各表的自增起点设为 (i+1) << SHARD_ID_BITS 已经更大时不变
+        建表后（post_migrate）调用 要求分片数据库是SQLite（AUTOINCREMENT使用sqlite_sequence）
+        '''
+        aliases = Shards.aliases()
+        if using not in aliases:
+            return
+        from django.apps import apps
+        start = Shards.idBase(using)
+        connection = connections[using]
+        tables = set(connection.introspection.table_names())
+        with connection.cursor() as cursor:
+            for model in apps.get_app_config('api').get_models():
+                table = model._meta.db_table
+                if model._meta.model_name not in SHARDED_MODELS or table not in tables:
+                    continue
+                cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s', [table])
+                row = cursor.fetchone()
+                if row is None:
+                    cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start])
+                elif row[0] < start:
+                    cursor.execute('UPDATE sqlite_sequence SET seq = %s WHERE name = %s', [start, table])
+
+    @staticmethod
+    def onPostMigrate(sender, using:str='default', **kwargs) -> None:
+        Shards.seedSequences(using)
+
+
+class ShardRouter:
+    '''
+    Django的数据库路由 只在分片时配置（settings.DATABASE_ROUTERS）
+
+    已保存的对象按主键所在的分片 新对象按内容: VirtualLocation按坐标 User按其VirtualLocation
+    Letter按收信人 Bulletin按目标地区 BulletinRead按公告
+    没有对象可依据的查询（如User.objects.filter(...)）返回None 即落到default 而default中没有分片模型的表
+    因此这类查询必须用using()指定分片 遗漏时会立即报错 不会静默地只查到一部分数据
+    '''
+    @staticmethod
+    def isSharded(model) -> bool:
+        return model._meta.app_label == 'api' and model._meta.model_name in SHARDED_MODELS
+
+    @staticmethod
+    def instanceDb(instance) -> Optional[str]:
+        if instance is None or not ShardRouter.isSharded(type(instance)):
+            return None
+        if instance.pk is not None:
+            return Shards.forId(instance.pk)
+        name = instance._meta.model_name
+        if name == 'virtuallocation':
+            return Shards.forPosition(instance.position_x, instance.position_y)
+        ref = {'user': 'vlocation_id', 'letter': 'receiver_id', 'bulletinread': 'bulletin_id'}.get(name)
+        if ref is not None and getattr(instance, ref) is not None:
+            return Shards.forId(getattr(instance, ref))
+        if name == 'bulletin' and instance.region:
+            return Shards.forRegion(instance.region)
+        return None
+
+    def db_for_read(self, model, **hints):
+        if not ShardRouter.isSharded(model):
+            return 'default'
+        return ShardRouter.instanceDb(hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 跨分片的关系（如寄信人）只存id
+        if obj1._meta.app_label == 'api' and obj2._meta.app_label == 'api':
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == 'api' and model_name in SHARDED_MODELS:
+            return db != 'default'
+        return db == 'default'
@@ -0,0 +1,164 @@
+from __future__ import annotations
+from typing import *
+
+import heapq
+import math
+import threading
+import time
+from array import array
+
+from .routing import WORLD_SIZE
+from .sharding import Shards
+
+
+GRID_CELL = 10                          # 与幢的大小一致 百万用户时每格平均约27人
+GRID_SIZE = WORLD_SIZE // GRID_CELL
+REFRESH_INTERVAL = 5                    # 秒 查询时若距上次同步超过此时间 拉取其他进程注册的新用户
+
+
+class NearbyIndex:
+    '''
+    已入住坐标的网格索引 用于查找附近的居民
+
+    世界按GRID_CELL划分为GRID_SIZE*GRID_SIZE个格子 每格用两个array分别存坐标(x*WORLD_SIZE+y)和用户id
+    k近邻从查询点所在的格子开始一圈圈向外扩展 当第k近的距离不超过下一圈的最小可能距离时停止
+    百万用户时一次查询只需检查几百个点
+
+    首次查询时从数据库加载 本进程注册的用户由RegisterInterface直接加入
+    其他进程注册的用户在查询时按主键增量拉取（最多延迟REFRESH_INTERVAL秒） 分片时每个分片分别记录已拉取的最大id
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> NearbyIndex:
+        if NearbyIndex.INSTANCE is None:
+            with NearbyIndex.LOCK:
+                if NearbyIndex.INSTANCE is None:
+                    index = NearbyIndex()
+                    index.refresh()
+                    NearbyIndex.INSTANCE = index
+        return NearbyIndex.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.positions:List[array] = [array('i') for _ in range(GRID_SIZE*GRID_SIZE)]
+        self.userIds:List[array] = [array('q') for _ in range(GRID_SIZE*GRID_SIZE)]
+        self.count = 0
+        self.lastUserIds:Dict[str,int] = {}     # 每个数据库中已拉取的最大用户id
+        self.lastRefresh = 0.0
+        self.added:Set[int] = set() # 上次同步之后由add加入的用户
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cellOf(x:int, y:int) -> int:
+        return (x // GRID_CELL)*GRID_SIZE + y // GRID_CELL
+
+    def add(self, userId:int, x:int, y:int) -> None:
+        cell = NearbyIndex.cellOf(x, y)
+        with self.lock:
+            self.positions[cell].append(x*WORLD_SIZE + y)
+            self.userIds[cell].append(userId)
+            self.count += 1
+            self.added.add(userId)
+
+    def remove(self, userId:int, x:int, y:int) -> bool:
+        cell = NearbyIndex.cellOf(x, y)
+        with self.lock:
+            ids = self.userIds[cell]
+            try:
+                i = ids.index(userId)
+            except ValueError:
+                return False
+            # 与最后一个交换后删除 格内顺序无关紧要
+            positions = self.positions[cell]
+            ids[i], positions[i] = ids[-1], positions[-1]
+            ids.pop()
+            positions.pop()
+            self.count -= 1
+            return True
+
+    def build(self, rows:Iterable[Tuple[int,int,int]]) -> None:
+        '''批量加入(用户id, x, y)'''
+        for userId, x, y in rows:
+            cell = (x // GRID_CELL)*GRID_SIZE + y // GRID_CELL
+            self.positions[cell].append(x*WORLD_SIZE + y)
+            self.userIds[cell].append(userId)
+            self.count += 1
+
+    def refresh(self) -> None:
+        '''拉取上次同步之后注册的用户 主键索引上的范围扫描'''
+        from .models import User
+        now = time.time()
+        if now - self.lastRefresh < REFRESH_INTERVAL:
+            return
+        self.lastRefresh = now
+
+        def fresh(db, rows):
+            # 本进程add过的用户不再重复加入
+            for row in rows:
+                self.lastUserIds[db] = row[0]
+                if row[0] not in added:
+                    yield row
+
+        with self.lock:
+            added, self.added = self.added, set()
+            for db in Shards.databases():
+                rows = User.objects.using(db).filter(id__gt=self.lastUserIds.get(db, 0)).exclude(vlocation=None) \
+                                   .order_by('id').values_list('id', 'vlocation__position_x', 'vlocation__position_y')
+                self.build(fresh(db, rows.iterator(chunk_size=20000)))
+
+    ##############################################
+
+    def nearest(self, x:int, y:int, k:int, maxDistance:Optional[float]=None,
+                exclude:Optional[int]=None) -> List[Tuple[float,int,int,int]]:
+        '''
+        距(x, y)最近的k个居民 可限定最大距离 返回[(距离, 用户id, x, y)] 按距离升序
+        '''
+        limit2 = maxDistance*maxDistance if maxDistance is not None else math.inf
+        cx, cy = x // GRID_CELL, y // GRID_CELL
+        best:List[Tuple[int,int,int]] = [] # 大顶堆 (-距离平方, -用户id, 坐标)
+        ring = 0
+        while True:
+            for gx, gy in NearbyIndex.ringCells(cx, cy, ring):
+                cell = gx*GRID_SIZE + gy
+                positions = self.positions[cell]
+                if not positions:
+                    continue
+                ids = self.userIds[cell]
+                for i in range(len(positions)):
+                    p = positions[i]
+                    dx = p // WORLD_SIZE - x
+                    dy = p % WORLD_SIZE - y
+                    d2 = dx*dx + dy*dy
+                    if d2 > limit2 or ids[i] == exclude:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-d2, -ids[i], p))
+                    elif (-d2, -ids[i]) > best[0][:2]:
+                        heapq.heapreplace(best, (-d2, -ids[i], p))
+            # 下一圈中的点距离至少为 ring*GRID_CELL
+            bound = ring*GRID_CELL
+            if (len(best) == k and -best[0][0] <= bound*bound) or bound*bound > limit2 or ring >= GRID_SIZE:
+                break
+            ring += 1
+        return sorted((math.sqrt(-d2), -negId, p // WORLD_SIZE, p % WORLD_SIZE) for d2, negId, p in best)
+
+    @staticmethod
+    def ringCells(cx:int, cy:int, ring:int) -> Iterator[Tuple[int,int]]:
+        '''与(cx, cy)的切比雪夫距离恰为ring的格子 超出世界的略去'''
+        if ring == 0:
+            yield cx, cy
+            return
+        x0, x1 = max(0, cx - ring), min(GRID_SIZE - 1, cx + ring)
+        y0, y1 = max(0, cy - ring), min(GRID_SIZE - 1, cy + ring)
+        for gx in range(x0, x1 + 1):
+            if cy - ring >= 0:
+                yield gx, cy - ring
+            if cy + ring < GRID_SIZE:
+                yield gx, cy + ring
+        for gy in range(max(y0, cy - ring + 1), min(y1, cy + ring - 1) + 1):
+            if cx - ring >= 0:
+                yield cx - ring, gy
+            if cx + ring < GRID_SIZE:
+                yield cx + ring, gy
@@ -0,0 +1,322 @@
+from __future__ import annotations
+from typing import *
+
+import atexit
+import logging
+import threading
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, IntegerField, Sum
+from django.db.models.functions import Cast, TruncDate
+
+from .archive import RECORD_ID, RECORD_RECV_TIME, RECORD_SEND_TIME, LetterArchive, archiveConfig, loadSegment
+from .data import LocationName
+from .logic import Tools
+from .models import COMMUNITY_SIZE, REGION_LEVELS, Letter, RegionStat, User, VirtualLocation, communityRegionKeys
+from .sharding import Shards
+
+
+logger = logging.getLogger(__name__)
+
+# 默认配置 可在settings.REGION_STATS中覆盖
+DEFAULT_REGION_STATS_CONFIG:Dict[str,Any] = {
+    'FLUSH_INTERVAL': 10,       # 秒 缓冲的计数写入数据库的间隔
+}
+
+STAT_FIELDS = ('residents', 'letters_sent', 'letters_received')
+KNOWN_ROWS_LIMIT = 100000   # 进程内记住已存在的(地区, 日期)行数 超过后清空
+
+
+class RegionStats:
+    '''
+    各城市、市区、小区按天汇总的居民数和寄出/收到的信件数
+
+    RegionStat每个(地区, 日期)一行 只在default中
+    注册时onRegister、寄信时onSend只在内存中累加 {(地区, 日期): [居民, 寄出, 收到]} 不访问数据库
+    后台线程每FLUSH_INTERVAL秒把缓冲整体取出 增量相同的行合并为一条UPDATE ... SET x = x + n 全部在一个事务中
+    用F表达式在数据库中累加 多个进程各自缓冲、各自写入也不会丢失 写入失败时增量放回缓冲 下次重试
+    当天第一次写某地区时先插入全零的行（已存在则忽略） 进程记住已插入过的行 之后只需要UPDATE
+    线程的启动、atexit和stop()与ExpLedger相同 临时的数据库销毁前应先调用stop()
+    收到的信件记在到达的那一天 因此寄信时可能写入未来的日期 查询时只统计到今天为止 最多落后FLUSH_INTERVAL秒
+
+    import_users导入的居民由onImport按地区合并直接写入 gen_population等其他不经过接口的写入不会计入
+    需要执行rebuild_region_stats从头重新统计
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> RegionStats:
+        if RegionStats.INSTANCE is None:
+            with RegionStats.LOCK:
+                if RegionStats.INSTANCE is None:
+                    RegionStats.INSTANCE = RegionStats()
+        return RegionStats.INSTANCE
+
+    known:Set[Tuple[str,date]] = set()
+    knownLock = threading.Lock()
+
+    ##############################################
+
+    def __init__(self):
+        self.config = dict(DEFAULT_REGION_STATS_CONFIG)
+        self.config.update(getattr(settings, 'REGION_STATS', {}))
+        self.pending:Dict[Tuple[str,date],List[int]] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread:Optional[threading.Thread] = None
+
+    def add(self, regions:Sequence[str], day:date, field:int, n:int=1) -> None:
+        with self.lock:
+            for region in regions:
+                row = self.pending.get((region, day))
+                if row is None:
+                    row = self.pending[(region, day)] = [0, 0, 0]
+                row[field] += n
+        if self.thread is None:
+            self.start()
+
+    def discard(self) -> None:
+        '''丢弃缓冲 rebuild之前的增量已经包含在重新统计的结果中'''
+        with self.lock:
+            self.pending = {}
+
+    def start(self) -> None:
+        with RegionStats.LOCK:
+            if self.thread is not None:
+                return
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stopped,), name='region-stats', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        '''停止后台线程并写入缓冲'''
+        with RegionStats.LOCK:
+            thread, self.thread = self.thread, None
+            self.stopped.set()
+            atexit.unregister(self.stop)
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        self.flush()
+
+    def run(self, stopped:threading.Event) -> None:
+        while not stopped.wait(self.config['FLUSH_INTERVAL']):
+            close_old_connections()
+            self.flush()
+
+    def flush(self) -> int:
+        '''把缓冲写入数据库 返回写入的行数'''
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending, self.pending = self.pending, {}
+
+        groups:Dict[Tuple[date,Tuple[int,...]],List[str]] = {}
+        for (region, day), row in pending.items():
+            groups.setdefault((day, tuple(row)), []).append(region)
+        try:
+            with transaction.atomic():
+                for (day, row), regions in groups.items():
+                    RegionStats.bump(regions, day, {f: n for f, n in zip(STAT_FIELDS, row) if n})
+        except Exception:
+            logger.exception('failed to flush region stats for %d rows', len(pending))
+            with self.lock:
+                for key, row in pending.items():
+                    current = self.pending.setdefault(key, [0, 0, 0])
+                    for i, n in enumerate(row):
+                        current[i] += n
+            return 0
+        return len(pending)
+
+    ##############################################
+
+    @staticmethod
+    def bump(regions:Sequence[str], day:date, amounts:Dict[str,int]) -> None:
+        '''regions在day的行各加上amounts {字段: 增量}'''
+        with RegionStats.knownLock:
+            missing = [region for region in regions if (region, day) not in RegionStats.known]
+        if missing:
+            RegionStat.objects.bulk_create([RegionStat(region=region, level=region.count('-'), bucket=day)
+                                            for region in missing], ignore_conflicts=True)
+            with RegionStats.knownLock:
+                if len(RegionStats.known) > KNOWN_ROWS_LIMIT:
+                    RegionStats.known.clear()
+                RegionStats.known.update((region, day) for region in missing)
+        RegionStat.objects.filter(region__in=regions, bucket=day).update(**{f: F(f) + n for f, n in amounts.items()})
+
+    @staticmethod
+    def onRegister(vlocation:VirtualLocation, regTime:datetime) -> None:
+        '''新居民入住vlocation'''
+        RegionStats.getInstance().add(vlocation.getRegionKeys(), regTime.date(), 0)
+
+    @staticmethod
+    def onImport(vlocations:Sequence[VirtualLocation], regTime:Optional[datetime]) -> None:
+        '''一批同时入住的居民 每个地区只加一次 入住人数相同的地区合并为一条UPDATE'''
+        counts:Dict[str,int] = {}
+        for vlocation in vlocations:
+            for region in vlocation.getRegionKeys():
+                counts[region] = counts.get(region, 0) + 1
+        groups:Dict[int,List[str]] = {}
+        for region, n in counts.items():
+            groups.setdefault(n, []).append(region)
+        with transaction.atomic():
+            for n, regions in groups.items():
+                RegionStats.bump(regions, regTime.date(), {'residents': n})
+
+    @staticmethod
+    def onSend(senderLocation:VirtualLocation, receiverLocation:VirtualLocation,
+               sendTime:datetime, recvTime:datetime) -> None:
+        '''新信件已写入数据库'''
+        stats = RegionStats.getInstance()
+        stats.add(senderLocation.getRegionKeys(), sendTime.date(), 1)
+        stats.add(receiverLocation.getRegionKeys(), recvTime.date(), 2)
+
+    ##############################################
+
+    @staticmethod
+    def parseRegion(region:str) -> Optional[Tuple[int,...]]:
+        '''地区键 -> (城市, 市区, 小区)编号的前缀 不存在的地区返回None'''
+        try:
+            ids = tuple(int(part) for part in region.split('-'))
+        except ValueError:
+            return None
+        bounds = (len(LocationName.City), 9, 16)
+        if len(ids) > len(bounds) or any(not 0 <= i < bound for i, bound in zip(ids, bounds)):
+            return None
+        return ids
+
+    @staticmethod
+    def regionName(region:str) -> str:
+        ids = RegionStats.parseRegion(region)
+        names = [LocationName.City[ids[0]] + '城']
+        if len(ids) > 1:
+            names.append(LocationName.Block[ids[0]][ids[1]])
+        if len(ids) > 2:
+            names.append(LocationName.Community[ids[0]][ids[1]][ids[2]])
+        return ' '.join(names)
+
+    @staticmethod
+    def query(level:str, region:Optional[str], days:int) -> Dict:
+        '''
+        level级各地区（或只有region）最近days天（0为全部）的合计 指定region时附带逐日数据
+        只读RegionStat
+        '''
+        today = Tools.getNow('datetime').date()
+        queryset = RegionStat.objects.filter(level=REGION_LEVELS.index(level), bucket__lte=today)
+        if days > 0:
+            queryset = queryset.filter(bucket__gt=today - timedelta(days=days))
+        if region:
+            queryset = queryset.filter(region=region)
+        totals = queryset.values('region').annotate(**{'total_' + f: Sum(f) for f in STAT_FIELDS}).order_by()
+        # 地区键按编号排序
+        totals = sorted(totals, key=lambda row: RegionStats.parseRegion(row['region']))
+        result = {
+            'regions': [dict({'region': row['region'], 'name': RegionStats.regionName(row['region'])},
+                             **{f: row['total_' + f] for f in STAT_FIELDS}) for row in totals]
+        }
+        if region:
+            result['series'] = [dict({'date': row['bucket'].isoformat()}, **{f: row[f] for f in STAT_FIELDS})
+                                for row in queryset.order_by('bucket').values('bucket', *STAT_FIELDS)]
+        return result
+
+    ##############################################
+
+    @staticmethod
+    def rebuild(batch:int=5000) -> int:
+        '''
+        从数据库和归档重新统计全部地区 替换RegionStat的全部内容 返回写入的行数
+        居民和收到的信件与居民在同一分片 在各分片中按小区格子和日期分组计数
+        寄信人可能在另一个分片 寄出的信件先按(寄信人id, 日期)计数 再到寄信人所在的分片取其位置
+        '''
+        if RegionStats.INSTANCE is not None:
+            RegionStats.INSTANCE.discard()
+        counts:Dict[Tuple[str,date], List[int]] = {}
+
+        def add(cx:int, cy:int, day:date, field:int, n:int) -> None:
+            for region in communityRegionKeys(cx, cy):
+                row = counts.get((region, day))
+                if row is None:
+                    row = counts[(region, day)] = [0, 0, 0]
+                row[field] += n
+
+        def cell(path:str):
+            # 整数除法 得到小区格子的坐标
+            return (Cast(F(path + '__position_x') / COMMUNITY_SIZE, IntegerField()),
+                    Cast(F(path + '__position_y') / COMMUNITY_SIZE, IntegerField()))
+
+        sent:Dict[int,Dict[date,int]] = {}
+        for db in Shards.databases():
+            groups = (
+                (0, User.objects.using(db).exclude(vlocation=None), 'vlocation', 'reg_date'),
+                (2, Letter.objects.using(db).exclude(receiver__vlocation=None), 'receiver__vlocation', 'recv_time'),
+            )
+            for field, queryset, path, timeField in groups:
+                cx, cy = cell(path)
+                rows = queryset.values(cx=cx, cy=cy, day=TruncDate(timeField)).annotate(n=Count('id')) \
+                               .values_list('cx', 'cy', 'day', 'n')
+                for x, y, day, n in rows:
+                    add(x, y, day, field, n)
+            rows = Letter.objects.using(db).exclude(sender_id=None).values('sender_id', day=TruncDate('send_time')) \
+                                 .annotate(n=Count('id')).values_list('sender_id', 'day', 'n')
+            for senderId, day, n in rows:
+                days = sent.setdefault(senderId, {})
+                days[day] = days.get(day, 0) + n
+        for senderId, (x, y) in RegionStats.userCells(sent).items():
+            for day, n in sent[senderId].items():
+                add(x, y, day, 1, n)
+
+        RegionStats.rebuildArchived(add)
+
+        rows = [RegionStat(region=region, level=region.count('-'), bucket=day, residents=row[0],
+                           letters_sent=row[1], letters_received=row[2]) for (region, day), row in counts.items()]
+        with transaction.atomic():
+            RegionStat.objects.all().delete()
+            RegionStat.objects.bulk_create(rows, batch_size=batch)
+        with RegionStats.knownLock:
+            RegionStats.known = set(counts)
+        return len(rows)
+
+    @staticmethod
+    def userCells(userIds:Iterable[int]) -> Dict[int,Tuple[int,int]]:
+        '''{用户id: 所在小区格子的坐标} 到各自的分片分批查询 没有住址的用户不出现在结果中'''
+        groups:Dict[str,List[int]] = {}
+        for userId in userIds:
+            groups.setdefault(Shards.forId(userId), []).append(userId)
+        cells = {}
+        for db, ids in groups.items():
+            for start in range(0, len(ids), 5000):
+                rows = User.objects.using(db).filter(id__in=ids[start:start+5000]).exclude(vlocation=None) \
+                                   .values_list('id', 'vlocation__position_x', 'vlocation__position_y')
+                cells.update((userId, (x // COMMUNITY_SIZE, y // COMMUNITY_SIZE)) for userId, x, y in rows)
+        return cells
+
+    @staticmethod
+    def rebuildArchived(add:Callable) -> None:
+        '''
+        已归档并从数据库删除的信件 寄出的记在寄信人的outbox归档中 收到的记在收信人的inbox归档中
+        归档后尚未删除的信件已经在数据库中统计过 跳过 信件id即可确定其所在的分片
+        '''
+        root = Path(archiveConfig()['DIR'])
+        if not root.is_dir():
+            return
+        userIds = [int(path.name) for path in root.glob('*/*') if path.is_dir() and path.name.isdigit()]
+        for userId, (cx, cy) in RegionStats.userCells(userIds).items():
+            for box, field, timeIndex in (('outbox', 1, RECORD_SEND_TIME), ('inbox', 2, RECORD_RECV_TIME)):
+                archive = LetterArchive(userId, box)
+                for seg in archive.index['segments']:
+                    shards:Dict[str,List[int]] = {}
+                    for letterId in seg['ids']:
+                        shards.setdefault(Shards.forId(letterId), []).append(letterId)
+                    hot = set()
+                    for db, ids in shards.items():
+                        hot.update(Letter.objects.using(db).filter(id__in=ids).values_list('id', flat=True))
+                    days:Dict[date,int] = {}
+                    for record in loadSegment(str(archive.dir / seg['file'])):
+                        if record[RECORD_ID] not in hot:
+                            day = date.fromisoformat(record[timeIndex][:10])
+                            days[day] = days.get(day, 0) + 1
+                    for day, n in days.items():
+                        add(cx, cy, day, field, n)
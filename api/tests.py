@@ -1,3 +1,856 @@
-from django.test import TestCase
+from __future__ import annotations
+from typing import *
+
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from .compression import ContentCompressor, ZlibCodec
+from .counters import UnreadCounter
+from .delivery import DeliveryScheduler
+from .logic import TOKEN_ACCESS_SCOPE, TOKEN_DURATION, APIInterface, JsonResponse, Tools
+from .mailbox import Mailbox
+from .matching import MatchPool
+from .passwords import PasswordService, PasswordServiceBusy
+from .realtime import PushHub, PushRouter
+from .revocation import TokenRevocation
+from .search import LetterSearch
+from .sharding import SHARD_ID_BITS, ShardRouter, Shards
+from .spatial import NearbyIndex
+from .tiles import np
 
 # Create your tests here.
+
+
+class TokenMixin:
+    '''吊销表换成临时文件 不写BASE_DIR下的revocation.bin'''
+    def setUpTokens(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        patcher = mock.patch.object(TokenRevocation, 'INSTANCE', TokenRevocation(os.path.join(tmpdir, 'revocation.bin'), 1024))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def accessToken(self, username):
+        from .models import User
+        return User.createToken(username, int(Tools.getNow()), TOKEN_DURATION, TOKEN_ACCESS_SCOPE)
+
+
+class EchoInterface(APIInterface):
+    '''测试用 logic中途让出CPU 并发的请求会交错执行'''
+    methods = ['GET']
+    args = {
+        'value': (str, None)
+    }
+    allow_errors = []
+
+    def logic(self, value):
+        time.sleep(0.001)
+        if value.startswith('raw'):
+            self.response = HttpResponse(value + self.request.GET['value'])
+            return True
+        self.result = {'value': value}
+        return True
+
+
+class APIInterfaceTest(SimpleTestCase):
+    def test_concurrent_requests_do_not_share_state(self):
+        view = EchoInterface.get_view()
+        factory = RequestFactory()
+        mismatches = []
+
+        def worker(i):
+            value = ('raw%d' if i % 2 else 'json%d') % i
+            response = view(factory.get('/', {'value': value}))
+            body = response.content.decode()
+            expected = value + value if i % 2 else '"value": "%s"' % value
+            if expected not in body:
+                mismatches.append((value, body))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(200)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mismatches, [])
+
+    def test_missing_arg(self):
+        view = EchoInterface.get_view()
+        response = view(RequestFactory().get('/'))
+        self.assertIn('"code": %d' % JsonResponse.ERR_ARG, response.content.decode())
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class MapTileTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = override_settings(MAP_TILES={'DIR': self.tmpdir, 'HEAT_TTL': 600})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_if_none_match(self):
+        client = Client()
+        url = '/myletter/api/map/tile/'
+        response = client.get(url, {'z': 0, 'x': 0, 'y': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        etag = response['ETag']
+        self.assertEqual(client.get(url, {'z': 0, 'x': 0, 'y': 0}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # 别的瓦片的ETag不匹配
+        response = client.get(url, {'z': 1, 'x': 1, 'y': 0}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class UpgradeSchemaTest(TransactionTestCase):
+    def columns(self, table):
+        with connection.cursor() as cursor:
+            return {column.name for column in connection.introspection.get_table_description(cursor, table)}
+
+    def constraints(self, table):
+        with connection.cursor() as cursor:
+            return connection.introspection.get_constraints(cursor, table)
+
+    def test_adds_missing_columns_and_indexes(self):
+        from .models import User
+        user = User.objects.create(username='olduser1', password_hash='x', nickname='老用户')
+        # 还原成没有匹配字段、没有收件箱索引的旧表
+        with connection.cursor() as cursor:
+            for name, info in self.constraints('api_user').items():
+                if info['index'] and info['columns'] in (['exp'], ['matchable_time']):
+                    cursor.execute('DROP INDEX "%s"' % name)
+            cursor.execute('ALTER TABLE api_user DROP COLUMN matchable_time')
+            cursor.execute('ALTER TABLE api_user DROP COLUMN matchable')
+            cursor.execute('DROP INDEX letter_inbox_idx')
+        self.assertNotIn('matchable', self.columns('api_user'))
+
+        out = io.StringIO()
+        call_command('upgrade_schema', dry_run=True, stdout=out)
+        self.assertIn('default: add column api_user.matchable (dry run)', out.getvalue())
+        self.assertNotIn('matchable', self.columns('api_user'))
+
+        out = io.StringIO()
+        call_command('upgrade_schema', stdout=out)
+        lines = out.getvalue().splitlines()
+        for change in ('add column api_user.matchable', 'add column api_user.matchable_time',
+                       'add index on api_user.exp', 'add index on api_user.matchable_time', 'add index letter_inbox_idx'):
+            self.assertIn('default: ' + change, lines)
+        self.assertIn('run rebuild_search_index and rebuild_region_stats', lines[-1])
+        self.assertTrue({'matchable', 'matchable_time'} <= self.columns('api_user'))
+        self.assertIn('letter_inbox_idx', self.constraints('api_letter'))
+        indexed = [info['columns'] for info in self.constraints('api_user').values() if info['index']]
+        self.assertIn(['exp'], indexed)
+        self.assertIn(['matchable_time'], indexed)
+        # 已有的行取默认值
+        self.assertFalse(User.objects.get(id=user.id).matchable)
+
+        out = io.StringIO()
+        call_command('upgrade_schema', stdout=out)
+        self.assertIn('up to date', out.getvalue())
+
+
+class LongPollTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(PushHub, 'INSTANCE', PushHub())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = PushRouter(None)
+
+    async def poll(self, **query):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            return {'type': 'http.request'}
+
+        parsed = {key: [str(value)] for key, value in query.items()}
+        with mock.patch.object(PushRouter, 'authenticate', return_value=('alice', parsed)):
+            await self.router.longPoll({'type': 'http'}, receive, send)
+        return json.loads(sent[-1]['body'])['data']
+
+    def test_events_between_polls_are_not_lost(self):
+        async def scenario():
+            hub = PushHub.getInstance()
+            first = await self.poll(timeout=0)
+            self.assertEqual(first['events'], [])
+            # 两次轮询之间没有连接时到达的消息
+            now = time.time()
+            hub.deliverLocal('alice', {'type': 'letter', 'letter_id': 7, 'recv_time': now})
+            hub.deliverLocal('bob', {'type': 'letter', 'letter_id': 8, 'recv_time': now})
+            second = await self.poll(timeout=5, since=first['cursor'])
+            self.assertEqual([event['letter_id'] for event in second['events']], [7])
+            self.assertFalse(second['reset'])
+            # 已收到的不再重复
+            third = await self.poll(timeout=0.01, since=second['cursor'])
+            self.assertEqual(third['events'], [])
+            self.assertEqual(third['cursor'], second['cursor'])
+            # 早于保留范围的游标可能有遗漏
+            stale = await self.poll(timeout=0, since='1.0_0')
+            self.assertTrue(stale['reset'])
+
+        asyncio.run(scenario())
+
+    def test_bad_cursor(self):
+        async def scenario():
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            with mock.patch.object(PushRouter, 'authenticate', return_value=('alice', {'since': ['x']})):
+                await self.router.longPoll({'type': 'http'}, None, send)
+            self.assertEqual(json.loads(sent[-1]['body'])['code'], JsonResponse.ERR_ARGTYPE)
+
+        asyncio.run(scenario())
+
+
+class UnreadCounterTest(TestCase):
+    def setUp(self):
+        from .models import User
+        caches['counter'].clear()
+        self.sender = User.objects.create(username='sender01', password_hash='x', nickname='寄信人')
+        self.receiver = User.objects.create(username='receiver01', password_hash='x', nickname='收信人')
+
+    def send(self, delay):
+        from .models import Letter
+        recvTime = Tools.getNow('datetime') + timedelta(seconds=delay)
+        letter = Letter.objects.create(sender=self.sender, receiver=self.receiver, receiver_alias='收信人',
+                                       recv_time=recvTime, content='你好')
+        UnreadCounter.onSend(self.receiver.username, recvTime)
+        return letter
+
+    def test_counts_follow_arrival_and_read(self):
+        self.send(-1)
+        self.assertEqual(UnreadCounter.get('receiver01'), 1)
+        # 已缓存 之后的修改都是增量的
+        self.send(-1)
+        later = self.send(3600)
+        self.assertEqual(UnreadCounter.get('receiver01'), 2)
+        UnreadCounter.onRead('receiver01')
+        self.assertEqual(UnreadCounter.get('receiver01'), 1)
+        # 到达后不需要任何通知就计入
+        with mock.patch.object(Tools, 'getNow', return_value=later.recv_time.timestamp() + 1):
+            self.assertEqual(UnreadCounter.get('receiver01'), 2)
+
+    def test_concurrent_updates_are_not_lost(self):
+        self.assertEqual(UnreadCounter.get('receiver01'), 0)
+        recvTime = Tools.getNow('datetime') + timedelta(seconds=3600)
+        threads = [threading.Thread(target=UnreadCounter.onSend, args=('receiver01', recvTime)) for _ in range(50)]
+        threads += [threading.Thread(target=UnreadCounter.onSend, args=('receiver01', Tools.getNow('datetime')))
+                    for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(UnreadCounter.get('receiver01'), 50)
+        with mock.patch.object(Tools, 'getNow', return_value=recvTime.timestamp() + 1):
+            self.assertEqual(UnreadCounter.get('receiver01'), 100)
+
+
+class DeliveryReloadTest(TestCase):
+    def test_reload_after_recompute(self):
+        from .models import Letter, User
+        sender = User.objects.create(username='sender02', password_hash='x', nickname='寄信人')
+        receiver = User.objects.create(username='receiver02', password_hash='x', nickname='收信人')
+        now = Tools.getNow('datetime')
+        letters = [Letter.objects.create(sender=sender, receiver=receiver, receiver_alias='收信人',
+                                         recv_time=now + timedelta(hours=i + 1), content='你好') for i in range(3)]
+        scheduler = DeliveryScheduler()
+        reloads = []
+        scheduler.addReloadListener(lambda: reloads.append(True))
+        scheduler.recover()
+        self.assertEqual(len(scheduler.heap), 3)
+
+        # 模拟recompute_delivery: 一封提前到过去 一封推迟
+        Letter.objects.filter(id=letters[0].id).update(recv_time=now - timedelta(days=1))
+        Letter.objects.filter(id=letters[1].id).update(recv_time=now + timedelta(days=1))
+        scheduler.poll()
+        self.assertEqual(reloads, [])
+        DeliveryScheduler.bumpGeneration()
+        scheduler.poll()
+        self.assertEqual(reloads, [True])
+        due = scheduler.popDue(Tools.getNow())
+        self.assertEqual([event.letter_id for event in due], [letters[0].id])
+        self.assertEqual(sorted(event.letter_id for _, _, event in scheduler.heap), [letters[1].id, letters[2].id])
+        self.assertEqual(max(t for t, _, _ in scheduler.heap), (now + timedelta(days=1)).timestamp())
+
+
+class MailboxPageTest(TokenMixin, TestCase):
+    def setUp(self):
+        from .models import Letter, User
+        self.setUpTokens()
+        alice = User.objects.create(username='alice001', password_hash='x', nickname='爱丽丝')
+        bob = User.objects.create(username='bob00001', password_hash='x', nickname='鲍勃')
+        now = Tools.getNow('datetime')
+        # 同一到达时间的多封信 游标要按id区分
+        self.arrived = [Letter.objects.create(sender=bob, receiver=alice, receiver_alias='爱丽丝', content='信%d' % i,
+                                              recv_time=now - timedelta(minutes=i // 2)).id for i in range(7)]
+        Letter.objects.create(sender=bob, receiver=alice, receiver_alias='爱丽丝', content='途中',
+                              recv_time=now + timedelta(days=1))
+
+    def pages(self, url, username):
+        client = Client()
+        token = self.accessToken(username)
+        ids, cursor = [], ''
+        while True:
+            data = json.loads(client.get(url, {'token': token, 'cursor': cursor, 'limit': 3}).content)
+            self.assertEqual(data['code'], 0)
+            self.assertLessEqual(len(data['data']['letters']), 3)
+            ids += [letter['id'] for letter in data['data']['letters']]
+            cursor = data['data']['next_cursor']
+            if cursor is None:
+                return ids, data['data']['profiles']
+
+    def test_inbox_pages(self):
+        ids, profiles = self.pages('/myletter/api/letter/inbox/', 'alice001')
+        # 按(到达时间, id)倒序 未到达的不在收件箱中
+        self.assertEqual(ids, sorted(self.arrived, key=lambda i: (self.arrived.index(i) // 2, -i)))
+        self.assertIn('bob00001', profiles)
+
+    def test_outbox_pages(self):
+        ids, profiles = self.pages('/myletter/api/letter/outbox/', 'bob00001')
+        self.assertEqual(len(ids), 8)
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertIn('alice001', profiles)
+
+    def test_bad_cursor(self):
+        data = json.loads(Client().get('/myletter/api/letter/inbox/', {'token': self.accessToken('alice001'),
+                                                                      'cursor': '!!'}).content)
+        self.assertEqual(data['code'], JsonResponse.ERR_QUERY_CURSOR)
+
+
+def createResident(username, x, y, **fields):
+    from .models import User, VirtualLocation
+    vlocation = VirtualLocation.createLocationByPos((x, y))
+    vlocation.save()
+    return User.objects.create(username=username, password_hash='x', nickname=username, vlocation=vlocation, **fields)
+
+
+class KeysetCursorTest(SimpleTestCase):
+    def test_round_trip(self):
+        position = (Tools.getNow('datetime'), 123456789)
+        self.assertEqual(Mailbox.decodeCursor(Mailbox.encodeCursor(*position)), position)
+        score = (-3.0625, 42)
+        self.assertEqual(LetterSearch.decodeCursor(LetterSearch.encodeCursor(*score)), score)
+
+    def test_malformed(self):
+        for cursor in ('!!', 'bm90IGEgY3Vyc29y', Mailbox.encodeCursor(Tools.getNow('datetime'), 1)[:-4]):
+            self.assertIsNone(Mailbox.decodeCursor(cursor))
+
+
+class LetterSearchTest(TestCase):
+    def test_segment(self):
+        self.assertEqual(LetterSearch.segment('你好世界').split(), ['你好', '好世', '世界', '你', '好', '世', '界'])
+        self.assertEqual(LetterSearch.segment('你好世界', unigrams=False).split(), ['你好', '好世', '世界'])
+        self.assertEqual(LetterSearch.segment('猫 and 咖啡').split(), ['猫', 'and', '咖啡', '咖', '啡'])
+        self.assertEqual(LetterSearch.keywords('想念 the远方!'), ['想念', 'the', '远方'])
+
+    def test_search_own_arrived_letters(self):
+        from .models import Letter
+        alice = createResident('alice002', 10, 10)
+        bob = createResident('bob00002', 20, 20)
+        carol = createResident('carol002', 30, 30)
+        now = Tools.getNow('datetime')
+
+        def send(sender, receiver, content, delay=-60):
+            return Letter.objects.create(sender=sender, receiver=receiver, receiver_alias='x', content=content,
+                                         recv_time=now + timedelta(seconds=delay)).id
+
+        arrived = send(bob, alice, '今天窗外在下雨 想念远方的朋友')
+        sent = send(alice, bob, '远方的朋友 你好')
+        send(bob, carol, '远方的朋友 别人的信')
+        send(bob, alice, '远方的朋友 还在路上', delay=3600)
+
+        hits, _ = LetterSearch.search(alice, '远方 朋友')
+        self.assertEqual(sorted(letter.id for letter, _ in hits), sorted([arrived, sent]))
+        hits, _ = LetterSearch.search(alice, '下雨')
+        self.assertEqual([letter.id for letter, _ in hits], [arrived])
+        self.assertEqual(LetterSearch.search(alice, '雨天')[0], [])
+        # 单个汉字 不论在词首还是词尾
+        ending = send(bob, alice, '我们说你好 我的猫')
+        for char in ('好', '猫', '我'):
+            hits, _ = LetterSearch.search(alice, char)
+            self.assertIn(ending, [letter.id for letter, _ in hits], char)
+        hits, _ = LetterSearch.search(alice, '雨')
+        self.assertEqual([letter.id for letter, _ in hits], [arrived])
+        # 修改和删除同步到索引
+        Letter.objects.filter(id=arrived).get().delete()
+        self.assertEqual(LetterSearch.search(alice, '下雨')[0], [])
+
+    def test_archived_letters_stay_searchable(self):
+        from .models import Letter
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        override = override_settings(LETTER_ARCHIVE={'DIR': tmpdir})
+        override.enable()
+        self.addCleanup(override.disable)
+        alice = createResident('alice003', 10, 10)
+        bob = createResident('bob00003', 20, 20)
+        recvTime = Tools.getNow('datetime') - timedelta(days=1)
+        old = Letter.objects.create(sender=bob, receiver=alice, receiver_alias='x', content='很久以前的咖啡馆',
+                                    recv_time=recvTime, has_read=True).id
+        Letter.objects.create(sender=alice, receiver=bob, receiver_alias='x', content='新开的咖啡馆',
+                              recv_time=recvTime)
+        call_command('archive_letters', age_days=0, stdout=io.StringIO())
+        self.assertFalse(Letter.objects.filter(id=old).exists())
+
+        for rebuild in (False, True):
+            if rebuild:
+                # 重建时归档中的信件也要索引
+                self.assertEqual(LetterSearch.rebuild(), 2)
+            hits, _ = LetterSearch.search(alice, '咖啡')
+            self.assertEqual(len(hits), 2)
+            letter, snippet = [hit for hit in hits if hit[0].id == old][0]
+            self.assertEqual(letter.sender.username, 'bob00003')
+            self.assertEqual(snippet['text'], '很久以前的咖啡馆')
+            self.assertEqual([letter.id for letter, _ in LetterSearch.search(bob, '以前')[0]], [old])
+
+
+class ContentCompressorTest(TestCase):
+    def compressor(self, **config):
+        compressor = ContentCompressor()
+        compressor.config.update(config)
+        return compressor
+
+    def test_round_trip(self):
+        text = '你好，好久不见。' * 40
+        for codec in ('raw', 'zlib', 'zlib-dict', 'lzma'):
+            payload = self.compressor(CODEC=codec).encode(text)
+            self.assertEqual(ContentCompressor.getInstance().decode(payload), text)
+            if codec != 'raw':
+                self.assertLess(len(payload), len(text.encode('utf-8')))
+
+    def test_short_and_legacy_content(self):
+        compressor = self.compressor(CODEC='zlib')
+        self.assertEqual(compressor.encode('短信'), b'\x00' + '短信'.encode('utf-8'))
+        self.assertEqual(compressor.decode('压缩之前的正文'), '压缩之前的正文')
+        # 没有训练过字典时zlib-dict退化为zlib
+        self.assertEqual(self.compressor(CODEC='zlib-dict').encode('信' * 200)[0], ZlibCodec.codecId)
+        with self.assertRaises(ValueError):
+            self.compressor(CODEC='brotli').encode('信' * 200)
+
+    def test_field_round_trip(self):
+        from .models import Letter
+        sender = createResident('sender03', 10, 10)
+        content = '窗外的花开了 ' * 50
+        letter = Letter.objects.create(sender=sender, receiver=sender, receiver_alias='x', content=content,
+                                       recv_time=Tools.getNow('datetime'))
+        self.assertEqual(Letter.objects.get(id=letter.id).content, content)
+
+    def test_only_exact_lookups(self):
+        from django.core.exceptions import FieldError
+        from .models import Letter
+        sender = createResident('lookup01', 12, 10)
+        letter = Letter.objects.create(sender=sender, receiver=sender, receiver_alias='x', content='今天天气很好',
+                                       recv_time=Tools.getNow('datetime'))
+        self.assertEqual(list(Letter.objects.filter(content='今天天气很好').values_list('id', flat=True)), [letter.id])
+        self.assertFalse(Letter.objects.filter(content__isnull=True).exists())
+        # 压缩后的字节上按子串比较总是匹配不到 应当报错而不是静默地返回空结果
+        for lookup in ('icontains', 'contains', 'startswith', 'iexact', 'gt'):
+            with self.assertRaises(FieldError, msg=lookup):
+                Letter.objects.filter(**{'content__' + lookup: '天气'}).exists()
+
+
+class TokenRevocationTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        self.path = os.path.join(self.tmpdir, 'revocation.bin')
+
+    def test_revoke_token_and_user(self):
+        table = TokenRevocation(self.path, 64)
+        now = int(Tools.getNow())
+        table.revokeToken('nonce1', now + 60)
+        table.revokeToken('nonce2', now - 1)   # 已过期的token不需要记住
+        self.assertTrue(table.isTokenRevoked('alice', now, 'nonce1'))
+        self.assertFalse(table.isTokenRevoked('alice', now, 'nonce2'))
+        self.assertFalse(table.isTokenRevoked('alice', now, 'nonce3'))
+
+        table.revokeUser('alice')
+        self.assertTrue(table.isTokenRevoked('alice', now, None))
+        self.assertTrue(table.isSessionRevoked('alice', now))
+        self.assertFalse(table.isTokenRevoked('bob', now, None))
+        # 之后签发的不受影响
+        self.assertFalse(table.isTokenRevoked('alice', table.issueTime('alice'), None))
+
+        # 其他进程打开同一个文件时看到相同的表 槽数以文件为准
+        other = TokenRevocation(self.path, 1024)
+        self.assertEqual(other.slots, 64)
+        self.assertTrue(other.isTokenRevoked('alice', now, 'nonce1'))
+
+    def test_compaction_keeps_live_entries(self):
+        table = TokenRevocation(self.path, 64)
+        now = int(Tools.getNow())
+        with mock.patch.object(Tools, 'getNow', return_value=now - 100):
+            for i in range(40):
+                table.revokeToken('old%d' % i, now - 50)
+        with self.assertLogs('api.revocation', 'WARNING'):
+            for i in range(40):
+                table.revokeToken('live%d' % i, now + 60)
+        self.assertTrue(all(table.lookup('n:live%d' % i) is not None for i in range(40)))
+        self.assertTrue(all(table.lookup('n:old%d' % i) is None for i in range(40)))
+        with self.assertRaises(ValueError):
+            TokenRevocation(os.path.join(self.tmpdir, 'other.bin'), 100)
+
+
+@override_settings(PASSWORD_HASHING={'N': 1 << 10, 'R': 8, 'P': 1})
+class PasswordServiceTest(SimpleTestCase):
+    def service(self, **config):
+        from .passwords import passwordConfig
+        return PasswordService(dict(passwordConfig(), **config))
+
+    def test_hash_and_verify(self):
+        service = self.service()
+        passwordHash = service.hash('secret123')
+        self.assertTrue(passwordHash.startswith('scrypt$1024$8$1$'))
+        self.assertNotEqual(passwordHash, service.hash('secret123'))
+        self.assertEqual(service.verify('secret123', passwordHash), (True, None))
+        self.assertEqual(service.verify('secret124', passwordHash), (False, None))
+        self.assertFalse(PasswordService.checkHash('secret123', 'scrypt$broken'))
+
+    def test_legacy_and_outdated_hashes_are_upgraded(self):
+        service = self.service()
+        ok, newHash = service.verify('secret123', Tools.getPasswordHash('secret123'))
+        self.assertTrue(ok)
+        self.assertTrue(service.isCurrent(newHash))
+        self.assertEqual(service.verify('wrong', Tools.getPasswordHash('secret123')), (False, None))
+
+        with override_settings(PASSWORD_HASHING={'N': 1 << 9, 'R': 8, 'P': 1}):
+            oldHash = PasswordService.computeHash('secret123')
+        ok, newHash = service.verify('secret123', oldHash)
+        self.assertTrue(ok)
+        self.assertTrue(newHash.startswith('scrypt$1024$'))
+        self.assertEqual(service.metrics()['rehashed'], 2)
+
+    def test_rejects_when_full(self):
+        service = self.service(WORKERS=1, MAX_PENDING=1, TIMEOUT=5)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        thread = threading.Thread(target=service.run, args=(block,))
+        thread.start()
+        started.wait(5)
+        with self.assertRaises(PasswordServiceBusy), self.assertLogs('api.passwords', 'WARNING'):
+            service.hash('secret123')
+        release.set()
+        thread.join()
+        self.assertEqual(service.metrics()['rejected'], 1)
+        self.assertTrue(service.hash('secret123').startswith('scrypt$'))
+
+    def test_timeout(self):
+        service = self.service(WORKERS=1, MAX_PENDING=4, TIMEOUT=0.05)
+        with self.assertRaises(PasswordServiceBusy):
+            service.run(time.sleep, 0.5)
+        self.assertEqual(service.metrics()['timeouts'], 1)
+
+
+@override_settings(SHARD_DATABASES=['shard0', 'shard1'])
+class ShardRouterTest(SimpleTestCase):
+    def test_ids_and_positions(self):
+        self.assertEqual(Shards.databases(), ['shard0', 'shard1'])
+        self.assertEqual(Shards.idBase('shard1'), 2 << SHARD_ID_BITS)
+        self.assertEqual(Shards.forId(Shards.idBase('shard0') + 5), 'shard0')
+        self.assertEqual(Shards.forId(Shards.idBase('shard1') + 5), 'shard1')
+        # 不属于任何分片的id落在第一个分片
+        self.assertEqual(Shards.forId(5), 'shard0')
+        # 城市id % 分片数
+        self.assertEqual(Shards.forPosition(0, 0), 'shard0')
+        self.assertEqual(Shards.forPosition(480, 0), 'shard1')
+        self.assertEqual(Shards.forRegion('3-5-12'), 'shard1')
+
+    def test_router(self):
+        from .models import Letter, MatchPair, User, VirtualLocation
+        router = ShardRouter()
+        vlocation = VirtualLocation(position_x=500, position_y=10)
+        self.assertEqual(router.db_for_write(VirtualLocation, instance=vlocation), 'shard1')
+        user = User(username='x', vlocation_id=Shards.idBase('shard1') + 1)
+        self.assertEqual(router.db_for_write(User, instance=user), 'shard1')
+        letter = Letter(receiver_id=Shards.idBase('shard0') + 7)
+        self.assertEqual(router.db_for_write(Letter, instance=letter), 'shard0')
+        user.pk = Shards.idBase('shard0') + 3
+        self.assertEqual(router.db_for_read(User, instance=user), 'shard0')
+        # 没有对象可依据的分片查询不路由 非分片模型在default
+        self.assertIsNone(router.db_for_read(User))
+        self.assertEqual(router.db_for_read(MatchPair), 'default')
+        self.assertTrue(router.allow_migrate('shard0', 'api', 'letter'))
+        self.assertFalse(router.allow_migrate('default', 'api', 'letter'))
+        self.assertFalse(router.allow_migrate('shard0', 'api', 'matchpair'))
+
+    def test_disabled(self):
+        with override_settings(SHARD_DATABASES=[]):
+            self.assertEqual(Shards.databases(), ['default'])
+            self.assertEqual(Shards.forId(Shards.idBase('shard1') + 1), 'default')
+
+
+class MatchPoolTest(TestCase):
+    def setUp(self):
+        # 0和1在同一城市 2在另一城市 3不愿被匹配
+        self.users = [createResident('match%03d' % i, x, y, matchable=i != 3, matchable_time=Tools.getNow('datetime'))
+                      for i, (x, y) in enumerate([(10, 10), (50, 50), (1000, 1000), (20, 20)])]
+        self.pool = MatchPool()
+
+    def test_match_each_pair_once(self):
+        from .models import MatchPair
+        me = self.users[0]
+        partners = set()
+        for _ in range(2):
+            partner = self.pool.match(me, 'world')
+            self.assertIsNotNone(partner)
+            partners.add(partner.id)
+        self.assertEqual(partners, {self.users[1].id, self.users[2].id})
+        self.assertIsNone(self.pool.match(me, 'world'))
+        self.assertTrue(MatchPair.objects.filter(user_id=self.users[1].id, partner_id=me.id).exists())
+        # 另一个进程的池从MatchPair得知已匹配过
+        self.assertIsNone(MatchPool().match(me, 'world'))
+
+    def test_scope_and_remove(self):
+        me = self.users[0]
+        self.pool.refresh()
+        self.assertEqual(self.pool.match(me, 'city').id, self.users[1].id)
+        self.pool.remove(self.users[2].id)
+        self.assertIsNone(self.pool.match(me, 'world'))
+        self.pool.add(self.users[2].id, 1000, 1000)
+        self.assertEqual(self.pool.match(me, 'world').id, self.users[2].id)
+
+
+class NearbyIndexTest(SimpleTestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        points = [(i + 1, rng.randrange(1920), rng.randrange(1920)) for i in range(3000)]
+        index = NearbyIndex()
+        index.build(points)
+        for _ in range(20):
+            x, y = rng.randrange(1920), rng.randrange(1920)
+            expected = sorted((math.hypot(px - x, py - y), uid, px, py) for uid, px, py in points)
+            self.assertEqual(index.nearest(x, y, 5), expected[:5])
+            within = [hit for hit in expected if hit[0] <= 100][:50]
+            self.assertEqual(index.nearest(x, y, 50, 100), within)
+
+    def test_add_remove_exclude(self):
+        index = NearbyIndex()
+        index.build([(1, 100, 100), (2, 101, 100), (3, 300, 300)])
+        self.assertEqual([hit[1] for hit in index.nearest(100, 100, 2, exclude=1)], [2, 3])
+        index.add(4, 100, 101)
+        self.assertTrue(index.remove(2, 101, 100))
+        self.assertFalse(index.remove(2, 101, 100))
+        self.assertEqual([hit[1] for hit in index.nearest(100, 100, 3)], [1, 4, 3])
+
+
+class NearbyIndexRefreshTest(TestCase):
+    def test_refresh_loads_new_users_once(self):
+        first = createResident('near0001', 10, 10)
+        index = NearbyIndex()
+        index.refresh()
+        self.assertEqual(index.count, 1)
+        # 本进程注册时直接add 其他进程注册的由refresh拉取
+        local = createResident('near0002', 12, 10)
+        index.add(local.id, 12, 10)
+        other = createResident('near0003', 15, 10)
+        index.lastRefresh = 0.0
+        index.refresh()
+        self.assertEqual(index.count, 3)
+        self.assertEqual([hit[1] for hit in index.nearest(10, 10, 5)], [first.id, local.id, other.id])
+
+
+class MailboxExportTest(TestCase):
+    def setUp(self):
+        from .archive import LetterArchive, formatTime
+        from .models import User
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        override = override_settings(LETTER_ARCHIVE={'DIR': tmpdir, 'SEGMENT_LETTERS': 3})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = User.objects.create(username='alice001', password_hash='x', nickname='爱丽丝')
+        bob = User.objects.create(username='bob00001', password_hash='x', nickname='鲍勃')
+        base = Tools.getNow('datetime') - timedelta(days=400)
+        rng = random.Random(0)
+
+        def record(letterId, sender, receiver):
+            # 时间与id无关 各段的id范围相互重叠
+            time = formatTime(base + timedelta(hours=rng.randrange(1000)))
+            return [letterId, sender.id, receiver.id, '别名', True, time, time, '信%d' % letterId]
+
+        inbox = [record(i, bob, self.alice) for i in range(1, 20, 2)]
+        outbox = [record(i, self.alice, bob) for i in range(2, 20, 2)]
+        selfLetter = record(25, self.alice, self.alice)
+        LetterArchive(self.alice.id, 'inbox').append(inbox + [selfLetter])
+        LetterArchive(self.alice.id, 'outbox').append(outbox + [selfLetter])
+
+    def test_archived_letters_merge_by_id(self):
+        from .export import MailboxExport
+        letters = list(MailboxExport(self.alice).letters())
+        self.assertEqual([letter['id'] for letter in letters], list(range(1, 20)) + [25])
+        self.assertEqual(letters[0]['box'], 'inbox')
+        self.assertEqual(letters[1]['box'], 'outbox')
+        self.assertEqual(letters[1]['receiver'], 'bob00001')
+        self.assertEqual([letter['id'] for letter in MailboxExport(self.alice, after=12).letters()],
+                         list(range(13, 20)) + [25])
+
+
+class RegionStatsTest(TestCase):
+    def setUp(self):
+        from .stats import RegionStats
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        override = override_settings(LETTER_ARCHIVE={'DIR': tmpdir})
+        override.enable()
+        self.addCleanup(override.disable)
+        # 已插入的行随每个测试的事务回滚 不能沿用其他测试记住的
+        for patcher in (mock.patch.object(RegionStats, 'known', set()),
+                        mock.patch.object(RegionStats, 'INSTANCE', RegionStats())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(RegionStats.INSTANCE.stop)
+
+    def rows(self):
+        from .models import RegionStat
+        return sorted(RegionStat.objects.exclude(residents=0, letters_sent=0, letters_received=0)
+                      .values_list('region', 'level', 'bucket', 'residents', 'letters_sent', 'letters_received'))
+
+    def test_incremental_matches_rebuild(self):
+        from .models import Letter
+        from .stats import RegionStats
+        now = Tools.getNow('datetime')
+        # 同一小区、同城的另一市区、另一个城市
+        users = [createResident('stat%04d' % i, x, y) for i, (x, y) in
+                 enumerate([(5, 5), (15, 25), (200, 10), (1000, 1500)])]
+        for user in users:
+            RegionStats.onRegister(user.vlocation, user.reg_date)
+        for i, (s, r) in enumerate([(0, 1), (0, 2), (2, 3), (3, 0), (1, 0)]):
+            sendTime = now - timedelta(days=i)
+            recvTime = sendTime + timedelta(hours=30)
+            letter = Letter.objects.create(sender=users[s], receiver=users[r], receiver_alias='x', content='信',
+                                           recv_time=recvTime)
+            # send_time是auto_now_add
+            Letter.objects.filter(id=letter.id).update(send_time=sendTime)
+            RegionStats.onSend(users[s].vlocation, users[r].vlocation, sendTime, recvTime)
+        # 缓冲中的增量在flush之前不写数据库
+        self.assertEqual(self.rows(), [])
+        self.assertGreater(RegionStats.INSTANCE.flush(), 0)
+        incremental = self.rows()
+        self.assertEqual(sum(row[3] for row in incremental if row[1] == 0), 4)
+        self.assertEqual(sum(row[4] for row in incremental if row[1] == 2), 5)
+
+        RegionStats.rebuild()
+        self.assertEqual(self.rows(), incremental)
+        result = RegionStats.query('city', None, 0)
+        self.assertEqual(sum(region['residents'] for region in result['regions']), 4)
+
+
+class ProfileCacheTest(TestCase):
+    def setUp(self):
+        caches['profile'].clear()
+
+    def test_invalidation(self):
+        from .models import User
+        from .profiles import ProfileCache
+        self.assertIsNone(ProfileCache.getProfile('prof0001'))
+        # “不存在”也被缓存 注册（post_save）时删除
+        user = createResident('prof0001', 50, 60)
+        profile = ProfileCache.getProfile('prof0001')
+        self.assertEqual(profile['nickname'], 'prof0001')
+        self.assertIsNotNone(profile['address'])
+
+        user.nickname = '新昵称'
+        user.save(update_fields=['nickname'])
+        self.assertEqual(ProfileCache.getProfile('prof0001')['nickname'], '新昵称')
+        # 只写无关字段不删除缓存
+        with mock.patch.object(ProfileCache, 'invalidate') as invalidate:
+            user.session = 'x'
+            user.save(update_fields=['session'])
+            invalidate.assert_not_called()
+        # update不触发信号 需要调用方invalidate
+        User.objects.filter(id=user.id).update(nickname='改了')
+        self.assertEqual(ProfileCache.getProfile('prof0001')['nickname'], '新昵称')
+        ProfileCache.invalidate(['prof0001'])
+        self.assertEqual(ProfileCache.getProfile('prof0001')['nickname'], '改了')
+
+
+class ExpLedgerTest(TestCase):
+    def test_flush_and_retry(self):
+        from .experience import ExpLedger
+        from .models import User
+        from .profiles import ProfileCache
+        caches['profile'].clear()
+        user = createResident('exp00001', 70, 80)
+        ledger = ExpLedger()
+        ledger.config['FLUSH_INTERVAL'] = 3600
+        self.addCleanup(ledger.stop)
+        ledger.award(user, 'SEND')
+        ledger.award(user, 'LOGIN')
+        self.assertEqual(ledger.pendingExp(user.id), 6)
+        self.assertEqual(ProfileCache.getProfile('exp00001')['exp'], 0)
+
+        # 写入失败时增量放回缓冲 与之后的增量合并
+        with mock.patch('api.experience.Shards.forId', return_value='missing'), \
+             self.assertLogs('api.experience', 'ERROR'):
+            self.assertEqual(ledger.flush(), 0)
+        ledger.award(user, 'RECEIVE')
+        self.assertEqual(ledger.pendingExp(user.id), 8)
+        self.assertEqual(User.objects.get(id=user.id).exp, 0)
+
+        self.assertEqual(ledger.flush(), 1)
+        self.assertEqual(ledger.pendingExp(user.id), 0)
+        self.assertEqual(User.objects.get(id=user.id).exp, 8)
+        # 写入后资料缓存失效
+        self.assertEqual(ProfileCache.getProfile('exp00001')['exp'], 8)
+        self.assertEqual(ledger.flush(), 0)
+
+
+class ImportUsersTest(TestCase):
+    def test_rejections(self):
+        from .models import User
+        createResident('taken001', 90, 90)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        source = os.path.join(tmpdir, 'users.csv')
+        rejects = os.path.join(tmpdir, 'rejects.jsonl')
+        with open(source, 'w', encoding='utf-8', newline='') as f:
+            f.write('username,password,nickname\n'
+                    'good0001,password1,好人\n'
+                    'good0001,password2,重复\n'        # 输入中重复
+                    'taken001,password3,已存在\n'      # 数据库中已存在
+                    'no,password4,太短\n'              # 用户名不合法
+                    'good0002,pw,密码太短\n'
+                    'good0003,password5\n'             # 缺少昵称
+                    'good0004,password6,好人二号\n')
+        output = io.StringIO()
+        call_command('import_users', source, workers=0, batch=3, rejects=rejects, stdout=output)
+
+        self.assertIn('imported 2 users', output.getvalue())
+        with open(rejects, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(sorted((row['line'], row['code']) for row in rows), [
+            (3, JsonResponse.ERR_INPUT_USERNAME_UNIQUE), (4, JsonResponse.ERR_INPUT_USERNAME_UNIQUE),
+            (5, JsonResponse.ERR_INPUT_USERNAME), (6, JsonResponse.ERR_INPUT_PASSWORD), (7, JsonResponse.ERR_ARG)])
+        self.assertFalse(any('password' in row for row in rows))
+        imported = User.objects.filter(username__in=['good0001', 'good0004']).select_related('vlocation')
+        self.assertEqual(sorted((user.username, user.nickname) for user in imported),
+                         [('good0001', '好人'), ('good0004', '好人二号')])
+        self.assertTrue(all(user.vlocation is not None for user in imported))
+        self.assertEqual(User.objects.get(username='taken001').nickname, 'taken001')
@@ -0,0 +1,271 @@
+from __future__ import annotations
+from typing import *
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+
+from django.conf import settings
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError: # numpy是可选依赖 没有安装时地图瓦片不可用
+    np = None
+
+from .models import COMMUNITY_SIZE
+from .routing import BLOCK_SIZE, CITY_SIZE, WORLD_SIZE
+from .sharding import Shards
+
+
+# 默认配置 可在settings.MAP_TILES中覆盖
+DEFAULT_TILE_CONFIG:Dict[str,Any] = {
+    'DIR': Path(settings.BASE_DIR) / 'tiles',
+    'HEAT_TTL': 600,            # 秒 信件流量热度的重新统计间隔
+}
+
+TILE_SIZE = 256
+MAX_ZOOM = 5                    # z级时整个世界为2^z*2^z个瓦片 z=5时每格约4.3像素
+TILE_LAYERS = ('base', 'heat')  # base: 已入住的地址和行政边界 heat: base之上叠加各小区的信件流量
+REFRESH_INTERVAL = 5            # 秒 渲染时若距上次同步超过此时间 拉取其他进程注册的新用户
+
+COMMUNITY_GRID = WORLD_SIZE // COMMUNITY_SIZE
+
+# 颜色 RGB
+BACKGROUND = (246, 241, 230)
+OCCUPIED = (52, 84, 140)
+BOUNDARIES = ((CITY_SIZE, 0, (90, 70, 60)), (BLOCK_SIZE, 0, (150, 130, 115)), (COMMUNITY_SIZE, 2, (205, 192, 175)))
+HEAT = (220, 60, 30)
+
+
+def tileConfig() -> Dict[str,Any]:
+    config = dict(DEFAULT_TILE_CONFIG)
+    config.update(getattr(settings, 'MAP_TILES', {}))
+    return config
+
+
+def tileEtag(data:bytes) -> str:
+    return '"%s"' % hashlib.sha1(data).hexdigest()[:20]
+
+
+class WorldMap:
+    '''
+    虚拟世界地图瓦片
+
+    已入住的地址存为1920*1920的占用位图 渲染时用它的二维前缀和求出每个像素覆盖的格子中有多少已入住
+    因此任意缩放级别都是几次numpy整体索引 不需要逐点绘制
+    信件流量按小区聚合（寄出和收到各算一次）由SQL分组统计 每HEAT_TTL秒重新统计一次
+
+    渲染好的瓦片缓存在 <DIR>/<layer>/<z>/<x>/<y>.png ETag为内容的哈希
+    新用户注册时只删除各缩放级别中其坐标所在的瓦片 其他进程在同步到新用户时也会删除一次
+    以免在同步之前按旧数据渲染的瓦片留在缓存中
+    热度图的目录名带有热度数据的哈希 重新统计后旧目录整体作废
+    '''
+    INSTANCE = None
+    LOCK = threading.Lock()
+    @staticmethod
+    def getInstance() -> WorldMap:
+        if WorldMap.INSTANCE is None:
+            with WorldMap.LOCK:
+                if WorldMap.INSTANCE is None:
+                    worldMap = WorldMap()
+                    worldMap.refresh()
+                    WorldMap.INSTANCE = worldMap
+        return WorldMap.INSTANCE
+
+    ##############################################
+
+    def __init__(self):
+        self.occupancy = np.zeros((WORLD_SIZE, WORLD_SIZE), dtype=np.uint8) # [y, x]
+        self.prefix = None          # 占用位图的二维前缀和 占用变化后重新计算
+        self.heat = np.zeros((COMMUNITY_GRID, COMMUNITY_GRID), dtype=np.float64) # [cy, cx]
+        self.heatVersion = ''
+        self.heatTime = 0.0
+        self.lastUserIds:Dict[str,int] = {}     # 每个数据库中已拉取的最大用户id
+        self.lastRefresh = 0.0
+        self.lock = threading.Lock()
+
+    def occupy(self, x:int, y:int) -> None:
+        with self.lock:
+            self.occupancy[y, x] = 1
+            self.prefix = None
+
+    def refresh(self) -> None:
+        '''拉取上次同步之后注册的用户 并删除他们所在的瓦片'''
+        from .models import User
+        now = time.time()
+        if now - self.lastRefresh < REFRESH_INTERVAL:
+            return
+        first = self.lastRefresh == 0.0
+        self.lastRefresh = now
+        xs, ys = [], []
+        lastUserIds = dict(self.lastUserIds)
+        for db in Shards.databases():
+            rows = User.objects.using(db).filter(id__gt=lastUserIds.get(db, 0)).exclude(vlocation=None).order_by('id') \
+                               .values_list('id', 'vlocation__position_x', 'vlocation__position_y')
+            for userId, x, y in rows.iterator(chunk_size=20000):
+                lastUserIds[db] = userId
+                xs.append(x)
+                ys.append(y)
+        if not xs:
+            return
+        with self.lock:
+            self.occupancy[np.asarray(ys), np.asarray(xs)] = 1
+            self.prefix = None
+            self.lastUserIds = lastUserIds
+        if not first:
+            for x, y in zip(xs, ys):
+                WorldMap.invalidate(x, y)
+
+    def refreshHeat(self) -> None:
+        from django.db.models import Count, F, IntegerField
+        from django.db.models.functions import Cast
+        from .models import Letter
+        now = time.time()
+        if now - self.heatTime < tileConfig()['HEAT_TTL']:
+            return
+        self.heatTime = now
+        heat = np.zeros((COMMUNITY_GRID, COMMUNITY_GRID), dtype=np.float64)
+        for db in Shards.databases():
+            # 分片时寄信人可能在其他分片 JOIN不到 按寄信人汇总后再取其坐标
+            sides = ('receiver',) if Shards.enabled() else ('sender', 'receiver')
+            for side in sides:
+                # 整数除法 得到小区格子的坐标
+                rows = Letter.objects.using(db).filter(**{side + '__vlocation__isnull': False}).values(
+                    cx=Cast(F(side + '__vlocation__position_x') / COMMUNITY_SIZE, IntegerField()),
+                    cy=Cast(F(side + '__vlocation__position_y') / COMMUNITY_SIZE, IntegerField())) \
+                    .annotate(n=Count('id')).values_list('cx', 'cy', 'n')
+                for cx, cy, n in rows:
+                    heat[cy, cx] += n
+            if Shards.enabled():
+                counts = dict(Letter.objects.using(db).exclude(sender=None).values('sender_id')
+                                    .annotate(n=Count('id')).values_list('sender_id', 'n'))
+                senders = Shards.usersByIds(counts, 'id', 'vlocation', related=('vlocation',))
+                for senderId, sender in senders.items():
+                    if sender.vlocation is not None:
+                        heat[sender.vlocation.position_y // COMMUNITY_SIZE,
+                             sender.vlocation.position_x // COMMUNITY_SIZE] += counts[senderId]
+        version = hashlib.sha1(heat.tobytes()).hexdigest()[:12]
+        if version != self.heatVersion:
+            self.heat, self.heatVersion = heat, version
+            # 删除其他版本的热度图
+            root = Path(tileConfig()['DIR'])
+            if root.is_dir():
+                for path in root.glob('heat-*'):
+                    if path.name != 'heat-' + version:
+                        shutil.rmtree(path, ignore_errors=True)
+
+    def prefixSum(self):
+        with self.lock:
+            if self.prefix is None:
+                prefix = np.zeros((WORLD_SIZE + 1, WORLD_SIZE + 1), dtype=np.int32)
+                np.cumsum(np.cumsum(self.occupancy, axis=0, dtype=np.int32), axis=1, out=prefix[1:, 1:])
+                self.prefix = prefix
+            return self.prefix
+
+    ##############################################
+
+    @staticmethod
+    def tileRange(z:int, t:int):
+        '''第t个瓦片中每个像素覆盖的格子范围[lo, hi) 至少一格'''
+        world = TILE_SIZE << z
+        edges = (np.arange(TILE_SIZE + 1, dtype=np.int64) + t*TILE_SIZE) * WORLD_SIZE // world
+        lo = edges[:-1]
+        return lo, np.maximum(edges[1:], lo + 1)
+
+    @staticmethod
+    def boundaryPixels(z:int, t:int, size:int):
+        '''第t个瓦片中 位于每size格一条的边界线上的像素'''
+        world = TILE_SIZE << z
+        starts = np.arange(0, WORLD_SIZE + 1, size, dtype=np.int64) * world // WORLD_SIZE - t*TILE_SIZE
+        return starts[(starts >= 0) & (starts < TILE_SIZE)]
+
+    def render(self, layer:str, z:int, x:int, y:int) -> bytes:
+        '''渲染一个瓦片 返回PNG x为横向（世界x坐标）编号 y为纵向编号'''
+        x0, x1 = WorldMap.tileRange(z, x)
+        y0, y1 = WorldMap.tileRange(z, y)
+        prefix = self.prefixSum()
+        count = (prefix[np.ix_(y1, x1)] - prefix[np.ix_(y0, x1)] - prefix[np.ix_(y1, x0)] + prefix[np.ix_(y0, x0)])
+        density = count / ((y1 - y0)[:, None] * (x1 - x0)[None, :])
+        # 缩小时入住率普遍较低 开方后更容易看出差别
+        alpha = np.sqrt(density)[:, :, None]
+        image = np.asarray(BACKGROUND, dtype=np.float64) * (1 - alpha) + np.asarray(OCCUPIED, dtype=np.float64) * alpha
+
+        if layer == 'heat':
+            heat = self.heat[np.ix_(y0 // COMMUNITY_SIZE, x0 // COMMUNITY_SIZE)]
+            top = self.heat.max()
+            if top > 0:
+                level = (np.log1p(heat) / np.log1p(top) * 0.7)[:, :, None]
+                image = image * (1 - level) + np.asarray(HEAT, dtype=np.float64) * level
+
+        # 由粗到细画边界 细的不覆盖粗的
+        drawn = np.zeros((TILE_SIZE, TILE_SIZE), dtype=bool)
+        for size, minZoom, color in BOUNDARIES:
+            if z < minZoom:
+                continue
+            mask = np.zeros((TILE_SIZE, TILE_SIZE), dtype=bool)
+            mask[WorldMap.boundaryPixels(z, y, size), :] = True
+            mask[:, WorldMap.boundaryPixels(z, x, size)] = True
+            mask &= ~drawn
+            image[mask] = color
+            drawn |= mask
+
+        buffer = BytesIO()
+        Image.fromarray(image.astype(np.uint8), 'RGB').save(buffer, 'PNG', compress_level=6)
+        return buffer.getvalue()
+
+    ##############################################
+
+    @staticmethod
+    def tilePath(layerDir:str, z:int, x:int, y:int) -> Path:
+        return Path(tileConfig()['DIR']) / layerDir / str(z) / str(x) / ('%d.png' % y)
+
+    def tile(self, layer:str, z:int, x:int, y:int) -> Tuple[bytes,str]:
+        '''取一个瓦片 (PNG, ETag) 缓存中没有时渲染并写入缓存'''
+        self.refresh()
+        layerDir = layer
+        if layer == 'heat':
+            self.refreshHeat()
+            layerDir = 'heat-' + self.heatVersion
+        path = WorldMap.tilePath(layerDir, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            return data, tileEtag(data)
+        except FileNotFoundError:
+            pass
+        data = self.render(layer, z, x, y)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name('%s.%d.%d.tmp' % (path.name, os.getpid(), threading.get_ident()))
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            # 缓存写入失败（如目录被并发清理）不影响本次响应
+            pass
+        return data, tileEtag(data)
+
+    @staticmethod
+    def invalidate(x:int, y:int) -> None:
+        '''删除各缩放级别中包含坐标(x, y)的瓦片 包括当前和旧版本的热度图'''
+        root = Path(tileConfig()['DIR'])
+        if not root.is_dir():
+            return
+        layerDirs = [path.name for path in root.iterdir() if path.is_dir()]
+        for z in range(MAX_ZOOM + 1):
+            world = TILE_SIZE << z
+            # 格子覆盖的像素范围的两端 可能落在相邻的两个瓦片中
+            txs = {x * world // WORLD_SIZE // TILE_SIZE, ((x+1)*world - 1) // WORLD_SIZE // TILE_SIZE}
+            tys = {y * world // WORLD_SIZE // TILE_SIZE, ((y+1)*world - 1) // WORLD_SIZE // TILE_SIZE}
+            for layerDir in layerDirs:
+                for tx in txs:
+                    for ty in tys:
+                        try:
+                            os.remove(WorldMap.tilePath(layerDir, z, tx, ty))
+                        except FileNotFoundError:
+                            pass
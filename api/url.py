@@ -8,6 +8,24 @@ urlpatterns = [
     path('user/register/', views.RegisterInterface.get_view(), name='register'),
     path('user/username_available/', views.UsernameAvailableInterface.get_view(), name='usernamea_available'),
     path('user/refresh_token/', views.RefreshAccessTokenInterface.get_view(), name="refresh_token"),
+    path('user/logout/', views.LogoutInterface.get_view(), name='logout'),
+    path('user/revoke_tokens/', views.RevokeTokensInterface.get_view(), name='revoke_tokens'),
+    path('user/profile/', views.UserProfileInterface.get_view(), name='user_profile'),
+    path('user/leaderboard/', views.LeaderboardInterface.get_view(), name='leaderboard'),
+    path('user/nearby/', views.NearbyUsersInterface.get_view(), name='nearby_users'),
+    path('user/matchable/', views.SetMatchableInterface.get_view(), name='set_matchable'),
+    path('user/match/', views.MatchPenPalInterface.get_view(), name='match_pen_pal'),
+    path('letter/send/', views.SendLetterInterface.get_view(), name='send_letter'),
+    path('letter/inbox/', views.InboxInterface.get_view(), name='inbox'),
+    path('letter/outbox/', views.OutboxInterface.get_view(), name='outbox'),
+    path('letter/unread_count/', views.UnreadCountInterface.get_view(), name='unread_count'),
+    path('letter/read/', views.ReadLetterInterface.get_view(), name='read_letter'),
+    path('letter/search/', views.SearchLetterInterface.get_view(), name='search_letter'),
+    path('letter/export/', views.ExportLetterInterface.get_view(), name='export_letter'),
+    path('bulletin/send/', views.SendBulletinInterface.get_view(), name='send_bulletin'),
+    path('bulletin/read/', views.ReadBulletinInterface.get_view(), name='read_bulletin'),
+    path('stats/region/', views.RegionStatsInterface.get_view(), name='region_stats'),
+    path('map/tile/', views.MapTileInterface.get_view(), name='map_tile'),
     path('test/verify_code/', views.VerifyCodeTestInterface.get_view(), name='verify_code_test'),
     path('test/token/', views.AccessTokenTestInterface.get_view(), name="token_test"),
 ]
\ No newline at end of file
@@ -2,8 +2,26 @@ from __future__ import annotations
 from typing import *
 
 from django.db import IntegrityError
-from .logic import TOKEN_DURATION, APIInterface, JsonResponse, Tools, VerifyCode
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from .logic import TOKEN_ACCESS_SCOPE, TOKEN_DURATION, APIInterface, JsonResponse, Tools, VerifyCode
+from .archive import LetterArchive
+from .bulletin import BulletinBoard
+from .counters import UnreadCounter
+from .experience import ExpLedger, expLevel
+from .export import EXPORT_FORMATS, MailboxExport
+from .mailbox import Mailbox
+from .passwords import PasswordService, PasswordServiceBusy
+from .matching import MATCH_SCOPES, MatchPool
+from .profiles import ProfileCache
 from .models import *
+from .revocation import TokenRevocation
+from .routing import PostalRouter
+from .search import LetterSearch
+from .sharding import Shards
+from .stats import RegionStats
+from .spatial import NearbyIndex
+from .tiles import MAX_ZOOM, TILE_LAYERS, WorldMap, np
 
 # Create your views here.
 class VerifyCodeInterface(APIInterface):
@@ -67,7 +85,7 @@ class LoginInterface(APIInterface):
         'randomkey': (str, None),
         'verifycode': (str, None)
     }
-    allow_errors = [JsonResponse.ERR_LOGIN_FAIL, JsonResponse.ERR_VERIFY_CODE_FAIL]
+    allow_errors = [JsonResponse.ERR_LOGIN_FAIL, JsonResponse.ERR_VERIFY_CODE_FAIL, JsonResponse.ERR_SERVER_BUSY]
     
     def logic(self, username, password, randomkey, verifycode):
         # 验证码是否正确？
@@ -76,19 +94,28 @@ class LoginInterface(APIInterface):
             self.error = JsonResponse.ERR_VERIFY_CODE_FAIL
             return False
         
-        try:
-            user:User = User.objects.get(username = username)
-        except User.DoesNotExist:
+        user = User.getUserByUsername(username)
+        if user is None:
             self.error = JsonResponse.ERR_LOGIN_FAIL
             return False
         
-        if user.password_hash != Tools.getPasswordHash(password):
+        try:
+            passwordRight, newHash = PasswordService.getInstance().verify(password, user.password_hash)
+        except PasswordServiceBusy:
+            self.error = JsonResponse.ERR_SERVER_BUSY
+            return False
+        if not passwordRight:
             self.error = JsonResponse.ERR_LOGIN_FAIL
             return False
+        if newHash is not None:
+            # 旧格式的哈希升级为scrypt 期间密码已被修改时不覆盖
+            User.objects.using(user._state.db).filter(id=user.id, password_hash=user.password_hash) \
+                        .update(password_hash=newHash)
         
         # 登录成功
         # 开启session
-        sessionCode = user.createSession(int(Tools.getNow()))
+        sessionCode = user.createSession(TokenRevocation.getInstance().issueTime(username))
+        ExpLedger.getInstance().award(user, 'LOGIN')
         self.result = {
             'session': sessionCode
         }
@@ -115,7 +142,7 @@ class RegisterInterface(APIInterface):
     }
     allow_errors: List[int] = [JsonResponse.ERR_INPUT_USERNAME, JsonResponse.ERR_INPUT_USERNAME_UNIQUE,
                                JsonResponse.ERR_INPUT_PASSWORD, JsonResponse.ERR_INPUT_NICKNAME,
-                               JsonResponse.ERR_VERIFY_CODE_FAIL]
+                               JsonResponse.ERR_VERIFY_CODE_FAIL, JsonResponse.ERR_SERVER_BUSY]
     
     def logic(self, username, password, nickname, randomkey, verifycode):
         # 验证码是否正确？
@@ -124,12 +151,21 @@ class RegisterInterface(APIInterface):
             self.error = JsonResponse.ERR_VERIFY_CODE_FAIL
             return False
         
+        # 先计算哈希 繁忙时不会留下空的地址
+        try:
+            passwordHash = PasswordService.getInstance().hash(password)
+        except PasswordServiceBusy:
+            self.error = JsonResponse.ERR_SERVER_BUSY
+            return False
+        
         vpos = VirtualLocation.getRandomPosition()
         vlocation = VirtualLocation.createLocationByPos(vpos)
         vlocation.save()
         
         try:
-            user = User(username = username, password_hash = Tools.getPasswordHash(password),
+            # 分片时先在用户名目录中占用 居民写入新地址所在城市的分片
+            Shards.claimUsername(username, vlocation._state.db)
+            user = User(username = username, password_hash = passwordHash,
                         nickname = nickname, vlocation = vlocation, session = None)
             user.save()
         except IntegrityError:
@@ -137,6 +173,13 @@ class RegisterInterface(APIInterface):
             self.error = JsonResponse.ERR_INPUT_USERNAME_UNIQUE
             return False
         
+        if NearbyIndex.INSTANCE is not None:
+            NearbyIndex.INSTANCE.add(user.id, vpos[0], vpos[1])
+        if WorldMap.INSTANCE is not None:
+            WorldMap.INSTANCE.occupy(vpos[0], vpos[1])
+        WorldMap.invalidate(vpos[0], vpos[1])
+        RegionStats.onRegister(vlocation, user.reg_date)
+        
         self.result = {
             'message': 'success'
         }
@@ -164,9 +207,7 @@ class UsernameAvailableInterface(APIInterface):
                 'reason': 'LIMIT'
             }
             return True
-        try:
-            user = User.objects.get(username = username)
-        except User.DoesNotExist:
+        if User.getUserByUsername(username) is None:
             # 没找到 说明是unique的
             self.result = {
                 'availability': True,
@@ -201,12 +242,70 @@ class RefreshAccessTokenInterface(APIInterface):
             self.error = JsonResponse.ERR_SESSION_FAIL
             return False
         
-        token = User.createToken(username, int(Tools.getNow()), TOKEN_DURATION, 'top.moyingmoe.myletter.access')
+        token = User.createToken(username, TokenRevocation.getInstance().issueTime(username),
+                                 TOKEN_DURATION, TOKEN_ACCESS_SCOPE)
         self.result = {
             'token': token
         }
         return True
     
+class LogoutInterface(APIInterface):
+    '''
+    退出登录 吊销这个access token并结束refresh会话
+    -> token: access token
+    
+    <- message: 'success'
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED]
+    
+    def logic(self, token):
+        tokenInfo = User.analyzeToken(token, TOKEN_ACCESS_SCOPE)
+        if not tokenInfo['success']:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        payload = tokenInfo['data']['payload']
+        revocation = TokenRevocation.getInstance()
+        if payload['random']:
+            revocation.revokeToken(payload['random'], payload['expiration'])
+        revocation.revokeSessions(payload['username'])
+        User.endSession(payload['username'])
+        self.result = {
+            'message': 'success'
+        }
+        return True
+
+class RevokeTokensInterface(APIInterface):
+    '''
+    在所有设备上退出登录 吊销该用户目前为止签发的全部access token和refresh会话
+    -> token: access token
+    
+    <- message: 'success'
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED]
+    
+    def logic(self, token):
+        tokenInfo = User.analyzeToken(token, TOKEN_ACCESS_SCOPE)
+        if not tokenInfo['success']:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        username = tokenInfo['data']['payload']['username']
+        TokenRevocation.getInstance().revokeUser(username)
+        User.endSession(username)
+        self.result = {
+            'message': 'success'
+        }
+        return True
+    
 class AccessTokenTestInterface(APIInterface):
     '''
     测试token的接口
@@ -218,5 +317,641 @@ class AccessTokenTestInterface(APIInterface):
     allow_errors: List[int] = []
     
     def logic(self, token):
-        self.result = User.analyzeToken(token, 'top.moyingmoe.myletter.access')
-        return True
\ No newline at end of file
+        self.result = User.analyzeToken(token, TOKEN_ACCESS_SCOPE)
+        return True
+
+class MailboxPageInterface(APIInterface):
+    '''
+    收件箱、发件箱共用的参数、游标解析和翻页 子类给出counterpart、page和brief
+    -> token: access token
+    -> cursor: 可选 上一页返回的next_cursor 缺省表示第一页
+    -> limit: 可选 每页数量 1-100 默认20
+
+    <- letters: 本页的摘要列表 见子类
+    <- profiles: 本页对方（counterpart）的资料 {username: {username, nickname, address, postcode, exp, reg_date}}
+    <- next_cursor: 下一页的游标 没有更多时为null
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'cursor': (str, None),
+        'limit': (int, 1, Mailbox.MAX_LIMIT, JsonResponse.ERR_QUERY_LIMIT)
+    }
+    defaults: Dict[str, Any] = {
+        'cursor': '',
+        'limit': Mailbox.DEFAULT_LIMIT
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_CURSOR,
+                               JsonResponse.ERR_QUERY_LIMIT]
+    counterpart: str = ''
+
+    def page(self, user:User, position:Optional[Tuple[datetime,int]], limit:int) -> Tuple[List, Optional[str]]:
+        raise NotImplementedError()
+
+    def brief(self, item) -> Dict:
+        raise NotImplementedError()
+
+    def logic(self, token, cursor, limit):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        position = None
+        if cursor:
+            position = Mailbox.decodeCursor(cursor)
+            if position is None:
+                self.error = JsonResponse.ERR_QUERY_CURSOR
+                return False
+        
+        items, nextCursor = self.page(user, position, limit)
+        self.result = {
+            'letters': [self.brief(item) for item in items],
+            'profiles': Mailbox.pageProfiles(items, self.counterpart),
+            'next_cursor': nextCursor
+        }
+        return True
+
+class InboxInterface(MailboxPageInterface):
+    '''
+    收件箱 只包含已到达的信件和所在地区的公告 按到达时间倒序 不含正文 参数见MailboxPageInterface
+    <- letters: 摘要列表 信件为 {type: 'letter', id, sender, receiver_alias, has_read, send_time, recv_time}
+                公告为 {type: 'bulletin', id, sender, region, level, has_read, send_time, recv_time}
+    <- profiles: 本页寄信人的资料
+    '''
+    counterpart: str = 'sender'
+
+    def page(self, user, position, limit):
+        return Mailbox.inboxPage(user, position, limit)
+
+    def brief(self, item):
+        return Mailbox.inboxBrief(item)
+
+class OutboxInterface(MailboxPageInterface):
+    '''
+    发件箱 包含投递途中的信件 按发出时间倒序 不含正文 参数见MailboxPageInterface
+    <- letters: 信件摘要列表 [{id, receiver, receiver_alias, has_read, send_time, recv_time}]
+    <- profiles: 本页收信人的资料
+    '''
+    counterpart: str = 'receiver'
+
+    def page(self, user, position, limit):
+        return Mailbox.outboxPage(user, position, limit)
+
+    def brief(self, item):
+        return Mailbox.letterBrief(item, 'receiver')
+
+class UnreadCountInterface(APIInterface):
+    '''
+    未读信件数 只统计已到达的信件 正常情况下只读一次缓存 不查数据库
+    -> token: access token
+    
+    <- unread: 未读数
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED]
+    
+    def logic(self, token):
+        tokenInfo = User.analyzeToken(token, TOKEN_ACCESS_SCOPE)
+        if not tokenInfo['success']:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        self.result = {
+            'unread': UnreadCounter.get(tokenInfo['data']['payload']['username'])
+        }
+        return True
+
+class ReadLetterInterface(APIInterface):
+    '''
+    读信 收信人读取已到达的信件时将其标记为已读 寄信人可以查看自己寄出的信
+    -> token: access token
+    -> letter_id: 信件id
+    
+    <- letter: {id, sender, receiver, receiver_alias, has_read, send_time, recv_time, content}
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'letter_id': (int, None)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_LETTER]
+    
+    def logic(self, token, letter_id):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        try:
+            # 信件在收信人的分片中 由id可知
+            letter = Letter.objects.using(Shards.forId(letter_id)).select_related('sender', 'receiver') \
+                                   .defer(*Mailbox.USER_DEFER) \
+                                   .get(Q(receiver=user, recv_time__lte=Tools.getNow('datetime')) | Q(sender=user),
+                                        id=letter_id)
+            Shards.attachUsers([letter], 'sender')
+        except Letter.DoesNotExist:
+            # 已归档的信件都是已读的 不需要再标记
+            record = LetterArchive(user.id, 'inbox').get(letter_id) or LetterArchive(user.id, 'outbox').get(letter_id)
+            if record is None:
+                self.error = JsonResponse.ERR_QUERY_LETTER
+                return False
+            letter = LetterArchive.toLetters([record])[0]
+        
+        if letter.receiver_id == user.id and not letter.has_read:
+            # 用条件update保证并发读同一封信时只计一次
+            if Letter.objects.using(Shards.forId(letter.id)).filter(id=letter.id, has_read=False).update(has_read=True):
+                UnreadCounter.onRead(user.username)
+            letter.has_read = True
+        
+        self.result = {
+            'letter': dict(Mailbox.letterBrief(letter, 'sender'),
+                           receiver=Mailbox.userBrief(letter.receiver), content=letter.content)
+        }
+        return True
+
+class SearchLetterInterface(APIInterface):
+    '''
+    在自己寄出和收到（已到达）的信中全文搜索 按相关度排序
+    -> token: access token
+    -> q: 关键词 1-50字符 空格分隔的多个关键词需要同时出现
+    -> cursor: 可选 上一页返回的next_cursor 缺省表示第一页
+    -> limit: 可选 每页数量 1-100 默认20
+    
+    <- letters: [{id, sender, receiver, receiver_alias, has_read, send_time, recv_time, snippet: {text, highlights}}]
+       highlights为snippet.text中关键词出现的[起, 止)字符区间
+    <- next_cursor: 下一页的游标 没有更多时为null
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'q': (str, 1, 50, JsonResponse.ERR_QUERY_KEYWORD),
+        'cursor': (str, None),
+        'limit': (int, 1, Mailbox.MAX_LIMIT, JsonResponse.ERR_QUERY_LIMIT)
+    }
+    defaults: Dict[str, Any] = {
+        'cursor': '',
+        'limit': Mailbox.DEFAULT_LIMIT
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_KEYWORD,
+                               JsonResponse.ERR_QUERY_CURSOR, JsonResponse.ERR_QUERY_LIMIT]
+    
+    def logic(self, token, q, cursor, limit):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        if not LetterSearch.keywords(q):
+            self.error = JsonResponse.ERR_QUERY_KEYWORD
+            return False
+        
+        position = None
+        if cursor:
+            position = LetterSearch.decodeCursor(cursor)
+            if position is None:
+                self.error = JsonResponse.ERR_QUERY_CURSOR
+                return False
+        
+        hits, nextCursor = LetterSearch.search(user, q, position, limit)
+        self.result = {
+            'letters': [dict(Mailbox.letterBrief(letter, 'sender'), receiver=Mailbox.userBrief(letter.receiver),
+                             snippet=snippet) for letter, snippet in hits],
+            'next_cursor': nextCursor
+        }
+        return True
+
+class UserProfileInterface(APIInterface):
+    '''
+    批量查询用户资料
+    -> token: access token
+    -> usernames: 用户名 以逗号分隔 最多50个
+    
+    <- profiles: {username: {username, nickname, address, postcode, exp, reg_date}} 不存在的用户不出现
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'usernames': (str, 1, 50*31, JsonResponse.ERR_QUERY_USERNAMES)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_USERNAMES]
+    
+    def logic(self, token, usernames):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        names = [name for name in usernames.split(',') if name]
+        if not names or len(names) > 50:
+            self.error = JsonResponse.ERR_QUERY_USERNAMES
+            return False
+        
+        self.result = {
+            'profiles': ProfileCache.getProfiles(names)
+        }
+        return True
+
+class LeaderboardInterface(APIInterface):
+    '''
+    经验值排行榜 数据库中的经验值可能落后最近的活动几秒
+    -> token: access token
+    -> limit: 可选 人数 1-100 默认20
+    
+    <- users: [{rank, username, nickname, exp, level}] 同分同名次
+    <- me: {rank, exp, level} 自己的名次 exp包含本进程中尚未写入的经验值
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'limit': (int, 1, 100, JsonResponse.ERR_QUERY_LIMIT)
+    }
+    defaults: Dict[str, Any] = {
+        'limit': 20
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_LIMIT]
+    
+    def logic(self, token, limit):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        exp = user.exp + ExpLedger.getInstance().pendingExp(user.id)
+        self.result = {
+            'users': ExpLedger.leaderboard(limit),
+            'me': {
+                'rank': ExpLedger.rank(exp),
+                'exp': exp,
+                'level': expLevel(exp)
+            }
+        }
+        return True
+
+class NearbyUsersInterface(APIInterface):
+    '''
+    附近的居民 按虚拟距离由近到远
+    -> token: access token
+    -> limit: 可选 返回人数 1-50 默认10
+    -> radius: 可选 最大距离 1-1920 缺省不限
+    
+    <- users: [{username, nickname, distance, address, postcode}]
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'limit': (int, 1, 50, JsonResponse.ERR_QUERY_LIMIT),
+        'radius': (int, 0, 1920, JsonResponse.ERR_QUERY_RADIUS)
+    }
+    defaults: Dict[str, Any] = {
+        'limit': 10,
+        'radius': 0
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_LIMIT,
+                               JsonResponse.ERR_QUERY_RADIUS]
+    
+    def logic(self, token, limit, radius):
+        user = User.getUserByToken(token)
+        if user is None or user.vlocation_id is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        index = NearbyIndex.getInstance()
+        index.refresh()
+        vloc = user.vlocation
+        hits = index.nearest(vloc.position_x, vloc.position_y, limit, radius or None, exclude=user.id)
+        neighbours = Shards.usersByIds([hit[1] for hit in hits], 'id', 'username', 'nickname', 'vlocation',
+                                       related=('vlocation',))
+        self.result = {
+            'users': [{
+                'username': neighbours[hit[1]].username,
+                'nickname': neighbours[hit[1]].nickname,
+                'distance': round(hit[0], 2),
+                'address': neighbours[hit[1]].vlocation.getFullAddress(),
+                'postcode': neighbours[hit[1]].vlocation.getPostCode()
+            } for hit in hits if hit[1] in neighbours]
+        }
+        return True
+
+class SetMatchableInterface(APIInterface):
+    '''
+    加入或退出随机笔友匹配
+    -> token: access token
+    -> enable: 1加入 0退出
+    
+    <- matchable: 修改后的状态
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'enable': (int, 0, 1, JsonResponse.ERR_INPUT_MATCHABLE)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_INPUT_MATCHABLE]
+    
+    def logic(self, token, enable):
+        user = User.getUserByToken(token)
+        if user is None or user.vlocation_id is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        matchable = bool(enable)
+        User.objects.using(Shards.forId(user.id)).filter(id=user.id).update(matchable=matchable, matchable_time=Tools.getNow('datetime'))
+        if MatchPool.INSTANCE is not None:
+            if matchable:
+                vloc = user.vlocation
+                MatchPool.INSTANCE.add(user.id, vloc.position_x, vloc.position_y)
+            else:
+                MatchPool.INSTANCE.remove(user.id)
+        self.result = {
+            'matchable': matchable
+        }
+        return True
+
+class MatchPenPalInterface(APIInterface):
+    '''
+    随机匹配一位愿意被匹配、且之前没有匹配过的笔友
+    -> token: access token
+    -> scope: 可选 world / city / block / community 默认world
+    
+    <- username, nickname, address, postcode: 匹配到的笔友
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'scope': (str, None)
+    }
+    defaults: Dict[str, Any] = {
+        'scope': 'world'
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_INPUT_MATCH_SCOPE,
+                               JsonResponse.ERR_QUERY_MATCH]
+    
+    def logic(self, token, scope):
+        user = User.getUserByToken(token)
+        if user is None or user.vlocation_id is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        if scope not in MATCH_SCOPES:
+            self.error = JsonResponse.ERR_INPUT_MATCH_SCOPE
+            return False
+        
+        partner = MatchPool.getInstance().match(user, scope)
+        if partner is None:
+            self.error = JsonResponse.ERR_QUERY_MATCH
+            return False
+        
+        self.result = {
+            'username': partner.username,
+            'nickname': partner.nickname,
+            'address': partner.vlocation.getFullAddress(),
+            'postcode': partner.vlocation.getPostCode()
+        }
+        return True
+
+class SendBulletinInterface(APIInterface):
+    '''
+    向自己所在的城市、市区或小区发布公告 地区内的居民在收件箱中收到 公告只存一份
+    -> token: access token
+    -> level: city / block / community
+    -> content: 正文 1-10000字符
+    
+    <- bulletin_id: 公告id
+    <- region: 目标地区
+    <- recv_time: 预计到达时间戳
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'level': (str, None),
+        'content': (str, 1, 10000, JsonResponse.ERR_INPUT_CONTENT)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_INPUT_REGION_LEVEL,
+                               JsonResponse.ERR_INPUT_CONTENT]
+    
+    def logic(self, token, level, content):
+        sender = User.getUserByToken(token)
+        if sender is None or sender.vlocation_id is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        if level not in REGION_LEVELS:
+            self.error = JsonResponse.ERR_INPUT_REGION_LEVEL
+            return False
+        
+        bulletin = BulletinBoard.post(sender, level, content)
+        self.result = {
+            'bulletin_id': bulletin.id,
+            'region': bulletin.region,
+            'recv_time': bulletin.recv_time.timestamp()
+        }
+        return True
+
+class ReadBulletinInterface(APIInterface):
+    '''
+    读取所在地区已到达的公告 并标记为已读
+    -> token: access token
+    -> bulletin_id: 公告id
+    
+    <- bulletin: {type, id, sender, region, level, has_read, send_time, recv_time, content}
+    '''
+    methods: List[str] = ['GET', 'POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'bulletin_id': (int, None)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_BULLETIN]
+    
+    def logic(self, token, bulletin_id):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        bulletin = BulletinBoard.read(user, bulletin_id)
+        if bulletin is None:
+            self.error = JsonResponse.ERR_QUERY_BULLETIN
+            return False
+        
+        self.result = {
+            'bulletin': dict(Mailbox.bulletinBrief(bulletin), content=bulletin.content)
+        }
+        return True
+
+class ExportLetterInterface(APIInterface):
+    '''
+    导出自己的全部信件（含已归档的） 以流式下载返回 不是JSON
+    -> token: access token
+    -> format: 可选 jsonl（默认 每行一封信） 或 zip（每封信一个文本文件）
+    -> cursor: 可选 从id大于cursor的信件开始导出 用于中断后续传 默认0
+    
+    <- jsonl每行: {id, box, sender, receiver, receiver_alias, has_read, send_time, recv_time, content} 按id升序
+    '''
+    methods: List[str] = ['GET']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'format': (str, None),
+        'cursor': (int, 0, 2**63 - 1, JsonResponse.ERR_QUERY_CURSOR)
+    }
+    defaults: Dict[str, Any] = {
+        'format': 'jsonl',
+        'cursor': 0
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_FORMAT,
+                               JsonResponse.ERR_QUERY_CURSOR]
+    
+    def logic(self, token, format, cursor):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        if format not in EXPORT_FORMATS:
+            self.error = JsonResponse.ERR_QUERY_FORMAT
+            return False
+        
+        response = StreamingHttpResponse(MailboxExport(user, cursor).chunks(format),
+                                         content_type=EXPORT_FORMATS[format])
+        response['Content-Disposition'] = 'attachment; filename="letters-%s.%s"' % (user.username, format)
+        self.response = response
+        return True
+
+class SendLetterInterface(APIInterface):
+    '''
+    寄信 按收信地址找到收信人 到达时间由双方的虚拟距离计算
+    -> token: access token
+    -> city_name, block_name, community_name: 收信地址的城市、市区、小区名
+    -> building_index, room_index: 收信地址的幢号、门牌号
+    -> receiver_alias: 收信人姓名 1-30字符
+    -> content: 正文 1-10000字符
+    
+    <- letter_id: 信件id
+    <- recv_time: 预计到达时间戳
+    '''
+    methods: List[str] = ['POST']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'city_name': (str, None),
+        'block_name': (str, None),
+        'community_name': (str, None),
+        'building_index': (int, None),
+        'room_index': (int, None),
+        'receiver_alias': (str, 1, 30, JsonResponse.ERR_INPUT_RECEIVER_ALIAS),
+        'content': (str, 1, 10000, JsonResponse.ERR_INPUT_CONTENT)
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_QUERY_ADDRESS,
+                               JsonResponse.ERR_INPUT_RECEIVER_ALIAS, JsonResponse.ERR_INPUT_CONTENT]
+    
+    def logic(self, token, city_name, block_name, community_name, building_index, room_index,
+              receiver_alias, content):
+        sender = User.getUserByToken(token)
+        if sender is None or sender.vlocation_id is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        receiver = User.searchUserByLocation(city_name, block_name, community_name, building_index, room_index)
+        if receiver is None:
+            self.error = JsonResponse.ERR_QUERY_ADDRESS
+            return False
+        
+        sendTime = Tools.getNow('datetime')
+        recvTime = PostalRouter.getInstance().deliveryTime(
+            (sender.vlocation.position_x, sender.vlocation.position_y),
+            (receiver.vlocation.position_x, receiver.vlocation.position_y), sendTime)
+        letter = Letter(sender=sender, receiver=receiver, receiver_alias=receiver_alias,
+                        recv_time=recvTime, content=content)
+        letter.save()
+        UnreadCounter.onSend(receiver.username, recvTime)
+        RegionStats.onSend(sender.vlocation, receiver.vlocation, sendTime, recvTime)
+        ExpLedger.getInstance().award(sender, 'SEND')
+        ExpLedger.getInstance().award(receiver, 'RECEIVE')
+        
+        self.result = {
+            'letter_id': letter.id,
+            'recv_time': recvTime.timestamp()
+        }
+        return True
+
+class RegionStatsInterface(APIInterface):
+    '''
+    各地区的居民数和信件数 只读汇总表
+    -> token: access token
+    -> level: 可选 city / block / community 默认city
+    -> region: 可选 只看这一个地区 如 3-5 此时附带逐日数据
+    -> days: 可选 最近多少天 0-3650 默认0即全部
+    
+    <- regions: [{region, name, residents, letters_sent, letters_received}]
+    <- series: 指定region时 [{date, residents, letters_sent, letters_received}] 按日期升序
+    '''
+    methods: List[str] = ['GET']
+    args: Dict[str, Tuple] = {
+        'token': (str, None),
+        'level': (str, None),
+        'region': (str, None),
+        'days': (int, 0, 3650, JsonResponse.ERR_QUERY_DAYS)
+    }
+    defaults: Dict[str, Any] = {
+        'level': 'city',
+        'region': '',
+        'days': 0
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_TOKEN_ACCESS_DENIED, JsonResponse.ERR_INPUT_REGION_LEVEL,
+                               JsonResponse.ERR_QUERY_REGION, JsonResponse.ERR_QUERY_DAYS]
+    
+    def logic(self, token, level, region, days):
+        user = User.getUserByToken(token)
+        if user is None:
+            self.error = JsonResponse.ERR_TOKEN_ACCESS_DENIED
+            return False
+        
+        if level not in REGION_LEVELS:
+            self.error = JsonResponse.ERR_INPUT_REGION_LEVEL
+            return False
+        
+        if region:
+            ids = RegionStats.parseRegion(region)
+            if ids is None or len(ids) != REGION_LEVELS.index(level) + 1:
+                self.error = JsonResponse.ERR_QUERY_REGION
+                return False
+            region = '-'.join(map(str, ids))
+        
+        self.result = RegionStats.query(level, region, days)
+        return True
+
+class MapTileInterface(APIInterface):
+    '''
+    世界地图的PNG瓦片 不是JSON 支持If-None-Match条件请求
+    -> z: 缩放级别 0-5 整个世界为2^z*2^z个256*256的瓦片
+    -> x, y: 瓦片编号 0 - 2^z-1
+    -> layer: 可选 base（已入住的地址和行政边界 默认） 或 heat（叠加各小区的信件流量）
+    '''
+    methods: List[str] = ['GET']
+    args: Dict[str, Tuple] = {
+        'z': (int, 0, MAX_ZOOM, JsonResponse.ERR_QUERY_TILE),
+        'x': (int, 0, 2**MAX_ZOOM - 1, JsonResponse.ERR_QUERY_TILE),
+        'y': (int, 0, 2**MAX_ZOOM - 1, JsonResponse.ERR_QUERY_TILE),
+        'layer': (str, None)
+    }
+    defaults: Dict[str, Any] = {
+        'layer': 'base'
+    }
+    allow_errors: List[int] = [JsonResponse.ERR_QUERY_TILE]
+    
+    def logic(self, z, x, y, layer):
+        if np is None or layer not in TILE_LAYERS or x >= 2**z or y >= 2**z:
+            self.error = JsonResponse.ERR_QUERY_TILE
+            return False
+        
+        data, etag = WorldMap.getInstance().tile(layer, z, x, y)
+        if etag in self.request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(data, content_type='image/png')
+        response['ETag'] = etag
+        # 瓦片随注册变化 每次都要验证
+        response['Cache-Control'] = 'public, no-cache'
+        self.response = response
+        return True
@@ -13,4 +13,12 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myletter.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 新信件推送（websocket/长轮询）由PushRouter处理 其余请求交给Django
+from api.realtime import PushRouter
+application = PushRouter(django_application)
+
+# 服务进程启动信件投递调度器
+from api.delivery import DeliveryScheduler
+DeliveryScheduler.getInstance().start()
@@ -0,0 +1,49 @@
+"""
+带生产环境连接配置的SQLite后端
+
+Django 3.2的sqlite3后端无法为每个连接设置PRAGMA 也无法指定事务模式
+本后端从DATABASES[...]['OPTIONS']中额外读取两项:
+    'pragmas':          PRAGMA名 -> 值 每个新连接都会执行
+    'transaction_mode': 'DEFERRED' / 'IMMEDIATE' / 'EXCLUSIVE' atomic()开启事务时使用
+"""
+from django.db.backends.sqlite3 import base
+
+
+# 生产环境默认的PRAGMA
+# WAL让读写互不阻塞 synchronous=NORMAL在WAL下仍保证数据库一致性
+PRODUCTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,           # 毫秒 等待写锁而不是立刻报database is locked
+    'cache_size': -64000,           # 负数单位为KiB 即约64MB页缓存
+    'mmap_size': 268435456,         # 256MB
+    'temp_store': 'MEMORY',
+}
+
+
+def applyPragmas(conn, pragmas) -> None:
+    '''对一个DB-API连接执行PRAGMA 也供benchmark直接使用'''
+    for name, value in pragmas.items():
+        conn.execute('PRAGMA %s = %s' % (name, value))
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    pragmas = {}
+    transaction_mode = 'DEFERRED'
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        # 这两项不是sqlite3.connect的参数 取出后再连接
+        self.pragmas = kwargs.pop('pragmas', {})
+        self.transaction_mode = kwargs.pop('transaction_mode', 'DEFERRED').upper()
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        applyPragmas(conn, self.pragmas)
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # atomic()在SQLite上以显式BEGIN开启事务
+        # IMMEDIATE在BEGIN时就拿写锁 避免读锁升级写锁时的死锁（立即返回database is locked）
+        self.cursor().execute('BEGIN %s' % self.transaction_mode)
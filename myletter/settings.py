@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -75,13 +76,35 @@ WSGI_APPLICATION = 'myletter.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# 使用带连接PRAGMA的SQLite后端 见myletter/backends/sqlite3/base.py
+from .backends.sqlite3.base import PRODUCTION_PRAGMAS
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': 'myletter.backends.sqlite3',
+        'NAME': os.environ.get('MYLETTER_DB_NAME', BASE_DIR / 'db.sqlite3'),
+        # 持久连接 每个工作线程复用连接 不再每个请求重新打开
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {
+            'pragmas': PRODUCTION_PRAGMAS,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# 按城市分片 见api/sharding.py 环境变量MYLETTER_SHARDS为分片数 不设置或为1时不分片
+# 分片数据库为 <default的文件名>.shard<i> 居民、信件、公告在分片中 其余表在default中
+# 建表: init_shards 即对default和每个分片各执行一次 migrate --run-syncdb --database <别名>（同时设置各分片的主键起点）
+# 分片数和城市到分片的对应在有数据后不能再改变
+SHARD_COUNT = int(os.environ.get('MYLETTER_SHARDS') or 1)
+SHARD_DATABASES = []
+if SHARD_COUNT > 1:
+    for i in range(SHARD_COUNT):
+        alias = 'shard%d' % i
+        DATABASES[alias] = dict(DATABASES['default'], NAME='%s.shard%d' % (DATABASES['default']['NAME'], i))
+        SHARD_DATABASES.append(alias)
+    DATABASE_ROUTERS = ['api.sharding.ShardRouter']
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -90,9 +113,113 @@ CACHES = {
     'rsession': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'refresh-session',
+    },
+    # 未读计数等按用户的计数器 所有进程必须共享 见下
+    'counter': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'counter',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # 用户资料 见api/profiles.py 修改后按键删除 多进程部署时同样必须共享 见下
+    'profile': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'profile',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
     }
 }
 
+# 环境变量MYLETTER_MEMCACHED为memcached的地址（如127.0.0.1:11211 需要安装pymemcache）时 计数器和用户资料使用memcached
+# 计数用incr/decr原子地修改 资料修改后删除的缓存项对所有进程生效
+# 不设置时只在进程内 只适用于单进程部署（非DEBUG下启动时会警告）
+MEMCACHED_LOCATION = os.environ.get('MYLETTER_MEMCACHED') or None
+if MEMCACHED_LOCATION:
+    CACHES['counter'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_LOCATION,
+    }
+    CACHES['profile'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': MEMCACHED_LOCATION,
+        'KEY_PREFIX': 'profile',
+    }
+
+
+# 按请求profile 见api/profiling.py 关闭时无任何开销
+# 开启后按SAMPLE_RATE随机采样 或请求头X-Myletter-Profile等于HEADER_TOKEN时触发
+API_PROFILING = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.0,
+    'HEADER_TOKEN': None,
+    'DIR': BASE_DIR / 'profiles',
+    'MAX_FILES': 200,
+    'TRACEMALLOC': False,
+}
+
+# 信件投递调度器 见api/delivery.py 在wsgi/asgi启动时运行
+DELIVERY_SCHEDULER = {
+    'ENABLED': True,
+    'POLL_INTERVAL': 5,
+}
+
+# 信件正文压缩 见api/compression.py
+LETTER_COMPRESSION = {
+    'CODEC': 'zlib',
+    'LEVEL': 6,
+    'THRESHOLD': 128,
+    'DICTIONARY': True,
+}
+
+# 冷信件归档 见api/archive.py 由archive_letters命令定期执行
+LETTER_ARCHIVE = {
+    'DIR': BASE_DIR / 'archive',
+    'AGE_DAYS': 180,
+    'SEGMENT_LETTERS': 500,
+}
+
+# 经验值的写回缓冲 见api/experience.py
+USER_EXP = {
+    'FLUSH_INTERVAL': 10,
+    'SEND': 5,
+    'RECEIVE': 2,
+    'LOGIN': 1,
+}
+
+# 地区统计的写回缓冲 见api/stats.py
+REGION_STATS = {
+    'FLUSH_INTERVAL': 10,
+}
+
+# 世界地图瓦片缓存 见api/tiles.py
+MAP_TILES = {
+    'DIR': BASE_DIR / 'tiles',
+    'HEAT_TTL': 600,
+}
+
+# access token和refresh会话的吊销表 见api/revocation.py 同一台机器上的进程共享此文件
+# 修改SLOTS后需删除旧文件
+TOKEN_REVOCATION = {
+    'PATH': BASE_DIR / 'revocation.bin',
+    'SLOTS': 1 << 18,
+}
+
+# 密码哈希 见api/passwords.py scrypt在有界的线程池中计算
+PASSWORD_HASHING = {
+    'N': 1 << 14,
+    'R': 8,
+    'P': 1,
+    'WORKERS': os.cpu_count() or 1,
+    'MAX_PENDING': 64,
+    'TIMEOUT': 5,
+}
+
+# 仅供压测使用的验证码旁路 只在DEBUG下生效
+# 环境变量MYLETTER_VERIFY_CODE_BYPASS非空时 输入该值的验证码总是通过
+VERIFY_CODE_TEST_BYPASS = (os.environ.get('MYLETTER_VERIFY_CODE_BYPASS') or None) if DEBUG else None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myletter.settings')
 
 application = get_wsgi_application()
+
+# 服务进程启动信件投递调度器
+from api.delivery import DeliveryScheduler
+DeliveryScheduler.getInstance().start()